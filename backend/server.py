@@ -3,11 +3,13 @@ from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne, ReturnDocument
+from pymongo.errors import BulkWriteError
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, EmailStr
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, NamedTuple, Tuple
 import uuid
 from datetime import datetime, timezone, timedelta
 import jwt
@@ -16,10 +18,20 @@ import httpx
 import base64
 import random
 import pandas as pd
+import numpy as np
 import io
+import json
 from fastapi.responses import StreamingResponse
+from fastapi.encoders import jsonable_encoder
 import xlsxwriter
 import re
+import asyncio
+import math
+import time
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -288,6 +300,175 @@ def calculate_margin(selling_price: float, buying_price: float, fees: float) ->
 
 # ==================== PRICE TREND ANALYSIS ====================
 
+# Keepa timestamps are minutes since the Keepa epoch
+KEEPA_EPOCH = datetime(2000, 12, 21, tzinfo=timezone.utc)
+# Price histories used for trends, by priority: Amazon, New FBA, New 3rd party
+KEEPA_TREND_CSV_INDICES = [0, 4, 1]
+TREND_WINDOWS_DAYS = (30, 60, 90)
+
+
+def keepa_minutes_now() -> float:
+    """Current time in Keepa minutes"""
+    return (datetime.now(timezone.utc) - KEEPA_EPOCH).total_seconds() / 60
+
+
+def decode_keepa_csv(series: Optional[list]) -> tuple:
+    """
+    Decode one interleaved Keepa csv array [minutes, price_cents, minutes, price_cents, ...]
+    into two numpy arrays in a single pass.
+    
+    Returns:
+        tuple: (keepa_minutes int32 array, prices float64 array in currency units),
+               keeping only points with a valid (> 0) price
+    """
+    if not series:
+        return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float64)
+    try:
+        raw = np.asarray(series, dtype=np.int64)
+    except (TypeError, ValueError):
+        # Missing values: treat them as "no price"
+        raw = np.array([-1 if v is None else v for v in series], dtype=np.int64)
+    pairs = raw[:len(raw) // 2 * 2].reshape(-1, 2)
+    valid = (pairs[:, 0] >= 0) & (pairs[:, 1] > 0)
+    minutes = pairs[valid, 0].astype(np.int32)
+    prices = pairs[valid, 1] / 100.0
+    if len(minutes) > 1 and np.any(np.diff(minutes) < 0):
+        order = np.argsort(minutes, kind='stable')
+        minutes, prices = minutes[order], prices[order]
+    return minutes, prices
+
+
+def select_keepa_price_series(keepa_product: dict) -> tuple:
+    """
+    Pick the first non-empty price history among Amazon (0), New FBA (4) and New 3rd party (1).
+    
+    Returns:
+        tuple: (csv_idx or None, keepa_minutes, prices)
+    """
+    csv_data = keepa_product.get('csv') or []
+    for csv_idx in KEEPA_TREND_CSV_INDICES:
+        if len(csv_data) > csv_idx and csv_data[csv_idx]:
+            minutes, prices = decode_keepa_csv(csv_data[csv_idx])
+            if len(prices) > 0:
+                return csv_idx, minutes, prices
+    return None, np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float64)
+
+
+def build_price_trend(current_price: float, windows: dict, data_points: int) -> dict:
+    """
+    Build the price trend dict from per-window statistics.
+    
+    windows: {days: (count, mean, min, max, variance around the rounded mean)} for 30/60/90 days
+    """
+    def window_avg(days):
+        count, mean = windows[days][0], windows[days][1]
+        return round(float(mean), 2) if count else None
+    
+    avg_30d = window_avg(30)
+    avg_60d = window_avg(60)
+    avg_90d = window_avg(90)
+    
+    count_30d, _, min_30d, max_30d, variance_30d = windows[30]
+    min_30d = round(float(min_30d), 2) if count_30d else None
+    max_30d = round(float(max_30d), 2) if count_30d else None
+    
+    # Calculate volatility (coefficient of variation)
+    if count_30d > 1:
+        std_dev = float(variance_30d) ** 0.5
+        volatility = round((std_dev / avg_30d) * 100, 2) if avg_30d > 0 else 0
+    else:
+        volatility = 0
+    
+    # Determine trend: compare current price to 30-day average
+    if avg_30d:
+        diff_percentage = ((current_price - avg_30d) / avg_30d) * 100
+        if diff_percentage > 5:
+            trend = "hausse"
+        elif diff_percentage < -5:
+            trend = "baisse"
+        else:
+            trend = "stable"
+    else:
+        trend = "stable"
+    
+    # Is it a favorable time to sell? (current price is below average = lower competition)
+    is_favorable = current_price < avg_30d if avg_30d else False
+    
+    return {
+        'trend': trend,
+        'current_price': current_price,
+        'avg_30d': avg_30d,
+        'avg_60d': avg_60d,
+        'avg_90d': avg_90d,
+        'min_30d': min_30d,
+        'max_30d': max_30d,
+        'volatility': volatility,
+        'is_favorable': is_favorable,
+        'data_points': data_points
+    }
+
+
+def analyze_price_series_batch(series: List[tuple], now_minutes: Optional[float] = None) -> List[Optional[dict]]:
+    """
+    Trend analysis of many decoded, time-sorted price series at once (see decode_keepa_csv).
+    
+    series: [(keepa_minutes, prices, current_price), ...]
+    
+    All series are concatenated with a segment id per series, so the 30/60/90-day
+    counts, sums, sums of squares and min/max are computed with one vectorized pass
+    per window instead of one Python loop per product. Sums are taken in whole cents,
+    which are exact in any order: a series gives the same trend alone or in a batch.
+    """
+    results: List[Optional[dict]] = [None] * len(series)
+    sizes = np.array([len(prices) for _, prices, _ in series], dtype=np.int64)
+    if not (sizes >= 2).any():
+        return results
+    
+    n = len(series)
+    minutes = np.concatenate([m for m, _, _ in series])
+    cents = np.rint(np.concatenate([p for _, p, _ in series]) * 100)
+    segments = np.repeat(np.arange(n), sizes)
+    now_minutes = now_minutes if now_minutes is not None else keepa_minutes_now()
+    
+    window_stats = {}
+    for days in TREND_WINDOWS_DAYS:
+        mask = minutes >= now_minutes - days * 1440
+        seg, values = segments[mask], cents[mask]
+        counts = np.bincount(seg, minlength=n)
+        sums = np.bincount(seg, weights=values, minlength=n) / 100
+        sums_sq = np.bincount(seg, weights=values * values, minlength=n) / 10000
+        mins = np.full(n, np.inf)
+        maxs = np.full(n, -np.inf)
+        np.minimum.at(mins, seg, values / 100)
+        np.maximum.at(maxs, seg, values / 100)
+        means = np.divide(sums, counts, out=np.zeros(n), where=counts > 0)
+        window_stats[days] = (counts, means, mins, maxs, sums, sums_sq)
+    
+    for i, (_, _, current_price) in enumerate(series):
+        if sizes[i] < 2:
+            continue
+        windows = {}
+        for days, (counts, means, mins, maxs, sums, sums_sq) in window_stats.items():
+            count = int(counts[i])
+            if count == 0:
+                windows[days] = (0, 0.0, 0.0, 0.0, 0.0)
+                continue
+            rounded_mean = round(float(means[i]), 2)
+            # Variance around the rounded mean from the running sums
+            variance = (sums_sq[i] - 2 * rounded_mean * sums[i]) / count + rounded_mean ** 2
+            windows[days] = (count, means[i], mins[i], maxs[i], max(variance, 0.0))
+        results[i] = build_price_trend(current_price, windows, int(sizes[i]))
+    return results
+
+
+def analyze_price_series(minutes: np.ndarray, prices: np.ndarray, current_price: float, now_minutes: Optional[float] = None) -> Optional[dict]:
+    """Trend analysis of one decoded, time-sorted price series (see decode_keepa_csv)"""
+    if len(prices) < 2:
+        logger.info("Insufficient price history for trend analysis")
+        return None
+    return analyze_price_series_batch([(minutes, prices, current_price)], now_minutes)[0]
+
+
 def analyze_keepa_price_trends(keepa_product: dict, current_price: float) -> dict:
     """
     Analyze Keepa price history to determine trends, volatility, and opportunity signals.
@@ -301,109 +482,45 @@ def analyze_keepa_price_trends(keepa_product: dict, current_price: float) -> dic
     - is_favorable: True if current price is below 30-day average (good time to sell)
     """
     try:
-        csv_data = keepa_product.get('csv', [])
-        if not csv_data or len(csv_data) == 0:
+        if not keepa_product.get('csv'):
             logger.info("No CSV data in Keepa product for trend analysis")
             return None
         
         # Keepa CSV format: csv[0] = Amazon prices, csv[1] = Marketplace New, etc.
         # Each array is [timestamp_minutes, price_cents, timestamp_minutes, price_cents, ...]
-        # Timestamps are in Keepa minutes (minutes since Keepa epoch: 21 Dec 2000)
-        
-        # Try to get price history from Amazon direct (index 0) or New FBA (index 4)
-        price_history = []
-        for csv_idx in [0, 4, 1]:  # Amazon, New FBA, New 3rd party
-            if len(csv_data) > csv_idx and csv_data[csv_idx]:
-                prices_array = csv_data[csv_idx]
-                # Parse [timestamp, price, timestamp, price, ...]
-                for i in range(0, len(prices_array), 2):
-                    if i + 1 < len(prices_array):
-                        timestamp_keepa = prices_array[i]
-                        price_cents = prices_array[i + 1]
-                        
-                        if timestamp_keepa is not None and price_cents is not None and price_cents > 0:
-                            # Convert Keepa minutes to datetime
-                            keepa_epoch = datetime(2000, 12, 21, tzinfo=timezone.utc)
-                            price_date = keepa_epoch + timedelta(minutes=timestamp_keepa)
-                            price_eur = price_cents / 100.0
-                            
-                            price_history.append({
-                                'date': price_date,
-                                'price': price_eur
-                            })
-                
-                if len(price_history) > 0:
-                    logger.info(f"Found {len(price_history)} price points from csv index {csv_idx}")
-                    break
-        
-        if len(price_history) < 2:
-            logger.info("Insufficient price history for trend analysis")
-            return None
-        
-        # Sort by date
-        price_history.sort(key=lambda x: x['date'])
-        
-        # Calculate statistics for different time periods
-        now = datetime.now(timezone.utc)
-        date_30d = now - timedelta(days=30)
-        date_60d = now - timedelta(days=60)
-        date_90d = now - timedelta(days=90)
-        
-        prices_30d = [p['price'] for p in price_history if p['date'] >= date_30d]
-        prices_60d = [p['price'] for p in price_history if p['date'] >= date_60d]
-        prices_90d = [p['price'] for p in price_history if p['date'] >= date_90d]
-        
-        # Calculate averages
-        avg_30d = round(sum(prices_30d) / len(prices_30d), 2) if prices_30d else None
-        avg_60d = round(sum(prices_60d) / len(prices_60d), 2) if prices_60d else None
-        avg_90d = round(sum(prices_90d) / len(prices_90d), 2) if prices_90d else None
-        
-        # Calculate min/max for 30 days
-        min_30d = round(min(prices_30d), 2) if prices_30d else None
-        max_30d = round(max(prices_30d), 2) if prices_30d else None
-        
-        # Calculate volatility (coefficient of variation)
-        if prices_30d and len(prices_30d) > 1:
-            mean_price = avg_30d
-            variance = sum((p - mean_price) ** 2 for p in prices_30d) / len(prices_30d)
-            std_dev = variance ** 0.5
-            volatility = round((std_dev / mean_price) * 100, 2) if mean_price > 0 else 0
-        else:
-            volatility = 0
-        
-        # Determine trend: compare current price to 30-day average
-        if avg_30d:
-            diff_percentage = ((current_price - avg_30d) / avg_30d) * 100
-            if diff_percentage > 5:
-                trend = "hausse"
-            elif diff_percentage < -5:
-                trend = "baisse"
-            else:
-                trend = "stable"
-        else:
-            trend = "stable"
+        csv_idx, minutes, prices = select_keepa_price_series(keepa_product)
+        if csv_idx is not None:
+            logger.info(f"Found {len(prices)} price points from csv index {csv_idx}")
         
-        # Is it a favorable time to sell? (current price is below average = lower competition)
-        is_favorable = current_price < avg_30d if avg_30d else False
-        
-        return {
-            'trend': trend,
-            'current_price': current_price,
-            'avg_30d': avg_30d,
-            'avg_60d': avg_60d,
-            'avg_90d': avg_90d,
-            'min_30d': min_30d,
-            'max_30d': max_30d,
-            'volatility': volatility,
-            'is_favorable': is_favorable,
-            'data_points': len(price_history)
-        }
+        return analyze_price_series(minutes, prices, current_price)
     
     except Exception as e:
         logger.error(f"Error analyzing Keepa price trends: {e}")
         return None
 
 
+def analyze_price_trends_batch(items: List[tuple]) -> List[Optional[dict]]:
+    """
+    Price trends of the products of a compare batch, in one vectorized pass.
+    
+    items: [(stored_history or None, keepa_csv, current_price), ...] where the stored
+    history (keepa minutes, prices) is preferred when it has enough points, as it
+    covers more than the fetched window (and is all an incremental refresh returns).
+    """
+    series = []
+    for stored_history, keepa_csv, current_price in items:
+        if stored_history is not None and len(stored_history[1]) >= 2:
+            minutes, prices = stored_history
+        else:
+            _, minutes, prices = select_keepa_price_series({'csv': keepa_csv})
+        series.append((minutes, prices, current_price))
+    try:
+        return analyze_price_series_batch(series)
+    except Exception as e:
+        logger.error(f"Error analyzing Keepa price trends in batch: {e}")
+        return [None] * len(items)
+
+
 def calculate_opportunity_score(
     margin_eur: Optional[float],
     margin_percentage: Optional[float],
@@ -563,10 +680,8 @@ def predict_price_profitability(price_trend: dict, amazon_price: float, supplier
         price_90d = max(current_price * 0.5, min(price_90d, current_price * 2.0))
         
         # Calculate predicted profits (Amazon price - supplier price - 15% fees)
-        AMAZON_FEE_RATE = 0.15
-        
         def calc_profit(amazon_price_pred):
-            fees = amazon_price_pred * AMAZON_FEE_RATE
+            fees = amazon_price_pred * AMAZON_FEE_PERCENTAGE
             return round(amazon_price_pred - supplier_price - fees, 2)
         
         current_profit = calc_profit(current_price)
@@ -640,41 +755,792 @@ def predict_price_profitability(price_trend: dict, amazon_price: float, supplier
         return None
 
 
+# ==================== HTTP CLIENTS ====================
+
+# One long-lived pooled client per outbound provider, so repeated calls reuse
+# TCP/TLS connections instead of paying a new handshake each time.
+# max_in_flight bounds the concurrent requests per provider when products are compared in parallel.
+HTTP_CLIENT_CONFIGS = {
+    'keepa': {'max_connections': 20, 'max_keepalive': 10, 'keepalive_expiry': 60, 'connect_timeout': 5, 'timeout': 30,
+              'max_in_flight': int(os.environ.get('KEEPA_MAX_IN_FLIGHT', 8))},
+    'google': {'max_connections': 20, 'max_keepalive': 10, 'keepalive_expiry': 60, 'connect_timeout': 5, 'timeout': 30,
+               'max_in_flight': int(os.environ.get('GOOGLE_MAX_IN_FLIGHT', 5))},
+    'dataforseo': {'max_connections': 10, 'max_keepalive': 5, 'keepalive_expiry': 60, 'connect_timeout': 5, 'timeout': 60,
+                   'max_in_flight': int(os.environ.get('DATAFORSEO_MAX_IN_FLIGHT', 4))},
+    'exchange': {'max_connections': 2, 'max_keepalive': 1, 'keepalive_expiry': 30, 'connect_timeout': 3, 'timeout': 5,
+                 'max_in_flight': 2},
+}
+
+# Expected request latency until measured (see provider_request); used by the compare planner
+# ('dataforseo_queue': time from task_post to a ready result in the DataForSEO standard queue)
+PROVIDER_DEFAULT_LATENCY_SECONDS = {'keepa': 1.0, 'google': 0.5, 'dataforseo': 5.0, 'exchange': 0.3, 'dataforseo_queue': 300.0}
+PROVIDER_LATENCY_SMOOTHING = 0.2  # Weight of the latest request in the moving average
+
+http_clients: Dict[str, httpx.AsyncClient] = {}
+provider_semaphores: Dict[str, asyncio.Semaphore] = {}
+provider_latencies: Dict[str, float] = {}  # Exponential moving average of the request latency, seconds
+
+
+def create_http_client(provider: str) -> httpx.AsyncClient:
+    """Build a pooled HTTP/2 client with the provider's limits and timeouts"""
+    config = HTTP_CLIENT_CONFIGS[provider]
+    return httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(
+            max_connections=config['max_connections'],
+            max_keepalive_connections=config['max_keepalive'],
+            keepalive_expiry=config['keepalive_expiry']
+        ),
+        timeout=httpx.Timeout(config['timeout'], connect=config['connect_timeout'])
+    )
+
+
+def get_http_client(provider: str) -> httpx.AsyncClient:
+    """Return the shared client for a provider (created lazily if the startup hook has not run)"""
+    http_client = http_clients.get(provider)
+    if http_client is None or http_client.is_closed:
+        http_client = create_http_client(provider)
+        http_clients[provider] = http_client
+    return http_client
+
+
+def get_provider_semaphore(provider: str) -> asyncio.Semaphore:
+    """Semaphore bounding the in-flight requests of a provider"""
+    semaphore = provider_semaphores.get(provider)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(HTTP_CLIENT_CONFIGS[provider]['max_in_flight'])
+        provider_semaphores[provider] = semaphore
+    return semaphore
+
+
+async def provider_request(provider: str, method: str, url: str, **kwargs) -> httpx.Response:
+    """Send a request with the provider's shared client, within its in-flight limit"""
+    async with get_provider_semaphore(provider):
+        started = time.monotonic()
+        response = await get_http_client(provider).request(method, url, **kwargs)
+        record_provider_latency(provider, time.monotonic() - started)
+        return response
+
+
+def record_provider_latency(provider: str, elapsed: float):
+    previous = provider_latencies.get(provider)
+    provider_latencies[provider] = elapsed if previous is None else previous + PROVIDER_LATENCY_SMOOTHING * (elapsed - previous)
+
+
+def get_provider_latency(provider: str) -> float:
+    """Measured (moving average) or default latency of a provider request, in seconds"""
+    return provider_latencies.get(provider, PROVIDER_DEFAULT_LATENCY_SECONDS[provider])
+
+
+async def close_http_clients():
+    """Close every shared provider client"""
+    for provider, http_client in list(http_clients.items()):
+        try:
+            await http_client.aclose()
+        except Exception as e:
+            logger.warning(f"Error closing {provider} HTTP client: {e}")
+    http_clients.clear()
+
+
+# ==================== BOUNDED CONCURRENCY ====================
+
+# Products compared at the same time by batch compares (can be lowered per request)
+COMPARE_BATCH_CONCURRENCY = int(os.environ.get('COMPARE_BATCH_CONCURRENCY', 5))
+COMPARE_BATCH_MAX_CONCURRENCY = 20
+
+
+async def map_bounded(func, items: list, limit: int) -> list:
+    """
+    Await func(item) for every item with at most `limit` calls in flight.
+    
+    Results are returned in the order of `items`; a call that raised is
+    returned as its exception (like asyncio.gather(return_exceptions=True)).
+    Provider rate limits still apply inside each call (token bucket, provider semaphores).
+    """
+    results: list = [None] * len(items)
+    next_index = 0
+    
+    async def worker():
+        nonlocal next_index
+        while next_index < len(items):
+            index = next_index
+            next_index += 1
+            try:
+                results[index] = await func(items[index])
+            except Exception as e:
+                results[index] = e
+    
+    await asyncio.gather(*(worker() for _ in range(max(1, min(limit, len(items))))))
+    return results
+
+
+def resolve_compare_concurrency(concurrency: Optional[int]) -> int:
+    """In-flight limit of a batch compare: the requested one within bounds, or the default"""
+    if not concurrency:
+        return COMPARE_BATCH_CONCURRENCY
+    return max(1, min(concurrency, COMPARE_BATCH_MAX_CONCURRENCY))
+
+
+# ==================== ANALYSIS PROCESS POOL ====================
+
+# CPU-bound work on whole batches (price trends of a compare batch, catalog re-scoring) runs
+# in worker processes so that it does not stall the event loop; 0 workers runs it inline.
+# Work on fewer than ANALYSIS_POOL_MIN_ITEMS items also runs inline: pickling it to a
+# worker would cost more than the work itself.
+ANALYSIS_PROCESS_WORKERS = int(os.environ.get('ANALYSIS_PROCESS_WORKERS', min(4, os.cpu_count() or 1)))
+ANALYSIS_POOL_MIN_ITEMS = int(os.environ.get('ANALYSIS_POOL_MIN_ITEMS', 50))
+
+analysis_executor: Optional[ProcessPoolExecutor] = None
+
+
+def get_analysis_executor() -> Optional[ProcessPoolExecutor]:
+    """
+    The shared analysis process pool (None when disabled).
+    
+    Created by the startup hook, or again after a worker died. Workers are spawned,
+    not forked: the parent already runs the event loop and the MongoDB driver threads,
+    which a forked child would inherit in whatever state they were in.
+    """
+    global analysis_executor
+    if ANALYSIS_PROCESS_WORKERS <= 0:
+        return None
+    if analysis_executor is None:
+        analysis_executor = ProcessPoolExecutor(
+            max_workers=ANALYSIS_PROCESS_WORKERS,
+            mp_context=multiprocessing.get_context('spawn')
+        )
+    return analysis_executor
+
+
+async def run_analysis(func, *args, items: int = 1):
+    """Run a pure, module-level function with picklable arguments in the analysis process pool
+    
+    items: size of the work; below ANALYSIS_POOL_MIN_ITEMS it runs inline.
+    """
+    global analysis_executor
+    executor = get_analysis_executor() if items >= ANALYSIS_POOL_MIN_ITEMS else None
+    if executor is None:
+        return func(*args)
+    try:
+        return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+    except BrokenProcessPool:
+        # A worker died (e.g. killed by the OOM killer): start a new pool next time, run this one inline
+        logger.warning(f"Analysis process pool broken, running {func.__name__} inline")
+        analysis_executor = None
+        return func(*args)
+
+
+def shutdown_analysis_executor():
+    global analysis_executor
+    if analysis_executor is not None:
+        analysis_executor.shutdown(wait=False, cancel_futures=True)
+        analysis_executor = None
+
+
 # ==================== KEEPA MULTI-DOMAIN SEARCH ====================
 
 # Keepa domain IDs: 1=US, 2=UK, 3=DE, 4=FR, 5=JP, 6=CA, 7=CN, 8=IT, 9=ES, 10=IN, 11=MX
 KEEPA_EUROPEAN_DOMAINS = [
-    {'domain': 4, 'name': 'Amazon.fr', 'flag': '🇫🇷', 'currency': 'EUR', 'exchange_rate': 1.0},
-    {'domain': 3, 'name': 'Amazon.de', 'flag': '🇩🇪', 'currency': 'EUR', 'exchange_rate': 1.0},
-    {'domain': 8, 'name': 'Amazon.it', 'flag': '🇮🇹', 'currency': 'EUR', 'exchange_rate': 1.0},
-    {'domain': 9, 'name': 'Amazon.es', 'flag': '🇪🇸', 'currency': 'EUR', 'exchange_rate': 1.0},
-    {'domain': 2, 'name': 'Amazon.co.uk', 'flag': '🇬🇧', 'currency': 'GBP', 'exchange_rate': 1.17},
-    {'domain': 1, 'name': 'Amazon.com', 'flag': '🇺🇸', 'currency': 'USD', 'exchange_rate': 0.92},
+    {'domain': 4, 'name': 'Amazon.fr', 'flag': '🇫🇷', 'currency': 'EUR', 'exchange_rate': 1.0, 'market_code': 'FR', 'country': 'France'},
+    {'domain': 3, 'name': 'Amazon.de', 'flag': '🇩🇪', 'currency': 'EUR', 'exchange_rate': 1.0, 'market_code': 'DE', 'country': 'Allemagne'},
+    {'domain': 8, 'name': 'Amazon.it', 'flag': '🇮🇹', 'currency': 'EUR', 'exchange_rate': 1.0, 'market_code': 'IT', 'country': 'Italie'},
+    {'domain': 9, 'name': 'Amazon.es', 'flag': '🇪🇸', 'currency': 'EUR', 'exchange_rate': 1.0, 'market_code': 'ES', 'country': 'Espagne'},
+    {'domain': 2, 'name': 'Amazon.co.uk', 'flag': '🇬🇧', 'currency': 'GBP', 'exchange_rate': 1.17, 'market_code': 'UK', 'country': 'Royaume-Uni'},
+    {'domain': 1, 'name': 'Amazon.com', 'flag': '🇺🇸', 'currency': 'USD', 'exchange_rate': 0.92, 'market_code': 'US', 'country': 'États-Unis'},
 ]
 
+# Markets compared by the multi-market arbitrage analysis (in display order)
+ARBITRAGE_MARKET_CODES = ['FR', 'UK', 'DE', 'ES']
+
+
+# ==================== KEEPA TOKEN RATE LIMITER ====================
+
+# Predicted token cost of Keepa calls
+KEEPA_TOKEN_COST_PRODUCT = 1  # per product (code or ASIN) requested
+KEEPA_TOKEN_COST_SEARCH = 10  # per /search result page
+KEEPA_SEARCH_CANDIDATES = 5  # ASINs of a keyword search checked for a valid price
+KEEPA_MAX_RETRIES = 3  # retries after an unexpected 429
+KEEPA_REFILL_INTERVAL_MS = 60000  # Keepa adds `refillRate` tokens every minute
+
+
+class KeepaTokenBucket:
+    """Client-side mirror of the token bucket of one Keepa API key.
+
+    The state is re-synchronised from the tokensLeft / refillIn / refillRate
+    fields of every Keepa response. Callers acquire the predicted cost of a call
+    before sending it; when the bucket is too low they queue (FIFO) until the
+    refill that covers the cost instead of hitting a 429.
+    """
+
+    def __init__(self):
+        self.tokens_left: Optional[float] = None  # Unknown until the first response
+        self.refill_rate: float = 0  # Tokens per minute
+        self.refill_in_ms: float = 0  # Milliseconds until the next refill, at updated_at
+        self.updated_at: float = time.monotonic()
+        self.synced_at: Optional[datetime] = None
+        self.waiting = 0
+        self.lock = asyncio.Lock()
+
+    @property
+    def capacity(self) -> Optional[float]:
+        # Keepa buckets hold at most one hour of refills
+        return self.refill_rate * 60 if self.refill_rate > 0 else None
+
+    def _elapsed_refills(self, now: float) -> int:
+        elapsed_ms = (now - self.updated_at) * 1000
+        if self.refill_rate <= 0 or elapsed_ms < self.refill_in_ms:
+            return 0
+        return 1 + int((elapsed_ms - self.refill_in_ms) // KEEPA_REFILL_INTERVAL_MS)
+
+    def estimate_tokens(self, now: Optional[float] = None) -> Optional[float]:
+        """Tokens expected to be available now, counting refills since the last sync"""
+        if self.tokens_left is None:
+            return None
+        now = now if now is not None else time.monotonic()
+        tokens = self.tokens_left + self._elapsed_refills(now) * self.refill_rate
+        if self.capacity is not None:
+            tokens = min(tokens, max(self.capacity, self.tokens_left))
+        return tokens
+
+    def ms_until_next_refill(self, now: Optional[float] = None) -> float:
+        now = now if now is not None else time.monotonic()
+        elapsed_ms = (now - self.updated_at) * 1000
+        if elapsed_ms < self.refill_in_ms:
+            return self.refill_in_ms - elapsed_ms
+        return KEEPA_REFILL_INTERVAL_MS - ((elapsed_ms - self.refill_in_ms) % KEEPA_REFILL_INTERVAL_MS)
+
+    def seconds_until_available(self, cost: float, now: Optional[float] = None) -> float:
+        """Seconds to wait before `cost` tokens are available (0 if they already are)"""
+        now = now if now is not None else time.monotonic()
+        tokens = self.estimate_tokens(now)
+        if tokens is None:
+            return 0
+        # A call bigger than the whole bucket only needs a full bucket
+        needed = min(cost, self.capacity) if self.capacity is not None else cost
+        if tokens >= needed:
+            return 0
+        if self.refill_rate <= 0:
+            return KEEPA_REFILL_INTERVAL_MS / 1000
+        refills_needed = math.ceil((needed - tokens) / self.refill_rate)
+        return (self.ms_until_next_refill(now) + (refills_needed - 1) * KEEPA_REFILL_INTERVAL_MS) / 1000
+
+    def _consume(self, cost: float):
+        now = time.monotonic()
+        tokens = self.estimate_tokens(now)
+        if tokens is None:
+            return
+        self.refill_in_ms = self.ms_until_next_refill(now)
+        self.tokens_left = tokens - cost
+        self.updated_at = now
+
+    async def acquire(self, cost: float):
+        """Wait (in FIFO order) until `cost` tokens are predicted to be available, then reserve them"""
+        self.waiting += 1
+        try:
+            async with self.lock:
+                while True:
+                    wait_seconds = self.seconds_until_available(cost)
+                    if wait_seconds <= 0:
+                        break
+                    logger.info(f"Keepa: {self.estimate_tokens():.0f} tokens left, need {cost}, waiting {wait_seconds:.1f}s for refill")
+                    await asyncio.sleep(wait_seconds)
+                self._consume(cost)
+        finally:
+            self.waiting -= 1
+
+    def update_from_response(self, data: dict):
+        """Sync the bucket with the token fields of a Keepa response"""
+        if not isinstance(data, dict) or data.get('tokensLeft') is None:
+            return
+        self.tokens_left = float(data['tokensLeft'])
+        self.refill_in_ms = float(data.get('refillIn') or 0)
+        self.refill_rate = float(data.get('refillRate') or self.refill_rate)
+        self.updated_at = time.monotonic()
+        self.synced_at = datetime.now(timezone.utc)
+
+    def status(self) -> dict:
+        tokens = self.estimate_tokens()
+        return {
+            'tokens_left': round(tokens, 1) if tokens is not None else None,
+            'refill_rate_per_minute': self.refill_rate,
+            'refill_in_seconds': round(self.ms_until_next_refill() / 1000, 1) if self.tokens_left is not None else None,
+            'capacity': self.capacity,
+            'queued_requests': self.waiting,
+            'synced_at': self.synced_at.isoformat() if self.synced_at else None
+        }
+
+
+keepa_token_buckets: Dict[str, KeepaTokenBucket] = {}
+
+
+def get_keepa_token_bucket(keepa_key: str) -> KeepaTokenBucket:
+    bucket = keepa_token_buckets.get(keepa_key)
+    if bucket is None:
+        bucket = KeepaTokenBucket()
+        keepa_token_buckets[keepa_key] = bucket
+    return bucket
+
+
+def estimate_keepa_cost(endpoint: str, params: dict) -> int:
+    """Predict the token cost of a Keepa call from its endpoint and parameters"""
+    if endpoint == 'search':
+        return KEEPA_TOKEN_COST_SEARCH
+    if endpoint == 'product':
+        codes = str(params.get('code') or params.get('asin') or '')
+        return max(1, len(codes.split(','))) * KEEPA_TOKEN_COST_PRODUCT
+    return 0
+
+
+async def keepa_request(keepa_key: str, endpoint: str, params: dict) -> tuple:
+    """Call a Keepa endpoint through the API key's token bucket.
+
+    Waits for enough predicted tokens before sending, re-syncs the bucket from
+    the response and retries a 429 after the announced refill.
+
+    Returns:
+        tuple: (status_code, json_data) - json_data is {} when the body is not JSON
+    """
+    bucket = get_keepa_token_bucket(keepa_key)
+    cost = estimate_keepa_cost(endpoint, params)
+
+    for attempt in range(KEEPA_MAX_RETRIES + 1):
+        await bucket.acquire(cost)
+        response = await provider_request(
+            'keepa',
+            'GET',
+            f"https://api.keepa.com/{endpoint}",
+            params={"key": keepa_key, **params}
+        )
+        try:
+            data = response.json()
+        except ValueError:
+            data = {}
+        bucket.update_from_response(data)
+
+        if response.status_code != 429:
+            return response.status_code, data
+
+        if bucket.tokens_left is None or bucket.tokens_left >= 0:
+            # 429 without token info: assume the bucket is empty until the next refill
+            bucket.tokens_left = min(bucket.tokens_left or 0, 0)
+            bucket.refill_in_ms = bucket.refill_in_ms or KEEPA_REFILL_INTERVAL_MS
+            bucket.updated_at = time.monotonic()
+        if attempt < KEEPA_MAX_RETRIES:
+            logger.warning(f"Keepa: rate limited (429) on {endpoint}, retry {attempt + 1}/{KEEPA_MAX_RETRIES} after refill")
+
+    return 429, data
+
+
+# ==================== KEEPA RESPONSE CACHE ====================
+
+# Named Keepa fetch profiles: query parameters, and which larger profiles can serve them from the cache.
+# Each call site requests the smallest profile it needs.
+KEEPA_TREND_HISTORY_DAYS = max(TREND_WINDOWS_DAYS)
+KEEPA_FETCH_PROFILES = {
+    'price-only': {'stats': 1, 'history': 0},  # Current prices / averages (arbitrage, keyword price checks, text search)
+    'trend': {'stats': 1, 'history': 1, 'days': KEEPA_TREND_HISTORY_DAYS},  # + the history needed by the trend analysis
+    'full': {'stats': 1, 'history': 1},  # Whole price history (product drill-down, history store); never cached
+    'refresh': {'stats': 1, 'history': 1},  # + `days` since the stored history was last fetched, set per call
+}
+# 'refresh' entries are cached per history window (see KeepaResponseCache.make_key), so they only serve
+# 'refresh' requests for the same window.
+KEEPA_PROFILE_SUPERSETS = {
+    'price-only': ['trend'],
+    'trend': [],
+    'refresh': ['trend'],
+}
+KEEPA_CACHE_TTL_STATS_SECONDS = int(os.environ.get('KEEPA_CACHE_TTL_STATS_SECONDS', 6 * 3600))
+KEEPA_CACHE_TTLS = {
+    'price-only': KEEPA_CACHE_TTL_STATS_SECONDS,
+    'trend': KEEPA_CACHE_TTL_STATS_SECONDS,
+    'refresh': KEEPA_CACHE_TTL_STATS_SECONDS,
+}
+KEEPA_CACHE_LRU_BYTES = int(os.environ.get('KEEPA_CACHE_LRU_BYTES', 32 * 1024 * 1024))
+# Price indices of stats.current / stats.avg30 read by extract_keepa_price and the arbitrage
+KEEPA_STATS_PRICE_INDICES = [0, 4, 1, 10, 7]
+
+
+def trim_keepa_series(series: Optional[list], since_minutes: float) -> Optional[list]:
+    """Points of an interleaved Keepa csv array [minutes, price_cents, ...] from since_minutes on"""
+    if not series:
+        return series
+    return [value for minutes, price in zip(series[0::2], series[1::2]) if minutes >= since_minutes for value in (minutes, price)]
+
+
+def slim_keepa_product(keepa_product: dict) -> dict:
+    """
+    The fields of a Keepa product that callers read: identifiers, title, the current,
+    30-day average and buy box prices, and the trend price histories (see
+    KEEPA_TREND_CSV_INDICES) over the trend windows only. The whole history is kept
+    in the history store (see store_keepa_price_histories), not in the response cache.
+    """
+    stats = keepa_product.get('stats') or {}
+    stats_size = max(KEEPA_STATS_PRICE_INDICES) + 1
+    since_minutes = keepa_minutes_now() - KEEPA_TREND_HISTORY_DAYS * 1440
+    csv_data = keepa_product.get('csv')
+    return {
+        'asin': keepa_product.get('asin'),
+        'title': keepa_product.get('title'),
+        'eanList': keepa_product.get('eanList'),
+        'upcList': keepa_product.get('upcList'),
+        'stats': {
+            'current': (stats.get('current') or [])[:stats_size],
+            'avg30': (stats.get('avg30') or [])[:stats_size],
+            'buyBoxPrice': stats.get('buyBoxPrice')
+        },
+        'csv': [
+            trim_keepa_series(series, since_minutes) if idx in KEEPA_TREND_CSV_INDICES else None
+            for idx, series in enumerate(csv_data[:max(KEEPA_TREND_CSV_INDICES) + 1])
+        ] if csv_data else csv_data
+    }
+
+
+class KeepaResponseCache:
+    """Two-level cache of Keepa products keyed by (domain, code type, code, fetch profile, `days` window).
+
+    An in-process LRU sits in front of the `keepa_cache` Mongo collection, whose
+    TTL index drops expired entries. The cache is shared by all users: Keepa
+    product data does not depend on the API key that fetched it. A request can be
+    served by an entry of a larger profile (see KEEPA_PROFILE_SUPERSETS) as long as
+    that entry is still fresh for the requested profile's TTL and its history
+    window covers the requested one.
+
+    Entries are slimmed products (see slim_keepa_product); the LRU is capped by the
+    total size of their JSON encoding. 'full' products are not cached: slimming
+    would drop the history they are fetched for.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self.entries: OrderedDict = OrderedDict()  # key -> (expires_at timestamp, cached_at timestamp, product, size in bytes)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(domain_id: int, code_type: str, code: str, profile: str, days: Optional[int] = None) -> str:
+        key = f"{profile}:{domain_id}:{code_type}:{code}"
+        return f"{key}:{days}d" if days else key
+
+    def _remember(self, key: str, expires_at: float, cached_at: float, keepa_product: dict):
+        size = len(json.dumps(keepa_product, separators=(',', ':')))
+        if size > self.max_bytes:
+            return
+        previous = self.entries.pop(key, None)
+        if previous:
+            self.size_bytes -= previous[3]
+        self.entries[key] = (expires_at, cached_at, keepa_product, size)
+        self.size_bytes += size
+        while self.size_bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size_bytes -= evicted[3]
+
+    async def get_many(
+        self, domain_id: int, code_type: str, codes: List[str], profile: str, days: Optional[int] = None, peek: bool = False
+    ) -> Dict[str, dict]:
+        """Return the fresh cached products among `codes` as {code: keepa_product}
+
+        days: history window of the request ('refresh' profile).
+        peek: only look (compare planner): no LRU update and no hit/miss counting.
+        """
+        now = time.time()
+        fresh_after = now - KEEPA_CACHE_TTLS[profile]
+        candidates = [(profile, days)] + [
+            (larger, None) for larger in KEEPA_PROFILE_SUPERSETS[profile]
+            if not days or days <= KEEPA_FETCH_PROFILES[larger].get('days', days)
+        ]
+        found = {}
+        missing_keys = {}
+        for code in codes:
+            for candidate, candidate_days in candidates:
+                key = self.make_key(domain_id, code_type, code, candidate, candidate_days)
+                entry = self.entries.get(key)
+                if entry and entry[0] > now and entry[1] > fresh_after:
+                    if not peek:
+                        self.entries.move_to_end(key)
+                    found[code] = entry[2]
+                    break
+                missing_keys[key] = code
+
+        missing_keys = {key: code for key, code in missing_keys.items() if code not in found}
+        if missing_keys:
+            try:
+                docs = await db.keepa_cache.find(
+                    {'key': {'$in': list(missing_keys)}, 'expires_at': {'$gt': datetime.now(timezone.utc)}},
+                    {'_id': 0, 'key': 1, 'product': 1, 'cached_at': 1, 'expires_at': 1}
+                ).to_list(None)
+                for doc in docs:
+                    expires_at, cached_at = doc['expires_at'], doc['cached_at']
+                    if expires_at.tzinfo is None:
+                        expires_at = expires_at.replace(tzinfo=timezone.utc)
+                    if cached_at.tzinfo is None:
+                        cached_at = cached_at.replace(tzinfo=timezone.utc)
+                    if not peek:
+                        self._remember(doc['key'], expires_at.timestamp(), cached_at.timestamp(), doc['product'])
+                    if cached_at.timestamp() > fresh_after:
+                        found.setdefault(missing_keys[doc['key']], doc['product'])
+            except Exception as e:
+                logger.warning(f"Keepa cache read error: {e}")
+
+        if not peek:
+            self.hits += len(found)
+            self.misses += len(codes) - len(found)
+        return found
+
+    async def set_many(self, domain_id: int, code_type: str, products: Dict[str, dict], profile: str, days: Optional[int] = None):
+        """Store freshly fetched products as {code: keepa_product}, fetched with a `days` window if given"""
+        if not products:
+            return
+        ttl = KEEPA_CACHE_TTLS[profile]
+        now = datetime.now(timezone.utc)
+        expires_at = now + timedelta(seconds=ttl)
+        operations = []
+        for code, keepa_product in products.items():
+            key = self.make_key(domain_id, code_type, code, profile, days)
+            self._remember(key, expires_at.timestamp(), now.timestamp(), keepa_product)
+            operations.append(UpdateOne(
+                {'key': key},
+                {'$set': {
+                    'key': key,
+                    'domain': domain_id,
+                    'code_type': code_type,
+                    'code': code,
+                    'profile': profile,
+                    'days': days,
+                    'product': keepa_product,
+                    'cached_at': now,
+                    'expires_at': expires_at
+                }},
+                upsert=True
+            ))
+        try:
+            await db.keepa_cache.bulk_write(operations, ordered=False)
+        except Exception as e:
+            logger.warning(f"Keepa cache write error: {e}")
+
+
+keepa_cache = KeepaResponseCache(KEEPA_CACHE_LRU_BYTES)
+
+
+async def refetch_keepa_product(keepa_key: str, domain_id: int, keepa_product: dict, profile: str) -> dict:
+    """Fetch a product checked with 'price-only' again with a larger profile (the price-only data if that fails)"""
+    if profile == 'price-only':
+        return keepa_product
+    found, _ = await fetch_keepa_products(keepa_key, domain_id, asins=[keepa_product['asin']], profile=profile)
+    return found.get(keepa_product['asin'], keepa_product)
+
+
+async def search_keepa_product_on_domain(
+    keepa_key: str,
+    domain_info: dict,
+    gtin: Optional[str] = None,
+    search_term: Optional[str] = None,
+    batch_asin_details: bool = False,
+    context: Optional[Dict[int, Optional[dict]]] = None,
+    profile: str = 'trend'
+) -> tuple:
+    """
+    Search for a product on a single Keepa domain: GTIN lookup first, then keyword search.
+    
+    Args:
+        batch_asin_details: fetch the candidate ASINs of the keyword search in one
+            request instead of one after another (used by race mode)
+        context: per-request {domain_id: keepa_product or None} where the GTIN
+            lookup result of this domain is recorded (see analyze_multi_market_arbitrage)
+        profile: fetch profile of the returned product. Keyword candidates are
+            checked with 'price-only' and only the match is fetched with this profile.
+    
+    Returns:
+        tuple: (keepa_product or None, rate_limited, complete) where complete is False
+               when an error or timeout cut the search of this domain short
+    """
+    domain_id = domain_info['domain']
+    domain_name = domain_info['name']
+    complete = True
+    
+    try:
+        # Step 1: Try by GTIN/EAN code if available
+        if gtin:
+            logger.info(f"Keepa: searching GTIN {gtin} on {domain_name} (domain={domain_id})")
+            found, rate_limited = await fetch_keepa_products(keepa_key, domain_id, codes=[gtin], profile=profile, raise_errors=True)
+            if context is not None and not rate_limited:
+                context[domain_id] = found.get(gtin)
+            
+            if gtin in found:
+                keepa_product = found[gtin]
+                logger.info(f"✅ Keepa found ASIN {keepa_product.get('asin', 'N/A')} via GTIN on {domain_name}")
+                return keepa_product, False, True
+            elif rate_limited:
+                logger.warning(f"Keepa: still rate limited (429) on {domain_name} after retries, stopping multi-domain search")
+                return None, True, False
+            else:
+                logger.info(f"Keepa: no product found for GTIN {gtin} on {domain_name}")
+        
+        # Step 2: Try by keyword search if GTIN failed or not provided
+        if search_term:
+            logger.info(f"Keepa: searching term '{search_term}' on {domain_name} (domain={domain_id})")
+            search_status, search_data = await keepa_request(
+                keepa_key,
+                "search",
+                {
+                    "domain": domain_id,
+                    "type": "product",
+                    "term": search_term
+                }
+            )
+            
+            if search_status == 200:
+                asin_list = search_data.get('asinList', [])
+                
+                if asin_list and len(asin_list) > 0:
+                    logger.info(f"Keepa: found {len(asin_list)} ASINs for '{search_term}' on {domain_name}")
+                    
+                    # Try multiple ASINs (up to 5) to find one with a valid price
+                    asins_to_try = asin_list[:KEEPA_SEARCH_CANDIDATES]  # Limit to first 5 to avoid too many API calls
+                    
+                    if batch_asin_details:
+                        # All candidates in one request, then pick the first valid one in search order
+                        details_by_asin, _ = await fetch_keepa_products(keepa_key, domain_id, asins=asins_to_try, profile='price-only', raise_errors=True)
+                        for idx, asin in enumerate(asins_to_try):
+                            keepa_product = details_by_asin.get(asin)
+                            price = extract_keepa_price(keepa_product) if keepa_product else None
+                            if price is not None and price > 0:
+                                logger.info(f"✅ Keepa found ASIN {asin} (result {idx+1}/{len(asin_list)}) with price {price} on {domain_name}")
+                                return await refetch_keepa_product(keepa_key, domain_id, keepa_product, profile), False, True
+                    else:
+                        for idx, asin in enumerate(asins_to_try):
+                            try:
+                                details_by_asin, _ = await fetch_keepa_products(keepa_key, domain_id, asins=[asin], profile='price-only', raise_errors=True)
+                                if asin in details_by_asin:
+                                    keepa_product = details_by_asin[asin]
+                                    # Check if this product has a valid price
+                                    price = extract_keepa_price(keepa_product)
+                                    if price is not None and price > 0:
+                                        logger.info(f"✅ Keepa found ASIN {keepa_product.get('asin', 'N/A')} (result {idx+1}/{len(asin_list)}) with price {price} on {domain_name}")
+                                        return await refetch_keepa_product(keepa_key, domain_id, keepa_product, profile), False, True
+                                    else:
+                                        logger.info(f"Keepa: ASIN {asin} (result {idx+1}) has no valid price, trying next...")
+                            except Exception as e:
+                                logger.warning(f"Keepa: error getting details for ASIN {asin}: {e}")
+                                complete = False
+                                continue
+                    
+                    # If we tried all ASINs but none had a valid price
+                    logger.info(f"Keepa: checked {len(asins_to_try)} ASINs on {domain_name} but none had valid prices")
+                else:
+                    logger.info(f"Keepa: no results for name search on {domain_name}")
+            elif search_status == 429:
+                logger.warning(f"Keepa: still rate limited (429) on {domain_name} name search after retries, stopping")
+                return None, True, False
+            else:
+                logger.warning(f"Keepa: HTTP {search_status} for name search on {domain_name}")
+                complete = False
+    
+    except httpx.TimeoutException:
+        logger.warning(f"Keepa: timeout on {domain_name}, trying next domain...")
+        complete = False
+    except Exception as e:
+        logger.warning(f"Keepa: error on {domain_name}: {e}")
+        complete = False
+    
+    return None, False, complete
+
+
+async def race_keepa_domains(
+    keepa_key: str,
+    domains_to_try: List[dict],
+    gtin: Optional[str] = None,
+    search_term: Optional[str] = None,
+    context: Optional[Dict[int, Optional[dict]]] = None,
+    profile: str = 'trend'
+) -> tuple:
+    """
+    Query all candidate domains concurrently and keep the highest-priority hit.
+    
+    Results are awaited in priority order: as soon as a domain answers with a
+    product and every higher-priority domain has missed, the requests still
+    running on lower-priority domains are cancelled.
+    
+    Returns:
+        tuple: (keepa_product, found_domain_info, complete) where complete tells
+               whether every domain was fully searched when nothing was found
+    """
+    tasks = [
+        asyncio.create_task(search_keepa_product_on_domain(
+            keepa_key, domain_info, gtin=gtin, search_term=search_term, batch_asin_details=True, context=context, profile=profile
+        ))
+        for domain_info in domains_to_try
+    ]
+    complete = True
+    try:
+        for domain_info, task in zip(domains_to_try, tasks):
+            keepa_product, _, domain_complete = await task
+            if keepa_product:
+                return keepa_product, domain_info, True
+            complete = complete and domain_complete
+    finally:
+        pending = [task for task in tasks if not task.done()]
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+    
+    logger.info(f"Keepa: product not found on any domain (GTIN={gtin}, term={search_term}, race mode)")
+    return None, None, complete
+
 
 async def search_keepa_product_multi_domain(
-    http_client: httpx.AsyncClient,
     keepa_key: str,
     gtin: Optional[str] = None,
     search_term: Optional[str] = None,
-    primary_domain: int = 4
+    primary_domain: int = 4,
+    race: bool = False,
+    context: Optional[Dict[int, Optional[dict]]] = None,
+    gtin_lookup: bool = True,
+    profile: str = 'trend'
 ) -> tuple:
     """
     Search for a product on Keepa across multiple Amazon domains.
-    Tries the primary domain first (default: Amazon.fr), then falls back to other European domains.
+    A GTIN already in the GTIN → ASIN index is fetched directly by ASIN, and a
+    (GTIN, search term) recently not found anywhere is skipped (see record_keepa_miss).
+    Otherwise tries the primary domain first (default: Amazon.fr), then falls back to other European domains.
     
     Args:
-        http_client: httpx AsyncClient
         keepa_key: Keepa API key
         gtin: Product EAN/GTIN code (optional)
         search_term: Product name/keywords for text search (optional)
         primary_domain: Primary domain to try first (default: 4 = Amazon.fr)
+        race: query all domains concurrently instead of one after another
+              (lower latency for interactive compares, more tokens spent)
+        context: optional per-request {domain_id: keepa_product or None} filled with
+              the GTIN results seen on each domain and the found product
+        gtin_lookup: look the GTIN up on each domain; when False the GTIN is only
+              used for the resolution index (already tried by the batch cascade)
+        profile: fetch profile of the returned product (see KEEPA_FETCH_PROFILES)
     
     Returns:
         tuple: (keepa_product, found_domain_info) or (None, None) if not found
     """
     
+    if gtin:
+        index_entries = await lookup_gtin_asin_index([gtin])
+        indexed, rate_limited = await fetch_indexed_keepa_products(keepa_key, index_entries, profile=profile)
+        if gtin in indexed:
+            keepa_product, found_domain_info = indexed[gtin]
+            logger.info(f"✅ Keepa: GTIN {gtin} resolved from the index to ASIN {keepa_product.get('asin')} on {found_domain_info['name']}")
+            if context is not None:
+                # No domain was queried by GTIN: the other domains stay unknown
+                context[found_domain_info['domain']] = keepa_product
+            return keepa_product, found_domain_info
+        if rate_limited:
+            logger.warning(f"Keepa: rate limited fetching indexed ASIN for GTIN {gtin}, stopping multi-domain search")
+            return None, None
+        if await is_keepa_known_absent(gtin, search_term):
+            logger.info(f"Keepa: GTIN {gtin} known to be absent from Amazon, skipping search")
+            return None, None
+    
+    domain_gtin = gtin if gtin_lookup else None
+    
     # Build ordered domain list: primary domain first, then others
     domains_to_try = []
     for d in KEEPA_EUROPEAN_DOMAINS:
@@ -683,109 +1549,37 @@ async def search_keepa_product_multi_domain(
         else:
             domains_to_try.append(d)
     
+    if race:
+        keepa_product, found_domain_info, complete = await race_keepa_domains(
+            keepa_key, domains_to_try, gtin=domain_gtin, search_term=search_term, context=context, profile=profile
+        )
+        if keepa_product:
+            if context is not None:
+                context[found_domain_info['domain']] = keepa_product
+            if gtin:
+                await record_gtin_asin_resolutions({gtin: (keepa_product, found_domain_info)})
+        elif gtin and complete:
+            await record_keepa_miss(gtin, search_term)
+        return keepa_product, found_domain_info
+    
+    complete = True
     for domain_info in domains_to_try:
-        domain_id = domain_info['domain']
-        domain_name = domain_info['name']
-        
-        try:
-            # Step 1: Try by GTIN/EAN code if available
+        keepa_product, rate_limited, domain_complete = await search_keepa_product_on_domain(
+            keepa_key, domain_info, gtin=domain_gtin, search_term=search_term, context=context, profile=profile
+        )
+        if keepa_product:
+            if context is not None:
+                context[domain_info['domain']] = keepa_product
             if gtin:
-                logger.info(f"Keepa: searching GTIN {gtin} on {domain_name} (domain={domain_id})")
-                response = await http_client.get(
-                    "https://api.keepa.com/product",
-                    params={
-                        "key": keepa_key,
-                        "domain": domain_id,
-                        "code": gtin,
-                        "stats": 1,
-                    },
-                    timeout=30
-                )
-                
-                if response.status_code == 200:
-                    data = response.json()
-                    products_found = data.get('products', [])
-                    if products_found and len(products_found) > 0:
-                        keepa_product = products_found[0]
-                        logger.info(f"✅ Keepa found ASIN {keepa_product.get('asin', 'N/A')} via GTIN on {domain_name}")
-                        return keepa_product, domain_info
-                    else:
-                        logger.info(f"Keepa: no product found for GTIN {gtin} on {domain_name}")
-                elif response.status_code == 429:
-                    logger.warning(f"Keepa: rate limited (429) on {domain_name}, stopping multi-domain search")
-                    break
-                else:
-                    logger.warning(f"Keepa: HTTP {response.status_code} for GTIN search on {domain_name}")
-            
-            # Step 2: Try by keyword search if GTIN failed or not provided
-            if search_term:
-                logger.info(f"Keepa: searching term '{search_term}' on {domain_name} (domain={domain_id})")
-                search_response = await http_client.get(
-                    "https://api.keepa.com/search",
-                    params={
-                        "key": keepa_key,
-                        "domain": domain_id,
-                        "type": "product",
-                        "term": search_term
-                    },
-                    timeout=30
-                )
-                
-                if search_response.status_code == 200:
-                    search_data = search_response.json()
-                    asin_list = search_data.get('asinList', [])
-                    
-                    if asin_list and len(asin_list) > 0:
-                        logger.info(f"Keepa: found {len(asin_list)} ASINs for '{search_term}' on {domain_name}")
-                        
-                        # Try multiple ASINs (up to 5) to find one with a valid price
-                        asins_to_try = asin_list[:5]  # Limit to first 5 to avoid too many API calls
-                        
-                        for idx, asin in enumerate(asins_to_try):
-                            try:
-                                detail_response = await http_client.get(
-                                    "https://api.keepa.com/product",
-                                    params={
-                                        "key": keepa_key,
-                                        "domain": domain_id,
-                                        "asin": asin,
-                                        "stats": 1,
-                                    },
-                                    timeout=30
-                                )
-                                if detail_response.status_code == 200:
-                                    detail_data = detail_response.json()
-                                    if detail_data.get('products') and len(detail_data['products']) > 0:
-                                        keepa_product = detail_data['products'][0]
-                                        # Check if this product has a valid price
-                                        price = extract_keepa_price(keepa_product)
-                                        if price is not None and price > 0:
-                                            logger.info(f"✅ Keepa found ASIN {keepa_product.get('asin', 'N/A')} (result {idx+1}/{len(asin_list)}) with price {price} on {domain_name}")
-                                            return keepa_product, domain_info
-                                        else:
-                                            logger.info(f"Keepa: ASIN {asin} (result {idx+1}) has no valid price, trying next...")
-                            except Exception as e:
-                                logger.warning(f"Keepa: error getting details for ASIN {asin}: {e}")
-                                continue
-                        
-                        # If we tried all ASINs but none had a valid price
-                        logger.info(f"Keepa: checked {len(asins_to_try)} ASINs on {domain_name} but none had valid prices")
-                    else:
-                        logger.info(f"Keepa: no results for name search on {domain_name}")
-                elif search_response.status_code == 429:
-                    logger.warning(f"Keepa: rate limited (429) on {domain_name} name search, stopping")
-                    break
-                else:
-                    logger.warning(f"Keepa: HTTP {search_response.status_code} for name search on {domain_name}")
-        
-        except httpx.TimeoutException:
-            logger.warning(f"Keepa: timeout on {domain_name}, trying next domain...")
-            continue
-        except Exception as e:
-            logger.warning(f"Keepa: error on {domain_name}: {e}")
-            continue
+                await record_gtin_asin_resolutions({gtin: (keepa_product, domain_info)})
+            return keepa_product, domain_info
+        complete = complete and domain_complete
+        if rate_limited:
+            break
     
     logger.info(f"Keepa: product not found on any domain (GTIN={gtin}, term={search_term})")
+    if gtin and complete:
+        await record_keepa_miss(gtin, search_term)
     return None, None
 
 
@@ -832,12 +1626,633 @@ def extract_keepa_price(keepa_product: dict) -> Optional[float]:
     return None
 
 
-async def analyze_multi_market_arbitrage(gtin: str, supplier_price_eur: float, keepa_api_key: Optional[str]) -> dict:
+# ==================== KEEPA PRICE HISTORY STORE ====================
+
+# csv types kept in `keepa_price_histories` (the series used by the trend analysis)
+KEEPA_HISTORY_CSV_TYPES = KEEPA_TREND_CSV_INDICES
+KEEPA_HISTORY_DTYPE = np.dtype('<i4')
+
+
+def pack_keepa_series(minutes: np.ndarray, prices: np.ndarray) -> tuple:
+    """Pack a decoded series as little-endian int32 bytes (Keepa minutes, price in cents)"""
+    timestamps = np.asarray(minutes, dtype=KEEPA_HISTORY_DTYPE).tobytes()
+    cents = np.rint(np.asarray(prices) * 100).astype(KEEPA_HISTORY_DTYPE).tobytes()
+    return timestamps, cents
+
+
+def unpack_keepa_series(timestamps: bytes, cents: bytes) -> tuple:
+    """Inverse of pack_keepa_series: (keepa_minutes int32 array, prices float64 array)"""
+    minutes = np.frombuffer(timestamps, dtype=KEEPA_HISTORY_DTYPE).astype(np.int32)
+    prices = np.frombuffer(cents, dtype=KEEPA_HISTORY_DTYPE) / 100.0
+    return minutes, prices
+
+
+async def store_keepa_price_histories(domain_id: int, keepa_products, windowed: bool = False) -> int:
     """
-    Analyze arbitrage opportunities across multiple Amazon marketplaces.
+    Persist the price histories of freshly fetched Keepa products in `keepa_price_histories`.
+    
+    One document per (asin, domain, csv_type) holds the whole series as two packed
+    int32 arrays, with a version counter bumped on every write.
+    
+    windowed: the products only carry the recent part of their history (fetched with
+    `days`); stored points older than the fetched window are kept in front of it.
+    
+    Returns:
+        int: number of histories written
+    """
+    series = []
+    for keepa_product in keepa_products:
+        asin = keepa_product.get('asin')
+        csv_data = keepa_product.get('csv') or []
+        if not asin:
+            continue
+        for csv_type in KEEPA_HISTORY_CSV_TYPES:
+            if len(csv_data) <= csv_type or not csv_data[csv_type]:
+                continue
+            minutes, prices = decode_keepa_csv(csv_data[csv_type])
+            if len(prices) > 0:
+                series.append((asin, csv_type, minutes, prices))
+    
+    if not series:
+        return 0
+    
+    stored = {}
+    if windowed:
+        try:
+            docs = await db.keepa_price_histories.find(
+                {'domain': domain_id, 'asin': {'$in': list({asin for asin, _, _, _ in series})}},
+                {'_id': 0, 'asin': 1, 'csv_type': 1, 'timestamps': 1, 'prices': 1}
+            ).to_list(None)
+            stored = {(doc['asin'], doc['csv_type']): doc for doc in docs}
+        except Exception as e:
+            logger.warning(f"Keepa history store read error: {e}")
+    
+    now = datetime.now(timezone.utc)
+    operations = []
+    for asin, csv_type, minutes, prices in series:
+        doc = stored.get((asin, csv_type))
+        if doc:
+            stored_minutes, stored_prices = unpack_keepa_series(doc['timestamps'], doc['prices'])
+            older = stored_minutes < minutes[0]
+            minutes = np.concatenate([stored_minutes[older], minutes])
+            prices = np.concatenate([stored_prices[older], prices])
+        timestamps, cents = pack_keepa_series(minutes, prices)
+        operations.append(UpdateOne(
+            {'asin': asin, 'domain': domain_id, 'csv_type': csv_type},
+            {
+                '$set': {
+                    'timestamps': timestamps,
+                    'prices': cents,
+                    'points': len(prices),
+                    'first_ts': int(minutes[0]),
+                    'last_ts': int(minutes[-1]),
+                    'updated_at': now
+                },
+                '$inc': {'version': 1}
+            },
+            upsert=True
+        ))
+    
+    if not operations:
+        return 0
+    try:
+        await db.keepa_price_histories.bulk_write(operations, ordered=False)
+    except Exception as e:
+        logger.warning(f"Keepa history store write error: {e}")
+        return 0
+    return len(operations)
+
+
+async def load_keepa_price_history(asin: str, domain_id: int, csv_type: Optional[int] = None) -> Optional[dict]:
+    """
+    Load a stored price history.
+    
+    Without csv_type, the first available series in trend priority order (Amazon, New FBA, New 3rd party) is returned.
+    
+    Returns:
+        dict: {'asin', 'domain', 'csv_type', 'version', 'points', 'updated_at', 'minutes', 'prices'}
+              with numpy arrays as in decode_keepa_csv, or None
+    """
+    csv_types = [csv_type] if csv_type is not None else KEEPA_HISTORY_CSV_TYPES
+    docs = await db.keepa_price_histories.find(
+        {'asin': asin, 'domain': domain_id, 'csv_type': {'$in': csv_types}},
+        {'_id': 0}
+    ).to_list(len(csv_types))
+    by_type = {doc['csv_type']: doc for doc in docs}
+    
+    for candidate in csv_types:
+        doc = by_type.get(candidate)
+        if not doc:
+            continue
+        minutes, prices = unpack_keepa_series(doc['timestamps'], doc['prices'])
+        return {
+            'asin': asin,
+            'domain': domain_id,
+            'csv_type': candidate,
+            'version': doc.get('version', 1),
+            'points': doc.get('points', len(prices)),
+            'updated_at': doc.get('updated_at'),
+            'minutes': minutes,
+            'prices': prices
+        }
+    return None
+
+
+async def get_keepa_history_refresh_days(products: List[tuple]) -> Dict[tuple, int]:
+    """
+    Size of the incremental history fetch of products whose history is already stored.
+    
+    products: [(asin, domain_id), ...]
+    
+    Returns:
+        dict: {(asin, domain_id): days} covering the time since the stored history was
+              last written (plus one day of overlap). Products without a stored history, or
+              last refreshed longer ago than the trend window, are left out.
+    """
+    if not products:
+        return {}
+    try:
+        docs = await db.keepa_price_histories.find(
+            {'asin': {'$in': list({asin for asin, _ in products})}, 'csv_type': {'$in': KEEPA_HISTORY_CSV_TYPES}},
+            {'_id': 0, 'asin': 1, 'domain': 1, 'updated_at': 1}
+        ).to_list(None)
+    except Exception as e:
+        logger.warning(f"Keepa history store read error: {e}")
+        return {}
+    
+    wanted = set(products)
+    last_written = {}
+    for doc in docs:
+        key = (doc['asin'], doc['domain'])
+        if key not in wanted:
+            continue
+        updated_at = doc['updated_at']
+        if updated_at.tzinfo is None:
+            updated_at = updated_at.replace(tzinfo=timezone.utc)
+        last_written[key] = max(last_written.get(key, updated_at), updated_at)
+    
+    now = datetime.now(timezone.utc)
+    refresh_days = {}
+    for key, updated_at in last_written.items():
+        days = math.ceil((now - updated_at).total_seconds() / 86400) + 1
+        if days < KEEPA_TREND_HISTORY_DAYS:
+            refresh_days[key] = days
+    return refresh_days
+
+
+# ==================== GTIN → ASIN RESOLUTION INDEX ====================
+
+# Confidence of an index entry: the Keepa product lists the GTIN, or it was picked by a keyword search
+GTIN_MATCH_CONFIDENCE = 1.0
+KEYWORD_MATCH_CONFIDENCE = 0.5
+
+
+def get_keepa_domain_info(domain_id: int) -> Optional[dict]:
+    """KEEPA_EUROPEAN_DOMAINS entry of a Keepa domain id"""
+    return next((d for d in KEEPA_EUROPEAN_DOMAINS if d['domain'] == domain_id), None)
+
+
+async def lookup_gtin_asin_index(gtins: List[str]) -> Dict[str, dict]:
+    """Return the known resolutions among `gtins` as {gtin: {'asin', 'domain', 'method', 'confidence', 'resolved_at'}}"""
+    gtins = [g for g in dict.fromkeys(gtins) if g]
+    if not gtins:
+        return {}
+    try:
+        docs = await db.gtin_asin_index.find({'gtin': {'$in': gtins}}, {'_id': 0}).to_list(None)
+    except Exception as e:
+        logger.warning(f"GTIN index read error: {e}")
+        return {}
+    return {doc['gtin']: doc for doc in docs}
+
+
+def keepa_product_lists_code(keepa_product: dict, code: str) -> bool:
+    """Whether a Keepa product carries the code in its EAN/UPC lists (leading zeros ignored)"""
+    product_codes = (keepa_product.get('eanList') or []) + (keepa_product.get('upcList') or [])
+    return code.lstrip('0') in {str(c).lstrip('0') for c in product_codes}
+
+
+async def record_gtin_asin_resolutions(resolutions: Dict[str, tuple], method: Optional[str] = None):
+    """
+    Upsert resolved GTINs in the `gtin_asin_index` collection, shared by all users.
+    
+    resolutions: {gtin: (keepa_product, domain_info)}. Without an explicit method, it is
+    'gtin' when the Keepa product lists the GTIN in its EAN/UPC codes, 'keyword' otherwise.
+    """
+    now = datetime.now(timezone.utc)
+    operations = []
+    for gtin, (keepa_product, domain_info) in resolutions.items():
+        if not gtin or not keepa_product or not keepa_product.get('asin') or not domain_info:
+            continue
+        listed = method == 'gtin' if method else keepa_product_lists_code(keepa_product, gtin)
+        operations.append(UpdateOne(
+            {'gtin': gtin},
+            {'$set': {
+                'gtin': gtin,
+                'asin': keepa_product['asin'],
+                'domain': domain_info['domain'],
+                'method': 'gtin' if listed else 'keyword',
+                'confidence': GTIN_MATCH_CONFIDENCE if listed else KEYWORD_MATCH_CONFIDENCE,
+                'resolved_at': now
+            }},
+            upsert=True
+        ))
+    if not operations:
+        return
+    try:
+        await db.gtin_asin_index.bulk_write(operations, ordered=False)
+        await db.keepa_negative_cache.delete_many({'gtin': {'$in': list(resolutions)}})
+    except Exception as e:
+        logger.warning(f"GTIN index write error: {e}")
+
+
+async def fetch_indexed_keepa_products(keepa_key: str, entries: Dict[str, dict], profile: str = 'trend') -> tuple:
+    """
+    Fetch the Keepa products of index entries directly by ASIN, one request per domain.
+    
+    For the 'trend' profile, products whose price history is already stored only
+    fetch the points since the last refresh ('refresh' profile) and the stored
+    history is extended with them.
+    Keyword resolutions are only kept while the product still has a valid price.
+    
+    Returns:
+        tuple: ({gtin: (keepa_product, domain_info)}, rate_limited)
+    """
+    refresh_days = {}
+    if profile == 'trend':
+        refresh_days = await get_keepa_history_refresh_days(
+            [(entry['asin'], entry['domain']) for entry in entries.values()]
+        )
+    
+    # One request per (domain, profile); incremental refreshes share the largest window of their domain
+    groups: Dict[tuple, List[str]] = {}
+    for gtin, entry in entries.items():
+        refreshable = (entry['asin'], entry['domain']) in refresh_days
+        groups.setdefault((entry['domain'], 'refresh' if refreshable else profile), []).append(gtin)
+    
+    resolved = {}
+    rate_limited = False
+    for (domain_id, group_profile), gtins in groups.items():
+        domain_info = get_keepa_domain_info(domain_id)
+        if not domain_info:
+            continue
+        days = None
+        if group_profile == 'refresh':
+            days = max(refresh_days[(entries[g]['asin'], domain_id)] for g in gtins)
+        found, domain_rate_limited = await fetch_keepa_products(
+            keepa_key, domain_id, asins=[entries[g]['asin'] for g in gtins], profile=group_profile, days=days
+        )
+        rate_limited = rate_limited or domain_rate_limited
+        for gtin in gtins:
+            keepa_product = found.get(entries[gtin]['asin'])
+            if not keepa_product:
+                continue
+            if entries[gtin].get('method') == 'keyword' and not extract_keepa_price(keepa_product):
+                continue
+            resolved[gtin] = (keepa_product, domain_info)
+    return resolved, rate_limited
+
+
+# ==================== KEEPA NEGATIVE CACHE ====================
+
+# Back-off before a (GTIN, search term) that was not found on any domain is searched again:
+# base delay, doubled after each further miss, capped
+KEEPA_NEGATIVE_CACHE_BASE_SECONDS = int(os.environ.get('KEEPA_NEGATIVE_CACHE_BASE_SECONDS', 24 * 3600))
+KEEPA_NEGATIVE_CACHE_MAX_SECONDS = int(os.environ.get('KEEPA_NEGATIVE_CACHE_MAX_SECONDS', 30 * 24 * 3600))
+
+
+def make_keepa_negative_key(gtin: str, search_term: Optional[str]) -> str:
+    return f"{gtin}:{(search_term or '').strip().lower()}"
+
+
+async def lookup_keepa_negative_cache(gtins: List[str]) -> Dict[str, dict]:
+    """Return the GTINs among `gtins` currently known to be absent from Amazon (any search term), as {gtin: entry}"""
+    gtins = [g for g in dict.fromkeys(gtins) if g]
+    if not gtins:
+        return {}
+    try:
+        docs = await db.keepa_negative_cache.find(
+            {'gtin': {'$in': gtins}, 'retry_after': {'$gt': datetime.now(timezone.utc)}},
+            {'_id': 0}
+        ).to_list(None)
+    except Exception as e:
+        logger.warning(f"Keepa negative cache read error: {e}")
+        return {}
+    return {doc['gtin']: doc for doc in docs}
+
+
+async def is_keepa_known_absent(gtin: str, search_term: Optional[str]) -> bool:
+    """Whether a (GTIN, search term) missed on every domain recently enough to be skipped"""
+    try:
+        doc = await db.keepa_negative_cache.find_one(
+            {'key': make_keepa_negative_key(gtin, search_term), 'retry_after': {'$gt': datetime.now(timezone.utc)}},
+            {'_id': 0, 'key': 1}
+        )
+    except Exception as e:
+        logger.warning(f"Keepa negative cache read error: {e}")
+        return False
+    return doc is not None
+
+
+async def record_keepa_miss(gtin: str, search_term: Optional[str]):
+    """
+    Record a clean miss on every domain (no rate limit, no error) for a (GTIN, search term).
+    
+    The retry delay doubles with each consecutive miss, from KEEPA_NEGATIVE_CACHE_BASE_SECONDS
+    up to KEEPA_NEGATIVE_CACHE_MAX_SECONDS. Entries are purged by a TTL index once the
+    maximum delay has passed after their retry time, which resets the back-off.
+    """
+    key = make_keepa_negative_key(gtin, search_term)
+    now = datetime.now(timezone.utc)
+    try:
+        existing = await db.keepa_negative_cache.find_one({'key': key}, {'_id': 0, 'misses': 1})
+        misses = (existing or {}).get('misses', 0) + 1
+        delay = min(KEEPA_NEGATIVE_CACHE_BASE_SECONDS * 2 ** (misses - 1), KEEPA_NEGATIVE_CACHE_MAX_SECONDS)
+        retry_after = now + timedelta(seconds=delay)
+        await db.keepa_negative_cache.update_one(
+            {'key': key},
+            {
+                '$set': {
+                    'key': key,
+                    'gtin': gtin,
+                    'search_term': search_term,
+                    'misses': misses,
+                    'last_miss_at': now,
+                    'retry_after': retry_after,
+                    'expires_at': retry_after + timedelta(seconds=KEEPA_NEGATIVE_CACHE_MAX_SECONDS)
+                },
+                '$setOnInsert': {'first_miss_at': now}
+            },
+            upsert=True
+        )
+        logger.info(f"Keepa: GTIN {gtin} recorded as absent (miss #{misses}), next search after {retry_after.isoformat()}")
+    except Exception as e:
+        logger.warning(f"Keepa negative cache write error: {e}")
+
+
+# ==================== KEEPA BATCH LOOKUPS ====================
+
+# Keepa /product accepts up to 100 comma-separated codes (or ASINs) per call
+KEEPA_MAX_CODES_PER_REQUEST = 100
+
+
+def match_keepa_products_to_codes(products: List[dict], codes: List[str]) -> Dict[str, dict]:
+    """Map Keepa products back to the requested codes using their EAN/UPC lists.
+
+    Leading zeros are ignored so that UPC-A / EAN-13 / GTIN-14 forms of the same code match.
+    The first product returned for a code wins, like single-code lookups.
+    """
+    lookup = {code.lstrip('0'): code for code in codes}
+    matched = {}
+    for product in products:
+        product_codes = (product.get('eanList') or []) + (product.get('upcList') or [])
+        for product_code in product_codes:
+            requested = lookup.get(str(product_code).lstrip('0'))
+            if requested and requested not in matched:
+                matched[requested] = product
+    # A single-code request needs no matching: Keepa only returned products for that code
+    if len(codes) == 1 and products and codes[0] not in matched:
+        matched[codes[0]] = products[0]
+    return matched
+
+
+class KeepaHTTPError(RuntimeError):
+    """Keepa answered a product request with an HTTP error (other than the 429 rate limit)"""
+
+    def __init__(self, status_code: int, message: str):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+async def fetch_keepa_products(
+    keepa_key: str,
+    domain_id: int,
+    codes: Optional[List[str]] = None,
+    asins: Optional[List[str]] = None,
+    profile: str = 'price-only',
+    days: Optional[int] = None,
+    raise_errors: bool = False,
+    not_looked_up: Optional[set] = None
+) -> tuple:
+    """Fetch Keepa products for GTIN/EAN codes or ASINs on one domain, through the response cache.
+
+    Cache misses are requested 100 codes (or ASINs) per call, with the query
+    parameters of the fetch profile (see KEEPA_FETCH_PROFILES). 'full' products
+    bypass the cache and are returned whole. `days` limits the
+    returned history to the last days (used by the 'refresh' profile).
+    With raise_errors, a failed request raises instead of being logged and skipped,
+    so that callers can tell "not on Keepa" from "not looked up". Without it, the
+    codes of failed requests (error, timeout, HTTP error, rate limit) are added to
+    `not_looked_up` when given.
+
+    Returns:
+        tuple: ({code_or_asin: keepa_product} for the known ones, slimmed as cached
+               (see slim_keepa_product) except for 'full', rate_limited)
+    """
+    code_type = 'asin' if asins is not None else 'code'
+    requested = list(dict.fromkeys(c for c in (asins if asins is not None else codes or []) if c))
+    cached = profile in KEEPA_CACHE_TTLS
+    found = await keepa_cache.get_many(domain_id, code_type, requested, profile, days) if cached else {}
+    missing = [c for c in requested if c not in found]
+    rate_limited = False
+    params = dict(KEEPA_FETCH_PROFILES[profile])
+    if days:
+        params['days'] = days
+
+    for start in range(0, len(missing), KEEPA_MAX_CODES_PER_REQUEST):
+        chunk = missing[start:start + KEEPA_MAX_CODES_PER_REQUEST]
+        try:
+            status_code, data = await keepa_request(
+                keepa_key,
+                "product",
+                {
+                    "domain": domain_id,
+                    code_type: ','.join(chunk),
+                    **params,
+                }
+            )
+        except Exception as e:
+            if raise_errors:
+                raise
+            logger.warning(f"Keepa: error fetching {len(chunk)} {code_type}s on domain {domain_id}: {e}")
+            if not_looked_up is not None:
+                not_looked_up.update(chunk)
+            continue
+
+        if status_code == 200:
+            products = data.get('products', []) or []
+            if code_type == 'asin':
+                matched = {p['asin']: p for p in products if p.get('asin') in chunk}
+            else:
+                matched = match_keepa_products_to_codes(products, chunk)
+            await store_keepa_price_histories(domain_id, matched.values(), windowed='days' in params)
+            if cached:
+                matched = {code: slim_keepa_product(keepa_product) for code, keepa_product in matched.items()}
+                await keepa_cache.set_many(domain_id, code_type, matched, profile, days)
+                if code_type == 'code':
+                    await keepa_cache.set_many(domain_id, 'asin', {p['asin']: p for p in matched.values() if p.get('asin')}, profile, days)
+            found.update(matched)
+        elif status_code == 429:
+            logger.warning(f"Keepa: still rate limited (429) on domain {domain_id} after retries, stopping")
+            rate_limited = True
+            if not_looked_up is not None:
+                not_looked_up.update(missing[start:])
+            break
+        else:
+            if raise_errors:
+                raise KeepaHTTPError(status_code, f"Keepa HTTP {status_code} for {len(chunk)} {code_type}s on domain {domain_id}")
+            logger.warning(f"Keepa: HTTP {status_code} for {len(chunk)} {code_type}s on domain {domain_id}")
+            if not_looked_up is not None:
+                not_looked_up.update(chunk)
+
+    return found, rate_limited
+
+
+async def resolve_keepa_products_batch(keepa_key: str, gtins: List[str]) -> tuple:
+    """Resolve a whole list of GTINs through the Keepa domain cascade.
+
+    GTINs already in the GTIN → ASIN index are fetched by ASIN and GTINs in the
+    negative cache are skipped. All other codes are sent to Amazon.fr first, then only the misses go to the next domain in
+    KEEPA_EUROPEAN_DOMAINS order (.de, .it, .es, .co.uk, .com).
+    A GTIN whose request failed on a domain (error, timeout, rate limit) leaves the
+    cascade: it was not looked up there, so it is not a miss on every domain.
+
+    The per-GTIN Keepa contexts ({domain_id: keepa_product or None}, see
+    analyze_multi_market_arbitrage) only hold the domains whose result is known:
+    the domains the cascade queried, the domain of a GTIN index hit, and every
+    domain for a GTIN in the negative cache (not found anywhere when last queried).
+
+    Returns:
+        tuple: ({gtin: (keepa_product, domain_info)} for every GTIN found on some domain,
+                set of the GTINs the cascade could not look up, {gtin: keepa context})
+    """
+    remaining = list(dict.fromkeys(g for g in gtins if g))
+
+    # Known GTINs go straight to a product fetch by ASIN
+    index_entries = await lookup_gtin_asin_index(remaining)
+    resolved, _ = await fetch_indexed_keepa_products(keepa_key, index_entries, profile='trend')
+    if index_entries:
+        logger.info(f"Keepa batch: {len(resolved)}/{len(remaining)} GTINs resolved from the GTIN index")
+    remaining = [code for code in remaining if code not in resolved]
+    contexts = {
+        code: {domain_info['domain']: keepa_product}
+        for code, (keepa_product, domain_info) in resolved.items()
+    }
+
+    # GTINs recently not found anywhere cost no call until their retry time
+    known_absent = await lookup_keepa_negative_cache(remaining)
+    if known_absent:
+        logger.info(f"Keepa batch: skipping {len(known_absent)} GTINs known to be absent from Amazon")
+        remaining = [code for code in remaining if code not in known_absent]
+        for code in known_absent:
+            contexts[code] = {domain_info['domain']: None for domain_info in KEEPA_EUROPEAN_DOMAINS}
+
+    cascade_resolved = {}
+    not_looked_up = set()
+    for domain_info in KEEPA_EUROPEAN_DOMAINS:
+        if not remaining:
+            break
+        domain_not_looked_up = set()
+        found, _ = await fetch_keepa_products(
+            keepa_key, domain_info['domain'], codes=remaining, profile='trend', not_looked_up=domain_not_looked_up
+        )
+        for code, keepa_product in found.items():
+            cascade_resolved[code] = (keepa_product, domain_info)
+        for code in remaining:
+            if code not in domain_not_looked_up:
+                contexts.setdefault(code, {})[domain_info['domain']] = found.get(code)
+        logger.info(f"Keepa batch: {len(found)}/{len(remaining)} GTINs found on {domain_info['name']}")
+        if domain_not_looked_up:
+            logger.warning(f"Keepa batch: {len(domain_not_looked_up)} GTINs not looked up on {domain_info['name']}, left to the per-product search")
+        not_looked_up.update(domain_not_looked_up)
+        remaining = [code for code in remaining if code not in found and code not in domain_not_looked_up]
+
+    await record_gtin_asin_resolutions(cascade_resolved, method='gtin')
+    resolved.update(cascade_resolved)
+    return resolved, not_looked_up, contexts
+
+
+async def prefetch_keepa_products(user: dict, products: List[dict]) -> tuple:
+    """Batch-resolve the Keepa products of catalog products before comparing them.
+
+    Returns:
+        tuple: (resolved products as returned by resolve_keepa_products_batch, or None when
+                nothing was prefetched (no Keepa key, error), set of the GTINs not looked up,
+                {gtin: keepa context})
+    """
+    keepa_key = user.get('api_keys', {}).get('keepa_api_key')
+    if not keepa_key:
+        return None, set(), {}
+    gtins = [p.get('gtin') for p in products if p.get('gtin')]
+    try:
+        return await resolve_keepa_products_batch(keepa_key, gtins)
+    except Exception as e:
+        logger.warning(f"Keepa batch prefetch error: {e}")
+        return None, set(), {}
+
+
+def build_arbitrage_market_entry(market_info: dict, product: Optional[dict], supplier_price_eur: float, fee_rate: float) -> Optional[dict]:
+    """Price, fees and margin of one market from its Keepa product (None if the product is unknown there)"""
+    if not product:
+        return None
+    
+    # Try to get current price
+    price_local = None
+    
+    # Try stats.current first
+    if 'stats' in product and product['stats'].get('current'):
+        price_cents = product['stats']['current'][0]
+        if price_cents and price_cents > 0:
+            price_local = price_cents / 100.0
+    
+    # Try buyBoxPrice
+    if not price_local and 'stats' in product and product['stats'].get('buyBoxPrice'):
+        price_cents = product['stats']['buyBoxPrice']
+        if price_cents and price_cents > 0:
+            price_local = price_cents / 100.0
+    
+    if not price_local:
+        return {
+            'country': market_info['country'],
+            'flag': market_info['flag'],
+            'available': False,
+            'reason': 'Prix non disponible'
+        }
+    
+    price_eur = round(price_local * market_info['exchange_rate'], 2)
+    fees_eur = round(price_eur * fee_rate, 2)
+    margin_eur = round(price_eur - supplier_price_eur - fees_eur, 2)
+    margin_pct = round((margin_eur / price_eur * 100) if price_eur > 0 else 0, 1)
+    
+    return {
+        'country': market_info['country'],
+        'flag': market_info['flag'],
+        'currency': market_info['currency'],
+        'price_local': price_local,
+        'price_eur': price_eur,
+        'fees_eur': fees_eur,
+        'margin_eur': margin_eur,
+        'margin_percentage': margin_pct,
+        'exchange_rate': market_info['exchange_rate'],
+        'available': True
+    }
+
+
+async def analyze_multi_market_arbitrage(
+    gtin: str,
+    supplier_price_eur: float,
+    keepa_api_key: Optional[str],
+    keepa_products: Optional[Dict[int, Optional[dict]]] = None
+) -> dict:
+    """
+    Analyze arbitrage opportunities across multiple Amazon marketplaces.
     
     Markets analyzed: FR, UK, DE, ES
     
+    Args:
+        keepa_products: per-request context {domain_id: keepa_product or None (known miss)}
+            from the product lookup. Those domains are reused as is; only the
+            missing markets are fetched, concurrently and through the Keepa cache.
+    
     Returns:
     - markets: Dict with price, fees, margin for each market
     - best_buy_market: Market code with lowest price
@@ -846,13 +2261,8 @@ async def analyze_multi_market_arbitrage(gtin: str, supplier_price_eur: float, k
     - exchange_rates: Currency conversion rates used
     """
     
-    # Market configurations - CORRECT Keepa domain IDs
-    MARKETS = {
-        'FR': {'domain': 4, 'currency': 'EUR', 'name': 'France', 'flag': '🇫🇷', 'exchange_rate': 1.0},
-        'UK': {'domain': 2, 'currency': 'GBP', 'name': 'Royaume-Uni', 'flag': '🇬🇧', 'exchange_rate': 1.17},  # GBP to EUR
-        'DE': {'domain': 3, 'currency': 'EUR', 'name': 'Allemagne', 'flag': '🇩🇪', 'exchange_rate': 1.0},
-        'ES': {'domain': 9, 'currency': 'EUR', 'name': 'Espagne', 'flag': '🇪🇸', 'exchange_rate': 1.0},
-    }
+    domains_by_market = {d['market_code']: d for d in KEEPA_EUROPEAN_DOMAINS}
+    MARKETS = {code: domains_by_market[code] for code in ARBITRAGE_MARKET_CODES}
     
     AMAZON_FEE_RATE = 0.15
     
@@ -873,7 +2283,7 @@ async def analyze_multi_market_arbitrage(gtin: str, supplier_price_eur: float, k
             margin_pct = round((margin_eur / price_eur * 100) if price_eur > 0 else 0, 1)
             
             markets_data[market_code] = {
-                'country': market_info['name'],
+                'country': market_info['country'],
                 'flag': market_info['flag'],
                 'currency': market_info['currency'],
                 'price_local': price_local,
@@ -886,80 +2296,35 @@ async def analyze_multi_market_arbitrage(gtin: str, supplier_price_eur: float, k
             }
     
     else:
-        # Real Keepa API call for multiple domains
-        try:
-            async with httpx.AsyncClient() as client:
-                for market_code, market_info in MARKETS.items():
-                    try:
-                        response = await client.get(
-                            "https://api.keepa.com/product",
-                            params={
-                                'key': keepa_api_key,
-                                'domain': market_info['domain'],
-                                'code': gtin
-                            },
-                            timeout=10
-                        )
-                        
-                        if response.status_code == 200:
-                            data = response.json()
-                            products = data.get('products', [])
-                            
-                            if products:
-                                product = products[0]
-                                # Try to get current price
-                                price_local = None
-                                
-                                # Try stats.current first
-                                if 'stats' in product and product['stats'].get('current'):
-                                    price_cents = product['stats']['current'][0]
-                                    if price_cents and price_cents > 0:
-                                        price_local = price_cents / 100.0
-                                
-                                # Try buyBoxPrice
-                                if not price_local and 'stats' in product and product['stats'].get('buyBoxPrice'):
-                                    price_cents = product['stats']['buyBoxPrice']
-                                    if price_cents and price_cents > 0:
-                                        price_local = price_cents / 100.0
-                                
-                                if price_local:
-                                    price_eur = round(price_local * market_info['exchange_rate'], 2)
-                                    fees_eur = round(price_eur * AMAZON_FEE_RATE, 2)
-                                    margin_eur = round(price_eur - supplier_price_eur - fees_eur, 2)
-                                    margin_pct = round((margin_eur / price_eur * 100) if price_eur > 0 else 0, 1)
-                                    
-                                    markets_data[market_code] = {
-                                        'country': market_info['name'],
-                                        'flag': market_info['flag'],
-                                        'currency': market_info['currency'],
-                                        'price_local': price_local,
-                                        'price_eur': price_eur,
-                                        'fees_eur': fees_eur,
-                                        'margin_eur': margin_eur,
-                                        'margin_percentage': margin_pct,
-                                        'exchange_rate': market_info['exchange_rate'],
-                                        'available': True
-                                    }
-                                else:
-                                    markets_data[market_code] = {
-                                        'country': market_info['name'],
-                                        'flag': market_info['flag'],
-                                        'available': False,
-                                        'reason': 'Prix non disponible'
-                                    }
-                        
-                    except Exception as e:
-                        logger.error(f"Error fetching Keepa data for market {market_code}: {e}")
-                        markets_data[market_code] = {
-                            'country': market_info['name'],
-                            'flag': market_info['flag'],
-                            'available': False,
-                            'reason': 'Erreur API'
-                        }
+        known_products = keepa_products or {}
+        missing_markets = [code for code, info in MARKETS.items() if info['domain'] not in known_products]
         
-        except Exception as e:
-            logger.error(f"Error in multi-market analysis: {e}")
-            return None
+        async def fetch_market(market_code: str):
+            try:
+                found, _ = await fetch_keepa_products(keepa_api_key, MARKETS[market_code]['domain'], codes=[gtin], profile='price-only')
+                return found.get(gtin)
+            except Exception as e:
+                logger.error(f"Error fetching Keepa data for market {market_code}: {e}")
+                return e
+        
+        # Only the markets the product lookup did not already cover, all at once
+        fetched = await asyncio.gather(*(fetch_market(code) for code in missing_markets))
+        market_products = {code: known_products.get(info['domain']) for code, info in MARKETS.items()}
+        market_products.update(zip(missing_markets, fetched))
+        
+        for market_code, market_info in MARKETS.items():
+            product = market_products[market_code]
+            if isinstance(product, Exception):
+                markets_data[market_code] = {
+                    'country': market_info['country'],
+                    'flag': market_info['flag'],
+                    'available': False,
+                    'reason': 'Erreur API'
+                }
+                continue
+            entry = build_arbitrage_market_entry(market_info, product, supplier_price_eur, AMAZON_FEE_RATE)
+            if entry:
+                markets_data[market_code] = entry
     
     # Calculate best opportunities
     available_markets = {k: v for k, v in markets_data.items() if v.get('available', False)}
@@ -1016,6 +2381,8 @@ class CatalogProduct(BaseModel):
     product_link: Optional[str] = None
     # Price data
     amazon_price_eur: Optional[float] = None  # Prix de vente Amazon (via Keepa)
+    amazon_price_local: Optional[float] = None  # Prix Amazon dans la devise de la marketplace
+    amazon_currency: Optional[str] = None
     google_lowest_price_eur: Optional[float] = None  # Prix le plus bas en ligne (via Google)
     google_suppliers_results: Optional[List[Dict[str, Any]]] = None  # Tous les fournisseurs Google avec détails
     # Comparison results
@@ -1037,6 +2404,9 @@ class CatalogProduct(BaseModel):
     margin_eur: Optional[float] = None
     margin_percentage: Optional[float] = None
     last_compared_at: Optional[datetime] = None
+    # Inputs of the last comparison (incremental re-compare)
+    compared_supplier_price_eur: Optional[float] = None
+    compared_gtin: Optional[str] = None
     created_at: datetime
 
 class CatalogStats(BaseModel):
@@ -1046,6 +2416,14 @@ class CatalogStats(BaseModel):
     avg_margin_percentage: float
     best_opportunity_margin: float
 
+class CatalogSimulationRequest(BaseModel):
+    fee_percentage: Optional[float] = None  # Frais Amazon en % (défaut: AMAZON_FEE_PERCENTAGE)
+    category_fee_percentages: Dict[str, float] = {}  # Frais Amazon en % par catégorie
+    exchange_rates: Dict[str, float] = {}  # Taux vers l'EUR par devise, ex. {"GBP": 1.15}
+    supplier_price_change_percentage: float = 0  # Variation des prix fournisseur en %
+    category_supplier_price_changes: Dict[str, float] = {}  # Variation en % par catégorie
+    top_n: int = 20
+
 # ==================== CURRENCY CONVERSION ====================
 
 # Fixed GBP to EUR rate (you can make this dynamic with an API later)
@@ -1058,14 +2436,14 @@ def convert_gbp_to_eur(price_gbp: float) -> float:
 async def get_exchange_rate() -> float:
     """Get current GBP to EUR exchange rate from API (fallback to fixed rate)"""
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                "https://api.exchangerate-api.com/v4/latest/GBP",
-                timeout=5
-            )
-            if response.status_code == 200:
-                data = response.json()
-                return data['rates'].get('EUR', GBP_TO_EUR_RATE)
+        response = await provider_request(
+            'exchange',
+            'GET',
+            "https://api.exchangerate-api.com/v4/latest/GBP"
+        )
+        if response.status_code == 200:
+            data = response.json()
+            return data['rates'].get('EUR', GBP_TO_EUR_RATE)
     except Exception as e:
         logger.warning(f"Exchange rate API error, using fixed rate: {e}")
     return GBP_TO_EUR_RATE
@@ -1438,33 +2816,32 @@ async def search_by_text(request: ProductSearchRequest, user: dict = Depends(get
     if keepa_key:
         # Try real Keepa API - multi-domain search for text-based product search
         try:
-            async with httpx.AsyncClient() as http_client:
-                # Multi-domain search: tries FR first, then DE, IT, ES, UK, US
-                keepa_product_found, found_domain = await search_keepa_product_multi_domain(
-                    http_client=http_client,
-                    keepa_key=keepa_key,
-                    gtin=None,  # Text search, no GTIN
-                    search_term=request.query,
-                    primary_domain=4  # Amazon.fr first
-                )
+            # Multi-domain search: tries FR first, then DE, IT, ES, UK, US
+            keepa_product_found, found_domain = await search_keepa_product_multi_domain(
+                keepa_key=keepa_key,
+                gtin=None,  # Text search, no GTIN
+                search_term=request.query,
+                primary_domain=4,  # Amazon.fr first
+                profile='price-only'
+            )
+            
+            if keepa_product_found:
+                # Extract price using helper function
+                local_price = extract_keepa_price(keepa_product_found)
+                if local_price is not None:
+                    exchange_rate = found_domain.get('exchange_rate', 1.0) if found_domain else 1.0
+                    amazon_price = round(local_price * exchange_rate, 2)
+                
+                domain_name = found_domain.get('name', 'unknown') if found_domain else 'unknown'
+                keepa_data = {
+                    'asin': keepa_product_found.get('asin', ''),
+                    'title': keepa_product_found.get('title', request.query),
+                    'current_price': amazon_price,
+                    'mock_data': False,
+                    'source_domain': domain_name
+                }
+                logger.info(f"Keepa found product: {keepa_product_found.get('title', 'N/A')} - Price: €{amazon_price} (from {domain_name})")
                 
-                if keepa_product_found:
-                    # Extract price using helper function
-                    local_price = extract_keepa_price(keepa_product_found)
-                    if local_price is not None:
-                        exchange_rate = found_domain.get('exchange_rate', 1.0) if found_domain else 1.0
-                        amazon_price = round(local_price * exchange_rate, 2)
-                    
-                    domain_name = found_domain.get('name', 'unknown') if found_domain else 'unknown'
-                    keepa_data = {
-                        'asin': keepa_product_found.get('asin', ''),
-                        'title': keepa_product_found.get('title', request.query),
-                        'current_price': amazon_price,
-                        'mock_data': False,
-                        'source_domain': domain_name
-                    }
-                    logger.info(f"Keepa found product: {keepa_product_found.get('title', 'N/A')} - Price: €{amazon_price} (from {domain_name})")
-                    
         except Exception as e:
             logger.warning(f"Keepa API error: {e}")
     
@@ -1476,22 +2853,22 @@ async def search_by_text(request: ProductSearchRequest, user: dict = Depends(get
     # If Google API keys are configured, use real search
     if google_key and search_engine_id:
         try:
-            async with httpx.AsyncClient() as http_client:
-                response = await http_client.get(
-                    "https://www.googleapis.com/customsearch/v1",
-                    params={
-                        "key": google_key,
-                        "cx": search_engine_id,
-                        "q": request.query,
-                        "searchType": "image" if request.search_type == "image" else None,
-                        "num": 5
-                    },
-                    timeout=30
-                )
-                if response.status_code == 200:
-                    data = response.json()
-                    # Process real search results...
-                    pass
+            response = await provider_request(
+                'google',
+                'GET',
+                "https://www.googleapis.com/customsearch/v1",
+                params={
+                    "key": google_key,
+                    "cx": search_engine_id,
+                    "q": request.query,
+                    "searchType": "image" if request.search_type == "image" else None,
+                    "num": 5
+                }
+            )
+            if response.status_code == 200:
+                data = response.json()
+                # Process real search results...
+                pass
         except Exception as e:
             logger.warning(f"Google Search API error: {e}")
     
@@ -1549,34 +2926,34 @@ async def search_by_image(
     # If Google Vision API key is configured, use real detection
     if google_key:
         try:
-            async with httpx.AsyncClient() as http_client:
-                response = await http_client.post(
-                    f"https://vision.googleapis.com/v1/images:annotate?key={google_key}",
-                    json={
-                        "requests": [{
-                            "image": {"content": image_base64},
-                            "features": [
-                                {"type": "LABEL_DETECTION", "maxResults": 10},
-                                {"type": "WEB_DETECTION", "maxResults": 5},
-                                {"type": "OBJECT_LOCALIZATION", "maxResults": 5}
-                            ]
-                        }]
-                    },
-                    timeout=30
-                )
-                if response.status_code == 200:
-                    data = response.json()
-                    responses = data.get('responses', [{}])[0]
-                    
-                    # Extract labels
-                    labels = responses.get('labelAnnotations', [])
-                    detected_labels = [lbl.get('description', '') for lbl in labels[:5]]
-                    
-                    # Extract web entities for product name
-                    web_detection = responses.get('webDetection', {})
-                    web_entities = web_detection.get('webEntities', [])
-                    if web_entities:
-                        product_name = web_entities[0].get('description', 'Detected Product')
+            response = await provider_request(
+                'google',
+                'POST',
+                f"https://vision.googleapis.com/v1/images:annotate?key={google_key}",
+                json={
+                    "requests": [{
+                        "image": {"content": image_base64},
+                        "features": [
+                            {"type": "LABEL_DETECTION", "maxResults": 10},
+                            {"type": "WEB_DETECTION", "maxResults": 5},
+                            {"type": "OBJECT_LOCALIZATION", "maxResults": 5}
+                        ]
+                    }]
+                }
+            )
+            if response.status_code == 200:
+                data = response.json()
+                responses = data.get('responses', [{}])[0]
+                
+                # Extract labels
+                labels = responses.get('labelAnnotations', [])
+                detected_labels = [lbl.get('description', '') for lbl in labels[:5]]
+                
+                # Extract web entities for product name
+                web_detection = responses.get('webDetection', {})
+                web_entities = web_detection.get('webEntities', [])
+                if web_entities:
+                    product_name = web_entities[0].get('description', 'Detected Product')
         except Exception as e:
             logger.warning(f"Google Vision API error: {e}")
     
@@ -1653,6 +3030,23 @@ async def get_price_history(product_id: str, user: dict = Depends(get_current_us
 
 # ==================== KEEPA INTEGRATION ====================
 
+@api_router.get("/keepa/tokens")
+async def get_keepa_tokens(user: dict = Depends(get_current_user)):
+    """Get the current Keepa token state (tokens left, refill rate, queued requests) for the user's key"""
+    keepa_key = user.get('api_keys', {}).get('keepa_api_key')
+    if not keepa_key:
+        return {'keepa_api_key_set': False}
+
+    bucket = get_keepa_token_bucket(keepa_key)
+    if bucket.tokens_left is None:
+        # Nothing synced yet: the /token endpoint reports the state without costing tokens
+        try:
+            await keepa_request(keepa_key, "token", {})
+        except Exception as e:
+            logger.warning(f"Keepa token status error: {e}")
+
+    return {'keepa_api_key_set': True, **bucket.status()}
+
 @api_router.get("/keepa/product/{asin}")
 async def get_keepa_product(asin: str, user: dict = Depends(get_current_user)):
     """Get product data from Keepa API"""
@@ -1673,27 +3067,87 @@ async def get_keepa_product(asin: str, user: dict = Depends(get_current_user)):
         }
     
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                "https://api.keepa.com/product",
-                params={
-                    "key": keepa_key,
-                    "domain": 1,  # Amazon.com
-                    "asin": asin,
-                    "history": 1
-                },
-                timeout=30
-            )
-            if response.status_code == 200:
-                return response.json()
-            else:
-                raise HTTPException(status_code=response.status_code, detail="Keepa API error")
+        status_code, data = await keepa_request(
+            keepa_key,
+            "product",
+            {"domain": 1, "asin": asin, **KEEPA_FETCH_PROFILES['full']}  # Amazon.com
+        )
+        if status_code == 429:
+            raise HTTPException(status_code=429, detail="Keepa API rate limited")
+        if status_code != 200:
+            logger.error(f"Keepa API error: HTTP {status_code} for ASIN {asin}")
+            raise HTTPException(status_code=502, detail=f"Keepa API error (HTTP {status_code})")
+        # The whole Keepa response; its history also goes to the history store
+        await store_keepa_price_histories(1, data.get('products') or [])
+        return data
+    except HTTPException:
+        raise
     except httpx.TimeoutException:
         raise HTTPException(status_code=504, detail="Keepa API timeout")
     except Exception as e:
         logger.error(f"Keepa API error: {e}")
         raise HTTPException(status_code=500, detail="Keepa API error")
 
+@api_router.get("/keepa/history/{asin}")
+async def get_keepa_price_history(asin: str, domain: int = 1, csv_type: Optional[int] = None, user: dict = Depends(get_current_user)):
+    """Get the stored Keepa price history of an ASIN, fetching it from Keepa once if it is not stored yet"""
+    history = await load_keepa_price_history(asin, domain, csv_type)
+    
+    if history is None:
+        keepa_key = user.get('api_keys', {}).get('keepa_api_key')
+        if not keepa_key:
+            raise HTTPException(status_code=404, detail="No stored price history for this ASIN")
+        try:
+            _, rate_limited = await fetch_keepa_products(keepa_key, domain, asins=[asin], profile='full', raise_errors=True)
+        except KeepaHTTPError as e:
+            logger.error(f"Keepa API error: {e}")
+            raise HTTPException(status_code=502, detail=f"Keepa API error (HTTP {e.status_code})")
+        except httpx.TimeoutException:
+            raise HTTPException(status_code=504, detail="Keepa API timeout")
+        except Exception as e:
+            logger.error(f"Keepa API error: {e}")
+            raise HTTPException(status_code=500, detail="Keepa API error")
+        if rate_limited:
+            raise HTTPException(status_code=429, detail="Keepa API rate limited")
+        history = await load_keepa_price_history(asin, domain, csv_type)
+        if history is None:
+            raise HTTPException(status_code=404, detail="No price history found for this ASIN")
+    
+    dates = KEEPA_EPOCH + pd.to_timedelta(history['minutes'], unit='m')
+    return {
+        'asin': asin,
+        'domain': domain,
+        'csv_type': history['csv_type'],
+        'version': history['version'],
+        'points': history['points'],
+        'updated_at': history['updated_at'],
+        'history': [
+            {'date': date.isoformat(), 'price': round(float(price), 2)}
+            for date, price in zip(dates, history['prices'])
+        ]
+    }
+
+@api_router.get("/keepa/negative-cache")
+async def list_keepa_negative_cache(limit: int = 100, user: dict = Depends(get_current_user)):
+    """List the GTINs of the user's catalog currently skipped because they were not found on any Amazon domain
+    
+    The negative cache is shared by all users: only the entries of GTINs in the caller's catalog are listed.
+    """
+    gtins = await db.catalog_products.distinct('gtin', {'user_id': user['id'], 'gtin': {'$nin': [None, '']}})
+    entries = await db.keepa_negative_cache.find(
+        {'gtin': {'$in': gtins}, 'retry_after': {'$gt': datetime.now(timezone.utc)}},
+        {'_id': 0}
+    ).sort('last_miss_at', -1).to_list(limit)
+    return {'entries': entries, 'count': len(entries)}
+
+@api_router.delete("/keepa/negative-cache/{gtin}")
+async def clear_keepa_negative_cache(gtin: str, user: dict = Depends(get_current_user)):
+    """Forget the misses of a GTIN of the user's catalog so that the next compare searches Keepa again"""
+    if not await db.catalog_products.find_one({'user_id': user['id'], 'gtin': gtin}, {'_id': 1}):
+        raise HTTPException(status_code=404, detail="GTIN non trouvé dans le catalogue")
+    result = await db.keepa_negative_cache.delete_many({'gtin': gtin})
+    return {'success': True, 'gtin': gtin, 'deleted': result.deleted_count}
+
 # ==================== CATALOG ENDPOINTS ====================
 
 def _is_good_header_row(columns) -> bool:
@@ -2371,151 +3825,604 @@ def extract_price_from_text(text: str) -> Optional[float]:
     return min(prices) if prices else None
 
 
-async def search_google_shopping_dataforseo(product: dict, login: str, password: str) -> tuple:
-    """Search Google Shopping via DataForSEO Merchant API.
-    
-    Returns:
-        tuple: (google_lowest_price, google_suppliers_list)
+# ==================== WEB SEARCH CACHE ====================
+
+# Normalized supplier results of the Google Custom Search (web and image) and DataForSEO
+# Google Shopping queries, keyed by query: catalog products sharing a brand + name, and
+# other users comparing the same products, reuse them instead of spending a query.
+WEB_SEARCH_CACHE_NAMESPACES = ('cse', 'cse_image', 'dataforseo')
+WEB_SEARCH_CACHE_TTL_SECONDS = int(os.environ.get('WEB_SEARCH_CACHE_TTL_SECONDS', 12 * 3600))
+WEB_SEARCH_CACHE_LRU_SIZE = int(os.environ.get('WEB_SEARCH_CACHE_LRU_SIZE', 5000))
+
+
+def copy_suppliers(suppliers: List[dict]) -> List[dict]:
+    return [dict(supplier) for supplier in suppliers]
+
+
+class WebSearchCache:
+    """Two-level cache of web search supplier results keyed by (namespace, normalized query).
+
+    As KeepaResponseCache: an in-process LRU in front of the `web_search_cache` Mongo
+    collection, whose TTL index drops expired entries, shared by all users. Searches
+    that found no price are cached too; failed ones are not. Concurrent fetches of the
+    same query wait for the first one instead of sending their own (see fetch).
     """
-    import base64
-    
-    google_suppliers = []
-    google_lowest_price = None
-    
-    try:
-        # Build search query from product info
-        search_parts = []
-        if product.get('brand') and product['brand'] != 'Non spécifié':
-            search_parts.append(product['brand'])
-        if product.get('name') and product['name'] != 'Non spécifié':
-            search_parts.append(product['name'])
-        if not search_parts:
-            search_parts.append(product.get('gtin', ''))
-        
-        search_keyword = ' '.join(search_parts).strip()
-        if not search_keyword:
-            logger.warning("DataForSEO: no search keyword available")
-            return None, []
-        
-        logger.info(f"DataForSEO Google Shopping search: '{search_keyword}'")
-        
-        # Build auth header
-        credentials = base64.b64encode(f"{login}:{password}".encode()).decode()
-        
-        async with httpx.AsyncClient() as http_client:
-            response = await http_client.post(
-                "https://api.dataforseo.com/v3/merchant/google/products/live",
-                headers={
-                    "Authorization": f"Basic {credentials}",
-                    "Content-Type": "application/json"
-                },
-                json=[{
-                    "language_code": "fr",
-                    "location_code": 2250,  # France
-                    "keyword": search_keyword,
-                    "price_min": 1
-                }],
-                timeout=30
-            )
-            
-            logger.info(f"DataForSEO API response status: {response.status_code}")
-            
-            if response.status_code == 200:
-                data = response.json()
-                tasks = data.get('tasks', [])
-                
-                if tasks and len(tasks) > 0:
-                    task = tasks[0]
-                    task_result = task.get('result', [])
-                    
-                    if task_result and len(task_result) > 0:
-                        items = task_result[0].get('items', [])
-                        logger.info(f"DataForSEO returned {len(items)} shopping items")
-                        
-                        for item in items:
-                            item_type = item.get('type', '')
-                            
-                            # Handle different item types from DataForSEO
-                            if item_type == 'google_shopping_serp':
-                                price = item.get('price', None)
-                                title = item.get('title', '')
-                                seller_name = item.get('seller', '') or item.get('source', '') or 'Inconnu'
-                                product_url = item.get('url', '') or item.get('product_url', '')
-                                
-                                if price and price > 0:
-                                    item_is_amazon = is_amazon_url(product_url) or 'amazon' in seller_name.lower()
-                                    
-                                    google_suppliers.append({
-                                        'supplier_name': seller_name if seller_name else extract_supplier_name_from_url(product_url),
-                                        'url': product_url,
-                                        'price': round(price, 2),
-                                        'is_lowest': False,
-                                        'is_amazon': item_is_amazon,
-                                        'source': 'google_shopping'
-                                    })
-                            
-                            elif item_type == 'google_shopping_paid':
-                                price = item.get('price', None)
-                                seller_name = item.get('seller', '') or item.get('source', '') or 'Inconnu'
-                                product_url = item.get('url', '') or item.get('product_url', '')
-                                
-                                if price and price > 0:
-                                    item_is_amazon = is_amazon_url(product_url) or 'amazon' in seller_name.lower()
-                                    
-                                    google_suppliers.append({
-                                        'supplier_name': seller_name if seller_name else extract_supplier_name_from_url(product_url),
-                                        'url': product_url,
-                                        'price': round(price, 2),
-                                        'is_lowest': False,
-                                        'is_amazon': item_is_amazon,
-                                        'source': 'google_shopping'
-                                    })
-                            
-                            else:
-                                # Generic handling for other item types
-                                price = item.get('price', None) or item.get('price_from', None)
-                                if price and price > 0:
-                                    seller_name = item.get('seller', '') or item.get('source', '') or item.get('title', 'Inconnu')
-                                    product_url = item.get('url', '') or item.get('product_url', '')
-                                    item_is_amazon = is_amazon_url(product_url) or 'amazon' in str(seller_name).lower()
-                                    
-                                    google_suppliers.append({
-                                        'supplier_name': seller_name if seller_name else 'Inconnu',
-                                        'url': product_url,
-                                        'price': round(float(price), 2),
-                                        'is_lowest': False,
-                                        'is_amazon': item_is_amazon,
-                                        'source': 'google_shopping'
-                                    })
-                        
-                        # Mark lowest price
-                        if google_suppliers:
-                            lowest_price = min(s['price'] for s in google_suppliers)
-                            google_lowest_price = lowest_price
-                            for supplier in google_suppliers:
-                                if supplier['price'] == lowest_price:
-                                    supplier['is_lowest'] = True
-                                    break
-                            
-                            logger.info(f"DataForSEO found {len(google_suppliers)} suppliers, lowest: €{google_lowest_price}")
-                        else:
-                            logger.info(f"DataForSEO: no prices found for '{search_keyword}'")
-                    else:
-                        logger.info(f"DataForSEO: empty result for '{search_keyword}'")
-                else:
-                    logger.warning(f"DataForSEO: no tasks in response")
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.entries: OrderedDict = OrderedDict()  # key -> (expires_at timestamp, suppliers)
+        self.in_flight: Dict[str, asyncio.Future] = {}  # key -> suppliers of the running search
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(namespace: str, query: str) -> str:
+        return f"{namespace}:{' '.join(query.lower().split())}"
+
+    def _remember(self, key: str, expires_at: float, suppliers: List[dict]):
+        self.entries[key] = (expires_at, suppliers)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    async def get_many(self, namespace: str, queries: List[str], peek: bool = False) -> Dict[str, List[dict]]:
+        """Return the cached suppliers among `queries` as {query: suppliers}
+
+        peek: only look (compare planner): no LRU update and no hit/miss counting.
+        """
+        now = time.time()
+        found = {}
+        missing_keys = {}
+        for query in queries:
+            key = self.make_key(namespace, query)
+            entry = self.entries.get(key)
+            if entry and entry[0] > now:
+                if not peek:
+                    self.entries.move_to_end(key)
+                found[query] = copy_suppliers(entry[1])
             else:
-                logger.warning(f"DataForSEO API HTTP {response.status_code}: {response.text[:300]}")
+                missing_keys.setdefault(key, []).append(query)
+        
+        if missing_keys:
+            try:
+                docs = await db.web_search_cache.find(
+                    {'key': {'$in': list(missing_keys)}, 'expires_at': {'$gt': datetime.now(timezone.utc)}},
+                    {'_id': 0, 'key': 1, 'suppliers': 1, 'expires_at': 1}
+                ).to_list(None)
+                for doc in docs:
+                    expires_at = doc['expires_at']
+                    if expires_at.tzinfo is None:
+                        expires_at = expires_at.replace(tzinfo=timezone.utc)
+                    if not peek:
+                        self._remember(doc['key'], expires_at.timestamp(), doc['suppliers'])
+                    for query in missing_keys[doc['key']]:
+                        found[query] = copy_suppliers(doc['suppliers'])
+            except Exception as e:
+                logger.warning(f"Web search cache read error: {e}")
+        
+        if not peek:
+            self.hits += len(found)
+            self.misses += len(queries) - len(found)
+        return found
+
+    async def set(self, namespace: str, query: str, suppliers: List[dict]):
+        """Store the normalized suppliers found by a successful search"""
+        key = self.make_key(namespace, query)
+        now = datetime.now(timezone.utc)
+        expires_at = now + timedelta(seconds=WEB_SEARCH_CACHE_TTL_SECONDS)
+        suppliers = copy_suppliers(suppliers)
+        self._remember(key, expires_at.timestamp(), suppliers)
+        try:
+            await db.web_search_cache.update_one(
+                {'key': key},
+                {'$set': {
+                    'key': key,
+                    'namespace': namespace,
+                    'query': query,
+                    'suppliers': suppliers,
+                    'cached_at': now,
+                    'expires_at': expires_at
+                }},
+                upsert=True
+            )
+        except Exception as e:
+            logger.warning(f"Web search cache write error: {e}")
+
+    async def fetch(self, namespace: str, query: str, search) -> Optional[List[dict]]:
+        """Cached suppliers of the query, or those of `search()` (a coroutine function; None when the search failed)"""
+        cached = await self.get_many(namespace, [query])
+        if query in cached:
+            return cached[query]
+        
+        key = self.make_key(namespace, query)
+        running = self.in_flight.get(key)
+        if running is not None:
+            suppliers = await asyncio.shield(running)
+            return copy_suppliers(suppliers) if suppliers is not None else None
+        
+        running = asyncio.get_running_loop().create_future()
+        self.in_flight[key] = running
+        suppliers = None
+        try:
+            suppliers = await search()
+            if suppliers is not None:
+                await self.set(namespace, query, suppliers)
+            return suppliers
+        finally:
+            del self.in_flight[key]
+            running.set_result(copy_suppliers(suppliers) if suppliers is not None else None)
+
+
+web_search_cache = WebSearchCache(WEB_SEARCH_CACHE_LRU_SIZE)
+
+
+def build_dataforseo_keyword(product: dict) -> str:
+    """Google Shopping keyword of a product: brand + name, or the GTIN without them"""
+    search_parts = []
+    if product.get('brand') and product['brand'] != 'Non spécifié':
+        search_parts.append(product['brand'])
+    if product.get('name') and product['name'] != 'Non spécifié':
+        search_parts.append(product['name'])
+    if not search_parts:
+        search_parts.append(product.get('gtin', ''))
+    return ' '.join(search_parts).strip()
+
+
+def build_dataforseo_headers(login: str, password: str) -> dict:
+    credentials = base64.b64encode(f"{login}:{password}".encode()).decode()
+    return {
+        "Authorization": f"Basic {credentials}",
+        "Content-Type": "application/json"
+    }
+
+
+def build_dataforseo_task(search_keyword: str, tag: Optional[str] = None) -> dict:
+    """One Google Shopping task (France, French), for the live endpoint or the standard queue"""
+    task = {
+        "language_code": "fr",
+        "location_code": 2250,  # France
+        "keyword": search_keyword,
+        "price_min": 1
+    }
+    if tag is not None:
+        task["tag"] = tag
+    return task
+
+
+def parse_dataforseo_items(items: List[dict]) -> List[dict]:
+    """Normalize DataForSEO Google Shopping items into supplier results (see mark_lowest_google_supplier)"""
+    google_suppliers = []
+    for item in items:
+        item_type = item.get('type', '')
+        
+        # Handle different item types from DataForSEO
+        if item_type in ('google_shopping_serp', 'google_shopping_paid'):
+            price = item.get('price', None)
+            seller_name = item.get('seller', '') or item.get('source', '') or 'Inconnu'
+            product_url = item.get('url', '') or item.get('product_url', '')
+            
+            if price and price > 0:
+                item_is_amazon = is_amazon_url(product_url) or 'amazon' in seller_name.lower()
+                
+                google_suppliers.append({
+                    'supplier_name': seller_name if seller_name else extract_supplier_name_from_url(product_url),
+                    'url': product_url,
+                    'price': round(price, 2),
+                    'is_lowest': False,
+                    'is_amazon': item_is_amazon,
+                    'source': 'google_shopping'
+                })
+        
+        else:
+            # Generic handling for other item types
+            price = item.get('price', None) or item.get('price_from', None)
+            if price and price > 0:
+                seller_name = item.get('seller', '') or item.get('source', '') or item.get('title', 'Inconnu')
+                product_url = item.get('url', '') or item.get('product_url', '')
+                item_is_amazon = is_amazon_url(product_url) or 'amazon' in str(seller_name).lower()
+                
+                google_suppliers.append({
+                    'supplier_name': seller_name if seller_name else 'Inconnu',
+                    'url': product_url,
+                    'price': round(float(price), 2),
+                    'is_lowest': False,
+                    'is_amazon': item_is_amazon,
+                    'source': 'google_shopping'
+                })
+    return google_suppliers
+
+
+def read_dataforseo_task_suppliers(task: dict, search_keyword: str) -> Optional[List[dict]]:
+    """Normalized suppliers of one DataForSEO task (None if the task failed)"""
+    if task.get('status_code') != DATAFORSEO_TASK_OK:
+        logger.warning(f"DataForSEO task failed for '{search_keyword}': {task.get('status_message')}")
+        return None
+    task_result = task.get('result') or []
+    if not task_result:
+        logger.info(f"DataForSEO: empty result for '{search_keyword}'")
+        return []
+    
+    items = task_result[0].get('items') or []
+    logger.info(f"DataForSEO returned {len(items)} shopping items")
+    return parse_dataforseo_items(items)
+
+
+def mark_dataforseo_lowest(google_suppliers: List[dict], search_keyword: str) -> tuple:
+    """(google_lowest_price, google_suppliers_list) of a Google Shopping search"""
+    google_lowest_price = mark_lowest_google_supplier(google_suppliers)
+    if google_suppliers:
+        logger.info(f"DataForSEO found {len(google_suppliers)} suppliers, lowest: €{google_lowest_price}")
+    else:
+        logger.info(f"DataForSEO: no prices found for '{search_keyword}'")
+    return google_lowest_price, google_suppliers
+
+
+async def fetch_google_shopping_dataforseo(search_keyword: str, login: str, password: str) -> Optional[List[dict]]:
+    """One live DataForSEO Google Shopping search; None when it failed"""
+    try:
+        response = await provider_request(
+            'dataforseo',
+            'POST',
+            f"{DATAFORSEO_PRODUCTS_URL}/live",
+            headers=build_dataforseo_headers(login, password),
+            json=[build_dataforseo_task(search_keyword)]
+        )
+        
+        logger.info(f"DataForSEO API response status: {response.status_code}")
+        
+        if response.status_code == 200:
+            tasks = response.json().get('tasks', [])
+            if tasks:
+                return read_dataforseo_task_suppliers(tasks[0], search_keyword)
+            logger.warning(f"DataForSEO: no tasks in response")
+        else:
+            logger.warning(f"DataForSEO API HTTP {response.status_code}: {response.text[:300]}")
     
     except Exception as e:
         logger.warning(f"DataForSEO API error: {e}")
     
-    return google_lowest_price, google_suppliers
+    return None
+
+
+async def search_google_shopping_dataforseo(product: dict, login: str, password: str) -> tuple:
+    """Search Google Shopping via DataForSEO Merchant API (results shared through web_search_cache).
+    
+    Returns:
+        tuple: (google_lowest_price, google_suppliers_list)
+    """
+    # Build search query from product info
+    search_keyword = build_dataforseo_keyword(product)
+    if not search_keyword:
+        logger.warning("DataForSEO: no search keyword available")
+        return None, []
+    
+    logger.info(f"DataForSEO Google Shopping search: '{search_keyword}'")
+    google_suppliers = await web_search_cache.fetch(
+        'dataforseo', search_keyword,
+        lambda: fetch_google_shopping_dataforseo(search_keyword, login, password)
+    )
+    if google_suppliers is None:
+        return None, []
+    return mark_dataforseo_lowest(google_suppliers, search_keyword)
+
+
+# ==================== DATAFORSEO STANDARD QUEUE ====================
+
+# Background compare runs post their Google Shopping searches to the standard queue
+# (cheaper than the live endpoint, results within minutes) while Keepa is queried.
+# Posted tasks are recorded in `dataforseo_tasks` until their result is collected: a
+# resumed job waits for the tasks it already posted, and the tasks nobody waits for any
+# more are collected by the compare jobs watchdog (see drain_dataforseo_tasks).
+DATAFORSEO_PRODUCTS_URL = "https://api.dataforseo.com/v3/merchant/google/products"
+DATAFORSEO_TASKS_PER_POST = 100  # DataForSEO limit per task_post call
+DATAFORSEO_TASK_OK = 20000
+DATAFORSEO_TASK_CREATED = 20100
+DATAFORSEO_TASK_NOT_DONE = (40601, 40602)  # Task handed / in queue
+DATAFORSEO_POLL_SECONDS = float(os.environ.get('DATAFORSEO_POLL_SECONDS', 15))
+DATAFORSEO_QUEUE_TIMEOUT_SECONDS = float(os.environ.get('DATAFORSEO_QUEUE_TIMEOUT_SECONDS', 1800))
+# tasks_ready lists a limited number of tasks of the whole account: a task it has not listed
+# after the usual queue latency is checked with task_get, then every DATAFORSEO_TASK_GET_SECONDS
+DATAFORSEO_TASK_GET_SECONDS = float(os.environ.get('DATAFORSEO_TASK_GET_SECONDS', 60))
+DATAFORSEO_TASK_RETENTION_SECONDS = 3 * 24 * 3600  # Recorded tasks still not collected are then forgotten
+DATAFORSEO_DRAIN_LIMIT = 100  # Abandoned tasks collected per watchdog pass
+# Compare jobs post the tasks of the next chunks while a chunk is compared
+DATAFORSEO_QUEUE_LOOKAHEAD_CHUNKS = int(os.environ.get('DATAFORSEO_QUEUE_LOOKAHEAD_CHUNKS', 2))
+
+
+async def get_dataforseo_task(headers: dict, task_id: str, search_keyword: str) -> tuple:
+    """
+    task_get of one queued task, normalized like a live search.
+    
+    Returns:
+        tuple: (done, suppliers) where done is False while the task is still queued (or the
+               call failed), and suppliers is None when the task failed
+    """
+    response = await provider_request(
+        'dataforseo', 'GET', f"{DATAFORSEO_PRODUCTS_URL}/task_get/advanced/{task_id}", headers=headers
+    )
+    if response.status_code != 200:
+        logger.warning(f"DataForSEO task_get HTTP {response.status_code}: {response.text[:300]}")
+        return False, None
+    tasks = response.json().get('tasks') or []
+    if not tasks:
+        logger.warning(f"DataForSEO task_get: no task {task_id} in response")
+        return False, None
+    if tasks[0].get('status_code') in DATAFORSEO_TASK_NOT_DONE:
+        return False, None
+    return True, read_dataforseo_task_suppliers(tasks[0], search_keyword)
+
+
+async def record_dataforseo_tasks(user_id: str, job_id: Optional[str], tasks: Dict[str, str]):
+    """Record posted tasks ({task_id: keyword}) until their result is collected"""
+    if not tasks:
+        return
+    now = datetime.now(timezone.utc)
+    try:
+        await db.dataforseo_tasks.insert_many([
+            {
+                'task_id': task_id,
+                'user_id': user_id,
+                'job_id': job_id,
+                'keyword': search_keyword,
+                'key': web_search_cache.make_key('dataforseo', search_keyword),
+                'posted_at': now,
+                'expires_at': now + timedelta(seconds=DATAFORSEO_TASK_RETENTION_SECONDS)
+            }
+            for task_id, search_keyword in tasks.items()
+        ], ordered=False)
+    except Exception as e:
+        logger.warning(f"DataForSEO task record error: {e}")
+
+
+async def forget_dataforseo_tasks(task_ids: List[str]):
+    if not task_ids:
+        return
+    try:
+        await db.dataforseo_tasks.delete_many({'task_id': {'$in': task_ids}})
+    except Exception as e:
+        logger.warning(f"DataForSEO task record error: {e}")
+
+
+async def lookup_dataforseo_tasks(user_id: str, keys: List[str]) -> Dict[str, dict]:
+    """Recorded tasks of the user for these web_search_cache keys, as {key: task}"""
+    if not keys:
+        return {}
+    try:
+        docs = await db.dataforseo_tasks.find(
+            {'user_id': user_id, 'key': {'$in': keys}}, {'_id': 0}
+        ).sort('posted_at', 1).to_list(None)
+    except Exception as e:
+        logger.warning(f"DataForSEO task record error: {e}")
+        return {}
+    return {doc['key']: doc for doc in docs}
+
+
+class DataForSEOQueueBatch:
+    """Google Shopping searches of a batch of products through the DataForSEO standard queue.
+
+    Queries already in web_search_cache are not posted, products sharing a query share one
+    task, and a query with a recorded task of the user (earlier chunk, interrupted run of the
+    job) waits for that task. Other tasks are posted DATAFORSEO_TASKS_PER_POST per task_post
+    call, tagged with the id of their first product. tasks_ready is then polled and each
+    result is fetched with task_get as soon as it is ready; tasks not listed after the usual
+    latency are checked directly. A product whose task could not be posted, failed, or was
+    not ready within DATAFORSEO_QUEUE_TIMEOUT_SECONDS gets None: the caller falls back to the
+    live endpoint.
+    """
+
+    def __init__(self, login: str, password: str, user_id: str, products: List[dict], job_id: Optional[str] = None):
+        self.headers = build_dataforseo_headers(login, password)
+        self.user_id = user_id
+        self.job_id = job_id
+        self.products = products
+        loop = asyncio.get_running_loop()
+        self.results: Dict[str, asyncio.Future] = {product['id']: loop.create_future() for product in products}
+        self.keywords: Dict[str, str] = {}  # product_id -> search keyword
+        self.groups: Dict[str, List[str]] = {}  # task tag -> ids of the products sharing its query
+        self.posted: set = set()  # Ids of the tasks posted by this batch (their latency is recorded)
+        self.posted_at: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def close(self):
+        """Stop polling; products still waiting get None"""
+        if self.task and not self.task.done():
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+        self.settle_pending()
+
+    async def result(self, product_id: str) -> Optional[tuple]:
+        """(google_lowest_price, google_suppliers_list) of the product, or None to search it live"""
+        return await self.results[product_id]
+
+    def settle(self, product_id: str, result: Optional[tuple]):
+        future = self.results.get(product_id)
+        if future is not None and not future.done():
+            future.set_result(result)
+
+    def settle_group(self, product_ids: List[str], google_suppliers: Optional[List[dict]]):
+        """Give each product of a query its own copy of the suppliers (None: search live)"""
+        for product_id in product_ids:
+            if google_suppliers is None:
+                self.settle(product_id, None)
+            else:
+                self.settle(product_id, mark_dataforseo_lowest(copy_suppliers(google_suppliers), self.keywords[product_id]))
+
+    def settle_pending(self):
+        for product_id in self.results:
+            self.settle(product_id, None)
+
+    async def post_tasks(self, tags: List[str]) -> Dict[str, str]:
+        """One task_post call; returns {task_id: tag} of the created tasks"""
+        response = await provider_request(
+            'dataforseo',
+            'POST',
+            f"{DATAFORSEO_PRODUCTS_URL}/task_post",
+            headers=self.headers,
+            json=[build_dataforseo_task(self.keywords[tag], tag=tag) for tag in tags]
+        )
+        if response.status_code != 200:
+            logger.warning(f"DataForSEO task_post HTTP {response.status_code}: {response.text[:300]}")
+            return {}
+        
+        created = {}
+        for task in response.json().get('tasks') or []:
+            tag = (task.get('data') or {}).get('tag')
+            if task.get('status_code') == DATAFORSEO_TASK_CREATED and tag in self.groups:
+                created[task['id']] = tag
+            else:
+                logger.warning(f"DataForSEO task not created for product {tag}: {task.get('status_message')}")
+        return created
+
+    async def fetch_ready_ids(self) -> set:
+        """Ids of the completed tasks not collected yet (listed for the whole account)"""
+        response = await provider_request('dataforseo', 'GET', f"{DATAFORSEO_PRODUCTS_URL}/tasks_ready", headers=self.headers)
+        if response.status_code != 200:
+            logger.warning(f"DataForSEO tasks_ready HTTP {response.status_code}: {response.text[:300]}")
+            return set()
+        ready = set()
+        for task in response.json().get('tasks') or []:
+            ready.update(entry['id'] for entry in task.get('result') or [] if entry.get('id'))
+        return ready
+
+    async def collect(self, task_id: str, tag: str) -> bool:
+        """task_get of one task and settle its products; False while it is still queued"""
+        try:
+            done, google_suppliers = await get_dataforseo_task(self.headers, task_id, self.keywords[tag])
+        except Exception as e:
+            logger.warning(f"DataForSEO task_get error for task {task_id}: {e}")
+            return False
+        if not done:
+            return False
+        if google_suppliers is not None:
+            if task_id in self.posted:
+                record_provider_latency('dataforseo_queue', time.monotonic() - self.posted_at)
+            await web_search_cache.set('dataforseo', self.keywords[tag], google_suppliers)
+        await forget_dataforseo_tasks([task_id])
+        self.settle_group(self.groups[tag], google_suppliers)
+        return True
+
+    async def run(self):
+        try:
+            queries: Dict[str, List[str]] = {}  # cache key -> product ids
+            for product in self.products:
+                search_keyword = build_dataforseo_keyword(product)
+                if search_keyword:
+                    self.keywords[product['id']] = search_keyword
+                    queries.setdefault(web_search_cache.make_key('dataforseo', search_keyword), []).append(product['id'])
+                else:
+                    logger.warning("DataForSEO: no search keyword available")
+                    self.settle(product['id'], (None, []))
+            
+            # Queries already searched (by this or another user) are not posted again
+            cached = await web_search_cache.get_many('dataforseo', [self.keywords[ids[0]] for ids in queries.values()])
+            uncached = {}
+            for key, product_ids in queries.items():
+                search_keyword = self.keywords[product_ids[0]]
+                if search_keyword in cached:
+                    self.settle_group(product_ids, cached[search_keyword])
+                else:
+                    self.groups[product_ids[0]] = product_ids
+                    uncached[key] = product_ids[0]
+            
+            # ... nor are the queries whose task is already queued
+            pending: Dict[str, str] = {}  # task_id -> tag
+            for key, task in (await lookup_dataforseo_tasks(self.user_id, list(uncached))).items():
+                pending[task['task_id']] = uncached.pop(key)
+            reused = set(pending)
+            
+            tags = list(uncached.values())
+            self.posted_at = time.monotonic()
+            posts = await asyncio.gather(*(
+                self.post_tasks(tags[start:start + DATAFORSEO_TASKS_PER_POST])
+                for start in range(0, len(tags), DATAFORSEO_TASKS_PER_POST)
+            ), return_exceptions=True)
+            for created in posts:
+                if isinstance(created, Exception):
+                    logger.warning(f"DataForSEO task_post error: {created}")
+                    continue
+                self.posted.update(created)
+                pending.update(created)
+                await record_dataforseo_tasks(
+                    self.user_id, self.job_id, {task_id: self.keywords[tag] for task_id, tag in created.items()}
+                )
+            logger.info(f"DataForSEO standard queue: {len(self.posted)}/{len(tags)} tasks posted, {len(reused)} already queued, for {len(self.products)} products ({len(cached)} queries cached)")
+            # Products whose task was not created are searched live right away
+            queued = set(pending.values())
+            for tag in tags:
+                if tag not in queued:
+                    self.settle_group(self.groups[tag], None)
+            
+            # Next direct task_get of each task: right away for tasks posted earlier, else after the usual latency
+            started = time.monotonic()
+            expected_at = started + get_provider_latency('dataforseo_queue')
+            check_at = {task_id: started if task_id in reused else expected_at for task_id in pending}
+            deadline = started + DATAFORSEO_QUEUE_TIMEOUT_SECONDS
+            while pending and time.monotonic() < deadline:
+                await asyncio.sleep(DATAFORSEO_POLL_SECONDS)
+                ready = await self.fetch_ready_ids()
+                now = time.monotonic()
+                due = [task_id for task_id in pending if task_id in ready or check_at[task_id] <= now]
+                collected = await asyncio.gather(*(self.collect(task_id, pending[task_id]) for task_id in due))
+                for task_id, done in zip(due, collected):
+                    if done:
+                        del pending[task_id]
+                    else:
+                        check_at[task_id] = now + DATAFORSEO_TASK_GET_SECONDS
+            if pending:
+                logger.warning(f"DataForSEO standard queue: {len(pending)} tasks not ready after {DATAFORSEO_QUEUE_TIMEOUT_SECONDS:.0f}s")
+        except Exception as e:
+            logger.warning(f"DataForSEO standard queue error: {e}")
+        finally:
+            self.settle_pending()
+
+
+async def drain_dataforseo_tasks() -> int:
+    """
+    Collect recorded tasks nobody waits for any more (timed out, cancelled or interrupted runs).
+    
+    Their results go to web_search_cache, and task_get takes them off the account's
+    tasks_ready list, which they would otherwise fill up. Returns the number collected.
+    """
+    posted_before = datetime.now(timezone.utc) - timedelta(seconds=DATAFORSEO_QUEUE_TIMEOUT_SECONDS)
+    tasks = await db.dataforseo_tasks.find(
+        {'posted_at': {'$lt': posted_before}}, {'_id': 0}
+    ).sort('posted_at', 1).to_list(DATAFORSEO_DRAIN_LIMIT)
+    by_user: Dict[str, List[dict]] = {}
+    for task in tasks:
+        by_user.setdefault(task['user_id'], []).append(task)
+    
+    collected = []
+    for user_id, user_tasks in by_user.items():
+        user = await db.users.find_one({'id': user_id}, {'_id': 0, 'api_keys': 1})
+        api_keys = (user or {}).get('api_keys') or {}
+        if not (api_keys.get('dataforseo_login') and api_keys.get('dataforseo_password')):
+            # No credentials to collect them with any more
+            await forget_dataforseo_tasks([task['task_id'] for task in user_tasks])
+            continue
+        headers = build_dataforseo_headers(api_keys['dataforseo_login'], api_keys['dataforseo_password'])
+        for task in user_tasks:
+            try:
+                done, google_suppliers = await get_dataforseo_task(headers, task['task_id'], task['keyword'])
+            except Exception as e:
+                logger.warning(f"DataForSEO task_get error for task {task['task_id']}: {e}")
+                continue
+            if done:
+                if google_suppliers is not None:
+                    await web_search_cache.set('dataforseo', task['keyword'], google_suppliers)
+                collected.append(task['task_id'])
+    await forget_dataforseo_tasks(collected)
+    if collected:
+        logger.info(f"DataForSEO standard queue: collected {len(collected)} abandoned tasks")
+    return len(collected)
 
 
 @api_router.post("/catalog/compare/{product_id}")
 async def compare_catalog_product(
     product_id: str,
+    race: bool = False,
     user: dict = Depends(get_current_user)
 ):
     """Compare a single catalog product: Keepa (Amazon) + Google (lowest price online).
@@ -2525,494 +4432,1794 @@ async def compare_catalog_product(
     - Google lowest price (cheapest online)
     - Cheapest source between supplier and Google
     - Amazon margin = Amazon price - buy price - Amazon fees (15% TTC)
-    """
-    product = await db.catalog_products.find_one({
-        'id': product_id,
-        'user_id': user['id']
-    }, {'_id': 0})
     
-    if not product:
-        raise HTTPException(status_code=404, detail="Product not found")
+    race=true queries the Amazon domains concurrently (interactive use).
+    """
+    return await run_catalog_comparison(product_id, user, race=race)
+
+
+class CompareContext:
+    """Settings shared by every product of a compare run: user doc, API keys and Keepa prefetch.
+
+    Built once per request (or job) from the user document that get_current_user
+    already loaded, instead of reloading it for every product.
+    """
+
+    def __init__(self, user: dict, race: bool = False, concurrency: Optional[int] = None, dataforseo_queue: bool = False):
+        self.user = user
+        api_keys = user.get('api_keys', {}) or {}
+        self.keepa_key = api_keys.get('keepa_api_key')
+        self.google_key = api_keys.get('google_api_key')
+        self.google_cx = api_keys.get('google_search_engine_id')
+        self.dataforseo_login = api_keys.get('dataforseo_login')
+        self.dataforseo_password = api_keys.get('dataforseo_password')
+        self.use_google_shopping = user.get('use_google_shopping', False)
+        self.race = race
+        self.concurrency = resolve_compare_concurrency(concurrency)
+        # Batch-resolved {gtin: (keepa_product, domain_info)}, None when the GTINs were not prefetched
+        self.keepa_prefetch: Optional[Dict[str, tuple]] = None
+        # GTINs the batch cascade could not look up (rate limit, error): searched per product by GTIN
+        self.keepa_not_looked_up: set = set()
+        # {gtin: {domain_id: keepa_product or None}} for the domains the batch cascade knows the result of
+        self.keepa_contexts: Dict[str, dict] = {}
+        # Google Shopping searches through the DataForSEO standard queue instead of the live endpoint
+        self.dataforseo_queue = dataforseo_queue
+        self.dataforseo_batch: Optional[DataForSEOQueueBatch] = None
+
+    @property
+    def use_dataforseo(self) -> bool:
+        return bool(self.use_google_shopping and self.dataforseo_login and self.dataforseo_password)
+
+    @property
+    def use_custom_search(self) -> bool:
+        return bool(self.google_key and self.google_cx)
+
+    @property
+    def has_api_keys(self) -> bool:
+        return bool(self.keepa_key) or self.use_custom_search or self.use_dataforseo
+
+
+class ProductComparison:
+    """State of one product as it moves through the compare stages"""
+
+    def __init__(self, product: dict):
+        self.product = product
+        self.product_id = product['id']
+        self.supplier_price = product['supplier_price_eur']
+        self.amazon_price = None
+        self.amazon_price_local = None  # Amazon price in the currency of its marketplace
+        self.amazon_currency = None
+        self.keepa_product = None  # Keepa product data for trend analysis
+        self.found_domain_info = None
+        self.keepa_context = {}  # {domain_id: keepa_product or None} already known for this product
+        self.google_lowest_price = None
+        self.google_suppliers = []  # All Google suppliers with details
+        self.search_source = None  # Which web search was used
+        self.price_trend: Optional[dict] = None  # Set by the trend stage (see analyze_price_trends)
+        self.is_mock_data = False
+        self.update_data: Optional[dict] = None
+        self.result: Optional[dict] = None
+
+
+def build_keepa_search_term(product: dict) -> str:
+    """Search term for the Keepa name search fallback: brand + name, at most ~50 characters"""
+    brand_part = product.get('brand', '')
+    name_part = product.get('name', '')
+    
+    # Avoid duplicates: if brand is already in the name, don't duplicate it
+    if brand_part and brand_part != 'Non spécifié' and brand_part.lower() not in name_part.lower():
+        search_term = f"{brand_part} {name_part}".strip()
+    else:
+        search_term = name_part.strip()
     
-    # Get API keys
-    user_doc = await db.users.find_one({'id': user['id']}, {'_id': 0})
-    api_keys = user_doc.get('api_keys', {})
-    keepa_key = api_keys.get('keepa_api_key')
-    google_key = api_keys.get('google_api_key')
-    google_cx = api_keys.get('google_search_engine_id')
-    dataforseo_login = api_keys.get('dataforseo_login')
-    dataforseo_password = api_keys.get('dataforseo_password')
-    use_google_shopping = user_doc.get('use_google_shopping', False)
+    # Simplify search term: take only first 50 characters to avoid being too specific
+    if len(search_term) > 50:
+        search_term = search_term[:50].rsplit(' ', 1)[0]  # Cut at last word boundary
     
-    supplier_price = product['supplier_price_eur']
-    amazon_price = None
-    google_lowest_price = None
-    is_mock_data = False
-    keepa_product = None  # Store Keepa product data for trend analysis
+    logger.info(f"Keepa search term built: '{search_term}' (from brand='{brand_part}', name='{name_part}')")
+    return search_term
+
+
+def mark_lowest_google_supplier(google_suppliers: List[dict]) -> Optional[float]:
+    """Flag the first cheapest supplier as lowest and return its price (None without suppliers)"""
+    if not google_suppliers:
+        return None
+    lowest_price = min(s['price'] for s in google_suppliers)
+    for supplier in google_suppliers:
+        if supplier['price'] == lowest_price:
+            supplier['is_lowest'] = True
+            break  # Only mark the first one as lowest
+    return lowest_price
+
+
+def parse_google_search_items(items: List[dict]) -> List[dict]:
+    """Extract one supplier (lowest price found) per Google Custom Search result"""
+    google_suppliers = []
+    for item in items:
+        # Extract basic info
+        item_url = item.get('link', '')
+        snippet = item.get('snippet', '')
+        title = item.get('title', '')
+        
+        # Check if this is an Amazon URL (no longer filtered - user wants to see Amazon results)
+        item_is_amazon = is_amazon_url(item_url)
+        
+        # Extract supplier name from URL
+        supplier_name = extract_supplier_name_from_url(item_url)
+        if item_is_amazon:
+            supplier_name = "Amazon"
+        
+        # Try to find price for this item
+        item_prices = []
+        
+        # Check pagemap for structured pricing data
+        pagemap = item.get('pagemap', {})
+        offers = pagemap.get('offer', [])
+        for offer in offers:
+            price_str = offer.get('price', '')
+            try:
+                price = float(price_str.replace(',', '.'))
+                if 0.01 < price < 100000:
+                    item_prices.append(price)
+                    logger.info(f"Google: found price {price} in offer data for {supplier_name}")
+            except (ValueError, AttributeError):
+                pass
+        
+        # Try product structured data
+        products_data = pagemap.get('product', [])
+        for prod in products_data:
+            price_str = prod.get('price', '')
+            try:
+                price = float(price_str.replace(',', '.'))
+                if 0.01 < price < 100000:
+                    item_prices.append(price)
+                    logger.info(f"Google: found price {price} in product data for {supplier_name}")
+            except (ValueError, AttributeError):
+                pass
+        
+        # Extract from snippet text
+        snippet_price = extract_price_from_text(snippet)
+        if snippet_price:
+            item_prices.append(snippet_price)
+            logger.info(f"Google: found price {snippet_price} in snippet for {supplier_name}")
+        
+        # Extract from title
+        title_price = extract_price_from_text(title)
+        if title_price:
+            item_prices.append(title_price)
+            logger.info(f"Google: found price {title_price} in title for {supplier_name}")
+        
+        # If we found at least one price for this item, add it to results
+        if item_prices:
+            item_price = min(item_prices)  # Take lowest price for this supplier
+            google_suppliers.append({
+                'supplier_name': supplier_name,
+                'url': item_url,
+                'price': round(item_price, 2),
+                'is_lowest': False,  # Will be set later
+                'is_amazon': item_is_amazon  # Flag Amazon results
+            })
+    return google_suppliers
+
+
+def parse_google_image_items(items: List[dict]) -> List[dict]:
+    """Extract one supplier per Google image search result, from the page title and snippet"""
+    google_suppliers = []
+    for item in items:
+        # For image search, the 'image' object contains contextLink (page URL)
+        context_link = item.get('image', {}).get('contextLink', '')
+        if not context_link:
+            continue
+        
+        snippet = item.get('snippet', '')
+        title = item.get('title', '')
+        
+        item_is_amazon = is_amazon_url(context_link)
+        supplier_name = extract_supplier_name_from_url(context_link)
+        if item_is_amazon:
+            supplier_name = "Amazon"
+        
+        # Try to extract prices from title and snippet
+        item_prices = []
+        snippet_price = extract_price_from_text(snippet)
+        if snippet_price:
+            item_prices.append(snippet_price)
+        title_price = extract_price_from_text(title)
+        if title_price:
+            item_prices.append(title_price)
+        
+        if item_prices:
+            item_price = min(item_prices)
+            google_suppliers.append({
+                'supplier_name': supplier_name,
+                'url': context_link,
+                'price': round(item_price, 2),
+                'is_lowest': False,
+                'is_amazon': item_is_amazon,
+                'source': 'image_search'
+            })
+    return google_suppliers
+
+
+# ==================== COMPARE STAGES ====================
+# resolve → fetch Amazon → fetch web prices → price trends → analyze → persist.
+# Each stage runs over every product of the batch before the next one starts.
+
+async def resolve_compare_products(ctx: CompareContext, product_ids: List[str], prefetch: bool) -> tuple:
+    """
+    Stage 1: load the products in one query and, for batches, resolve their GTINs on Keepa together.
     
-    # ==================== KEEPA API (Amazon price) - MULTI-DOMAIN ====================
-    found_domain_info = None
-    if keepa_key:
-        try:
-            async with httpx.AsyncClient() as http_client:
-                # Build search term for fallback name search
-                brand_part = product.get('brand', '')
-                name_part = product.get('name', '')
-                
-                # Avoid duplicates: if brand is already in the name, don't duplicate it
-                if brand_part and brand_part != 'Non spécifié' and brand_part.lower() not in name_part.lower():
-                    search_term = f"{brand_part} {name_part}".strip()
-                else:
-                    search_term = name_part.strip()
-                
-                # Simplify search term: take only first 50 characters to avoid being too specific
-                if len(search_term) > 50:
-                    search_term = search_term[:50].rsplit(' ', 1)[0]  # Cut at last word boundary
-                
-                logger.info(f"Keepa search term built: '{search_term}' (from brand='{brand_part}', name='{name_part}')")
-                
-                # Multi-domain search: tries FR first, then DE, IT, ES, UK, US
-                keepa_product, found_domain_info = await search_keepa_product_multi_domain(
-                    http_client=http_client,
-                    keepa_key=keepa_key,
-                    gtin=product.get('gtin'),
-                    search_term=search_term,
-                    primary_domain=4  # Amazon.fr first
-                )
-                
-                # Extract price from found product
-                if keepa_product:
-                    local_price = extract_keepa_price(keepa_product)
-                    if local_price is not None:
-                        # Convert to EUR if needed
-                        exchange_rate = found_domain_info.get('exchange_rate', 1.0) if found_domain_info else 1.0
-                        amazon_price = round(local_price * exchange_rate, 2)
-                        logger.info(f"Keepa final Amazon price for {product['name']}: €{amazon_price} (from {found_domain_info.get('name', 'unknown')})")
-                    else:
-                        logger.info(f"Keepa: product found but no valid price for {product['name']}")
-                else:
-                    logger.info(f"Keepa: no products found for {product['name']} on any domain")
-                    
-        except Exception as e:
-            logger.warning(f"Keepa API error for {product['gtin']}: {e}")
+    Returns:
+        tuple: ({product_id: ProductComparison}, {product_id: exception} for unknown products)
+    """
+    products = await db.catalog_products.find(
+        {'id': {'$in': list(dict.fromkeys(product_ids))}, 'user_id': ctx.user['id']},
+        {'_id': 0}
+    ).to_list(None)
+    items = {product['id']: ProductComparison(product) for product in products}
+    failures = {
+        product_id: HTTPException(status_code=404, detail="Product not found")
+        for product_id in product_ids if product_id not in items
+    }
     
-    # ==================== GOOGLE SHOPPING / GOOGLE CUSTOM SEARCH ====================
-    google_suppliers = []  # List to store all Google suppliers with details
-    search_source = None  # Track which search was used
+    if prefetch:
+        # Resolve all GTINs on Keepa in 100-code batches before comparing
+        ctx.keepa_prefetch, ctx.keepa_not_looked_up, ctx.keepa_contexts = await prefetch_keepa_products(ctx.user, products)
+    return items, failures
+
+
+async def fetch_amazon_price(ctx: CompareContext, item: ProductComparison):
+    """Stage 2: Keepa product (prefetched, indexed or searched across domains) and its price in EUR"""
+    if not ctx.keepa_key:
+        return
+    product = item.product
+    try:
+        search_term = build_keepa_search_term(product)
+        gtin = product.get('gtin')
+        
+        if ctx.keepa_prefetch is not None and gtin in ctx.keepa_prefetch:
+            # Already resolved by the batch GTIN cascade
+            item.keepa_product, item.found_domain_info = ctx.keepa_prefetch[gtin]
+            item.keepa_context = dict(ctx.keepa_contexts.get(gtin, {}))
+        else:
+            # The batch cascade missed this GTIN on every domain (not when it could not look it up)
+            cascade_missed = ctx.keepa_prefetch is not None and bool(gtin) and gtin not in ctx.keepa_not_looked_up
+            if cascade_missed:
+                item.keepa_context = dict(ctx.keepa_contexts.get(gtin, {}))
+            # Multi-domain search: tries FR first, then DE, IT, ES, UK, US
+            # (GTIN already tried on every domain by the batch cascade -> keyword search only)
+            item.keepa_product, item.found_domain_info = await search_keepa_product_multi_domain(
+                keepa_key=ctx.keepa_key,
+                gtin=gtin,
+                search_term=search_term,
+                primary_domain=4,  # Amazon.fr first
+                race=ctx.race,
+                context=item.keepa_context,
+                gtin_lookup=not cascade_missed
+            )
+        
+        # Extract price from found product
+        if item.keepa_product:
+            local_price = extract_keepa_price(item.keepa_product)
+            if local_price is not None:
+                # Convert to EUR if needed
+                exchange_rate = item.found_domain_info.get('exchange_rate', 1.0) if item.found_domain_info else 1.0
+                item.amazon_price = round(local_price * exchange_rate, 2)
+                item.amazon_price_local = local_price
+                item.amazon_currency = item.found_domain_info.get('currency', 'EUR') if item.found_domain_info else 'EUR'
+                logger.info(f"Keepa final Amazon price for {product['name']}: €{item.amazon_price} (from {item.found_domain_info.get('name', 'unknown')})")
+            else:
+                logger.info(f"Keepa: product found but no valid price for {product['name']}")
+        else:
+            logger.info(f"Keepa: no products found for {product['name']} on any domain")
+            
+    except Exception as e:
+        logger.warning(f"Keepa API error for {product['gtin']}: {e}")
+
+
+async def fetch_google_search_suppliers(ctx: CompareContext, query: str, image: bool = False) -> Optional[List[dict]]:
+    """Suppliers parsed from one Google Custom Search query (image search with image=True); None when it failed"""
+    params = {
+        "key": ctx.google_key,
+        "cx": ctx.google_cx,
+        "q": query,
+        "num": 10
+    }
+    if image:
+        params["searchType"] = "image"
+    search_name = 'Google Image Search' if image else 'Google'
+    response = await provider_request('google', 'GET', "https://www.googleapis.com/customsearch/v1", params=params)
+    logger.info(f"{search_name} API response status: {response.status_code}")
+    
+    if response.status_code != 200:
+        logger.warning(f"{search_name} API HTTP {response.status_code}: {response.text[:300]}")
+        return None
+    items = response.json().get('items', [])
+    logger.info(f"{search_name} returned {len(items)} items")
+    parser = parse_google_image_items if image else parse_google_search_items
+    return parser(items)
+
+
+async def fetch_web_prices(ctx: CompareContext, item: ProductComparison):
+    """Stage 3: lowest web prices, from DataForSEO Google Shopping or Google Custom Search (+ image search)"""
+    product = item.product
     
     # Branch 1: DataForSEO Google Shopping (if enabled and credentials available)
-    if use_google_shopping and dataforseo_login and dataforseo_password:
+    if ctx.use_dataforseo:
         logger.info(f"Using DataForSEO Google Shopping for {product['name']}")
-        search_source = 'google_shopping'
-        google_lowest_price, google_suppliers = await search_google_shopping_dataforseo(
-            product, dataforseo_login, dataforseo_password
-        )
+        item.search_source = 'google_shopping'
+        queued = await ctx.dataforseo_batch.result(item.product_id) if ctx.dataforseo_batch else None
+        if queued is not None:
+            item.google_lowest_price, item.google_suppliers = queued
+        else:
+            item.google_lowest_price, item.google_suppliers = await search_google_shopping_dataforseo(
+                product, ctx.dataforseo_login, ctx.dataforseo_password
+            )
     
     # Branch 2: Google Custom Search (default)
-    elif google_key and google_cx:
+    elif ctx.use_custom_search:
         try:
             search_query = f"{product['brand']} {product['name']} prix"
             logger.info(f"Google search query: {search_query}")
-            async with httpx.AsyncClient() as http_client:
-                response = await http_client.get(
-                    "https://www.googleapis.com/customsearch/v1",
-                    params={
-                        "key": google_key,
-                        "cx": google_cx,
-                        "q": search_query,
-                        "num": 10
-                    },
-                    timeout=30
-                )
-                logger.info(f"Google API response status: {response.status_code}")
+            google_suppliers = await web_search_cache.fetch(
+                'cse', search_query, lambda: fetch_google_search_suppliers(ctx, search_query)
+            )
+            
+            if google_suppliers is not None:
+                item.google_suppliers = google_suppliers
                 
-                if response.status_code == 200:
-                    data = response.json()
-                    items = data.get('items', [])
-                    logger.info(f"Google returned {len(items)} items")
-                    
-                    for item in items:
-                        # Extract basic info
-                        item_url = item.get('link', '')
-                        snippet = item.get('snippet', '')
-                        title = item.get('title', '')
-                        
-                        # Check if this is an Amazon URL (no longer filtered - user wants to see Amazon results)
-                        item_is_amazon = is_amazon_url(item_url)
-                        
-                        # Extract supplier name from URL
-                        supplier_name = extract_supplier_name_from_url(item_url)
-                        if item_is_amazon:
-                            supplier_name = "Amazon"
-                        
-                        # Try to find price for this item
-                        item_prices = []
-                        
-                        # Check pagemap for structured pricing data
-                        pagemap = item.get('pagemap', {})
-                        offers = pagemap.get('offer', [])
-                        for offer in offers:
-                            price_str = offer.get('price', '')
-                            try:
-                                price = float(price_str.replace(',', '.'))
-                                if 0.01 < price < 100000:
-                                    item_prices.append(price)
-                                    logger.info(f"Google: found price {price} in offer data for {supplier_name}")
-                            except (ValueError, AttributeError):
-                                pass
-                        
-                        # Try product structured data
-                        products_data = pagemap.get('product', [])
-                        for prod in products_data:
-                            price_str = prod.get('price', '')
-                            try:
-                                price = float(price_str.replace(',', '.'))
-                                if 0.01 < price < 100000:
-                                    item_prices.append(price)
-                                    logger.info(f"Google: found price {price} in product data for {supplier_name}")
-                            except (ValueError, AttributeError):
-                                pass
-                        
-                        # Extract from snippet text
-                        snippet_price = extract_price_from_text(snippet)
-                        if snippet_price:
-                            item_prices.append(snippet_price)
-                            logger.info(f"Google: found price {snippet_price} in snippet for {supplier_name}")
-                        
-                        # Extract from title
-                        title_price = extract_price_from_text(title)
-                        if title_price:
-                            item_prices.append(title_price)
-                            logger.info(f"Google: found price {title_price} in title for {supplier_name}")
-                        
-                        # If we found at least one price for this item, add it to results
-                        if item_prices:
-                            item_price = min(item_prices)  # Take lowest price for this supplier
-                            google_suppliers.append({
-                                'supplier_name': supplier_name,
-                                'url': item_url,
-                                'price': round(item_price, 2),
-                                'is_lowest': False,  # Will be set later
-                                'is_amazon': item_is_amazon  # Flag Amazon results
-                            })
-                    
-                    # Mark the lowest price supplier
-                    if google_suppliers:
-                        lowest_price = min(s['price'] for s in google_suppliers)
-                        google_lowest_price = lowest_price
-                        for supplier in google_suppliers:
-                            if supplier['price'] == lowest_price:
-                                supplier['is_lowest'] = True
-                                break  # Only mark the first one as lowest
-                        
-                        logger.info(f"Google found {len(google_suppliers)} suppliers for {product['name']}, lowest price: €{google_lowest_price}")
-                    else:
-                        logger.info(f"Google: no prices found in search results for {product['name']}")
+                # Mark the lowest price supplier
+                if item.google_suppliers:
+                    item.google_lowest_price = mark_lowest_google_supplier(item.google_suppliers)
+                    logger.info(f"Google found {len(item.google_suppliers)} suppliers for {product['name']}, lowest price: €{item.google_lowest_price}")
                 else:
-                    logger.warning(f"Google API HTTP {response.status_code}: {response.text[:300]}")
+                    logger.info(f"Google: no prices found in search results for {product['name']}")
         except Exception as e:
             logger.warning(f"Google API error for {product['name']}: {e}")
     else:
-        logger.info(f"Google search skipped: google_key={bool(google_key)}, google_cx={bool(google_cx)}, dataforseo={bool(dataforseo_login)}, use_shopping={use_google_shopping}")
+        logger.info(f"Google search skipped: google_key={bool(ctx.google_key)}, google_cx={bool(ctx.google_cx)}, dataforseo={bool(ctx.dataforseo_login)}, use_shopping={ctx.use_google_shopping}")
     
-    # ==================== GOOGLE IMAGE SEARCH (if product has image_url, only for Custom Search mode) ====================
-    if not use_google_shopping and google_key and google_cx and product.get('image_url') and not google_suppliers:
+    # Google image search (if product has image_url, only for Custom Search mode)
+    if not ctx.use_google_shopping and ctx.use_custom_search and product.get('image_url') and not item.google_suppliers:
         try:
             image_url = product['image_url']
             logger.info(f"Google Image Search for {product['name']} with image: {image_url}")
-            async with httpx.AsyncClient() as http_client:
-                # Use Google Custom Search with the image URL as a search term
-                # Google CSE doesn't support reverse image search directly,
-                # but we can search with the product name + image context
-                image_search_query = f"{product['brand']} {product['name']}"
-                response = await http_client.get(
-                    "https://www.googleapis.com/customsearch/v1",
-                    params={
-                        "key": google_key,
-                        "cx": google_cx,
-                        "q": image_search_query,
-                        "searchType": "image",
-                        "num": 10
-                    },
-                    timeout=30
-                )
-                logger.info(f"Google Image Search API response status: {response.status_code}")
+            # Use Google Custom Search with the image URL as a search term
+            # Google CSE doesn't support reverse image search directly,
+            # but we can search with the product name + image context
+            image_search_query = f"{product['brand']} {product['name']}"
+            image_suppliers = await web_search_cache.fetch(
+                'cse_image', image_search_query, lambda: fetch_google_search_suppliers(ctx, image_search_query, image=True)
+            )
+            
+            if image_suppliers is not None:
+                item.google_suppliers.extend(image_suppliers)
                 
-                if response.status_code == 200:
-                    data = response.json()
-                    items = data.get('items', [])
-                    logger.info(f"Google Image Search returned {len(items)} items")
-                    
-                    for item in items:
-                        # For image search, the 'image' object contains contextLink (page URL)
-                        context_link = item.get('image', {}).get('contextLink', '')
-                        if not context_link:
-                            continue
-                        
-                        snippet = item.get('snippet', '')
-                        title = item.get('title', '')
-                        
-                        item_is_amazon = is_amazon_url(context_link)
-                        supplier_name = extract_supplier_name_from_url(context_link)
-                        if item_is_amazon:
-                            supplier_name = "Amazon"
-                        
-                        # Try to extract prices from title and snippet
-                        item_prices = []
-                        snippet_price = extract_price_from_text(snippet)
-                        if snippet_price:
-                            item_prices.append(snippet_price)
-                        title_price = extract_price_from_text(title)
-                        if title_price:
-                            item_prices.append(title_price)
-                        
-                        if item_prices:
-                            item_price = min(item_prices)
-                            google_suppliers.append({
-                                'supplier_name': supplier_name,
-                                'url': context_link,
-                                'price': round(item_price, 2),
-                                'is_lowest': False,
-                                'is_amazon': item_is_amazon,
-                                'source': 'image_search'
-                            })
-                    
-                    # Update lowest price if we found suppliers via image search
-                    if google_suppliers:
-                        lowest_price = min(s['price'] for s in google_suppliers)
-                        google_lowest_price = lowest_price
-                        for supplier in google_suppliers:
-                            if supplier['price'] == lowest_price:
-                                supplier['is_lowest'] = True
-                                break
-                        logger.info(f"Google Image Search found {len(google_suppliers)} suppliers for {product['name']}, lowest: €{google_lowest_price}")
+                # Update lowest price if we found suppliers via image search
+                if item.google_suppliers:
+                    item.google_lowest_price = mark_lowest_google_supplier(item.google_suppliers)
+                    logger.info(f"Google Image Search found {len(item.google_suppliers)} suppliers for {product['name']}, lowest: €{item.google_lowest_price}")
         except Exception as e:
             logger.warning(f"Google Image Search error for {product['name']}: {e}")
+
+
+class ComparisonInput(NamedTuple):
+    """Compact, picklable input of compute_comparison"""
+    supplier_price: float
+    amazon_price: Optional[float]
+    google_lowest_price: Optional[float]
+    google_suppliers_count: int
+    price_trend: Optional[dict]  # See analyze_price_trends
+
+
+def trim_keepa_csv(keepa_product: dict) -> Optional[list]:
+    """The Keepa csv with only the series the trend analysis can pick (others set to None)"""
+    csv_data = keepa_product.get('csv')
+    if not csv_data:
+        return csv_data
+    wanted = set(KEEPA_TREND_CSV_INDICES)
+    return [series if idx in wanted else None for idx, series in enumerate(csv_data[:max(wanted) + 1])]
+
+
+def compute_comparison(record: ComparisonInput) -> dict:
+    """
+    CPU part of the analysis stage: margins, opportunity score and predictions.
     
-    # ==================== MOCK DATA FALLBACK ====================
-    has_api_keys = bool(keepa_key) or bool(google_key and google_cx) or bool(use_google_shopping and dataforseo_login and dataforseo_password)
-    
-    if amazon_price is None and google_lowest_price is None and not has_api_keys:
-        # No API keys configured at all → use mock data for demo
-        mock_prices = generate_mock_catalog_prices(product)
-        amazon_price = mock_prices['amazon_price']
-        google_lowest_price = mock_prices['google_lowest_price']
-        is_mock_data = True
-        logger.info(f"Using mock prices for {product['name']} (no API keys): Amazon=€{amazon_price}, Google=€{google_lowest_price}")
-    elif amazon_price is None and google_lowest_price is None and has_api_keys:
-        # API keys configured but no prices found → product not found on APIs
-        is_mock_data = False
-        logger.info(f"No prices found via APIs for {product['name']} (GTIN: {product['gtin']})")
-    else:
-        is_mock_data = False
-    
-    # ==================== PRICE TREND ANALYSIS ====================
-    price_trend = None
-    if keepa_product and amazon_price:
-        price_trend = analyze_keepa_price_trends(keepa_product, amazon_price)
-        if price_trend:
-            logger.info(f"Price trend analysis for {product['name']}: trend={price_trend['trend']}, volatility={price_trend['volatility']}%, favorable={price_trend['is_favorable']}")
+    Pure function of its record; the trend is analyzed beforehand for the whole batch.
+    """
+    amazon_price = record.amazon_price
+    google_lowest_price = record.google_lowest_price
+    supplier_price = record.supplier_price
+    price_trend = record.price_trend
     
     # ==================== CALCULATE COMPARISONS ====================
     
     # Amazon fees (15% TTC) - only if amazon price is available
     amazon_fees = calculate_amazon_fees(amazon_price) if amazon_price else None
     
-    # Cheapest source between supplier and Google
-    if google_lowest_price is not None and google_lowest_price <= supplier_price:
-        cheapest_source = "google"
-        cheapest_buy_price = google_lowest_price
-    else:
-        cheapest_source = "supplier"
-        cheapest_buy_price = supplier_price
+    # Cheapest source between supplier and Google
+    if google_lowest_price is not None and google_lowest_price <= supplier_price:
+        cheapest_source = "google"
+        cheapest_buy_price = google_lowest_price
+    else:
+        cheapest_source = "supplier"
+        cheapest_buy_price = supplier_price
+    
+    # Margin if buying from SUPPLIER and selling on Amazon
+    supplier_margin = calculate_margin(amazon_price, supplier_price, amazon_fees) if amazon_price else {'margin_eur': None, 'margin_percentage': None}
+    
+    # Margin if buying from GOOGLE and selling on Amazon
+    google_margin = calculate_margin(amazon_price, google_lowest_price, amazon_fees) if (amazon_price and google_lowest_price) else {'margin_eur': None, 'margin_percentage': None}
+    
+    # Best margin (from cheapest source)
+    best_margin = calculate_margin(amazon_price, cheapest_buy_price, amazon_fees) if amazon_price else {'margin_eur': None, 'margin_percentage': None}
+    
+    # Price differences
+    google_vs_amazon_diff = round(google_lowest_price - amazon_price, 2) if (google_lowest_price and amazon_price) else None
+    supplier_vs_google_diff = round(supplier_price - google_lowest_price, 2) if google_lowest_price else None
+    
+    # ==================== OPPORTUNITY SCORE ====================
+    opportunity = calculate_opportunity_score(
+        margin_eur=best_margin['margin_eur'],
+        margin_percentage=best_margin['margin_percentage'],
+        price_trend=price_trend,
+        google_suppliers_count=record.google_suppliers_count,
+        amazon_price=amazon_price,
+        supplier_price=supplier_price
+    )
+    
+    # ==================== PROFITABILITY PREDICTIONS ====================
+    profitability_predictions = None
+    if price_trend and amazon_price:
+        profitability_predictions = predict_price_profitability(
+            price_trend=price_trend,
+            amazon_price=amazon_price,
+            supplier_price=cheapest_buy_price
+        )
+    
+    return {
+        'price_trend': price_trend,
+        'amazon_fees': amazon_fees,
+        'cheapest_source': cheapest_source,
+        'cheapest_buy_price': cheapest_buy_price,
+        'supplier_margin': supplier_margin,
+        'google_margin': google_margin,
+        'best_margin': best_margin,
+        'google_vs_amazon_diff': google_vs_amazon_diff,
+        'supplier_vs_google_diff': supplier_vs_google_diff,
+        'opportunity': opportunity,
+        'profitability_predictions': profitability_predictions
+    }
+
+
+async def load_trend_history(item: ProductComparison) -> Optional[tuple]:
+    """(keepa minutes, prices) of the stored price history of the item's Keepa product, if any"""
+    if not item.keepa_product.get('asin') or not item.found_domain_info:
+        return None
+    history = await load_keepa_price_history(item.keepa_product['asin'], item.found_domain_info['domain'])
+    return (history['minutes'], history['prices']) if history is not None else None
+
+
+async def analyze_price_trends(ctx: CompareContext, items: List[ProductComparison]) -> list:
+    """Stage 4 (whole batch): price trends of the products with a priced Keepa product, in one vectorized pass"""
+    analyzed = [item for item in items if item.keepa_product and item.amazon_price]
+    if not analyzed:
+        return [None] * len(items)
+    histories = await map_bounded(load_trend_history, analyzed, ctx.concurrency)
+    inputs = []
+    for item, history in zip(analyzed, histories):
+        if isinstance(history, Exception):
+            logger.error(f"Error loading stored Keepa price history: {history}")
+            history = None
+        inputs.append((history, trim_keepa_csv(item.keepa_product), item.amazon_price))
+    trends = await run_analysis(analyze_price_trends_batch, inputs, items=len(inputs))
+    for item, price_trend in zip(analyzed, trends):
+        item.price_trend = price_trend
+    return [None] * len(items)
+
+
+async def analyze_comparison(ctx: CompareContext, item: ProductComparison):
+    """Stage 5: mock fallback, margins, opportunity score, predictions and arbitrage"""
+    product = item.product
+    supplier_price = item.supplier_price
+    
+    # ==================== MOCK DATA FALLBACK ====================
+    if item.amazon_price is None and item.google_lowest_price is None and not ctx.has_api_keys:
+        # No API keys configured at all → use mock data for demo
+        mock_prices = generate_mock_catalog_prices(product)
+        item.amazon_price = mock_prices['amazon_price']
+        item.google_lowest_price = mock_prices['google_lowest_price']
+        item.is_mock_data = True
+        logger.info(f"Using mock prices for {product['name']} (no API keys): Amazon=€{item.amazon_price}, Google=€{item.google_lowest_price}")
+    elif item.amazon_price is None and item.google_lowest_price is None and ctx.has_api_keys:
+        # API keys configured but no prices found → product not found on APIs
+        item.is_mock_data = False
+        logger.info(f"No prices found via APIs for {product['name']} (GTIN: {product['gtin']})")
+    else:
+        item.is_mock_data = False
+    
+    amazon_price = item.amazon_price
+    google_lowest_price = item.google_lowest_price
+    google_suppliers = item.google_suppliers
+    found_domain_info = item.found_domain_info
+    
+    computed = compute_comparison(ComparisonInput(
+        supplier_price=supplier_price,
+        amazon_price=amazon_price,
+        google_lowest_price=google_lowest_price,
+        google_suppliers_count=len(google_suppliers) if google_suppliers else 0,
+        price_trend=item.price_trend
+    ))
+    price_trend = computed['price_trend']
+    amazon_fees = computed['amazon_fees']
+    cheapest_source = computed['cheapest_source']
+    cheapest_buy_price = computed['cheapest_buy_price']
+    supplier_margin = computed['supplier_margin']
+    google_margin = computed['google_margin']
+    best_margin = computed['best_margin']
+    google_vs_amazon_diff = computed['google_vs_amazon_diff']
+    supplier_vs_google_diff = computed['supplier_vs_google_diff']
+    opportunity = computed['opportunity']
+    profitability_predictions = computed['profitability_predictions']
+    
+    if price_trend:
+        logger.info(f"Price trend analysis for {product['name']}: trend={price_trend['trend']}, volatility={price_trend['volatility']}%, favorable={price_trend['is_favorable']}")
+    logger.info(f"Opportunity score for {product['name']}: {opportunity['score']}/100 ({opportunity['level']})")
+    if profitability_predictions:
+        logger.info(f"Profitability predictions for {product['name']}: 30d profit change = {profitability_predictions['predictions']['30d']['profit_change_pct']}%, recommendation = {profitability_predictions['recommendation']}")
+    
+    # ==================== MULTI-MARKET ARBITRAGE ====================
+    multi_market_arbitrage = None
+    if amazon_price:  # Only analyze arbitrage if we have Amazon price data
+        multi_market_arbitrage = await analyze_multi_market_arbitrage(
+            gtin=product['gtin'],
+            supplier_price_eur=supplier_price,
+            keepa_api_key=ctx.keepa_key,
+            keepa_products=item.keepa_context
+        )
+        if multi_market_arbitrage and multi_market_arbitrage.get('analysis_available'):
+            logger.info(f"Multi-market arbitrage for {product['name']}: Best sell market = {multi_market_arbitrage['best_sell_market']['country']}, arbitrage profit = €{multi_market_arbitrage['arbitrage_opportunity_eur']}")
+    
+    amazon_source_domain = found_domain_info.get('name', 'Amazon.fr') if found_domain_info else ('Mock' if item.is_mock_data else 'Amazon.fr')
+    
+    # Product fields updated with all comparison data
+    item.update_data = {
+        'amazon_price_eur': amazon_price,
+        'amazon_price_local': item.amazon_price_local,  # Keeps FX changes re-applicable (see rescore_catalog)
+        'amazon_currency': item.amazon_currency,
+        'amazon_source_domain': amazon_source_domain,
+        'google_lowest_price_eur': google_lowest_price,
+        'google_suppliers_results': google_suppliers if google_suppliers else None,  # Store all Google suppliers
+        'cheapest_source': cheapest_source,
+        'cheapest_buy_price_eur': cheapest_buy_price,
+        'amazon_fees_eur': amazon_fees,
+        'amazon_margin_eur': best_margin['margin_eur'],
+        'amazon_margin_percentage': best_margin['margin_percentage'],
+        'supplier_margin_eur': supplier_margin['margin_eur'],
+        'supplier_margin_percentage': supplier_margin['margin_percentage'],
+        'google_margin_eur': google_margin['margin_eur'],
+        'google_margin_percentage': google_margin['margin_percentage'],
+        'google_vs_amazon_diff_eur': google_vs_amazon_diff,
+        'supplier_vs_google_diff_eur': supplier_vs_google_diff,
+        # Price trend analysis
+        'price_trend': price_trend,
+        # Opportunity score
+        'opportunity_score': opportunity['score'],
+        'opportunity_level': opportunity['level'],
+        'opportunity_details': opportunity['details'],
+        # Profitability predictions
+        'profitability_predictions': profitability_predictions,
+        # Multi-market arbitrage
+        'multi_market_arbitrage': multi_market_arbitrage,
+        # Legacy fields
+        'google_price_eur': google_lowest_price,
+        'best_price_eur': cheapest_buy_price,
+        'margin_eur': best_margin['margin_eur'],
+        'margin_percentage': best_margin['margin_percentage'],
+        'last_compared_at': datetime.now(timezone.utc).isoformat(),
+        # Inputs of this comparison, to detect changes (see build_compare_products_query)
+        'compared_supplier_price_eur': supplier_price,
+        'compared_gtin': product['gtin']
+    }
+    
+    item.result = {
+        'product_id': item.product_id,
+        'product_name': product['name'],
+        'gtin': product['gtin'],
+        'brand': product['brand'],
+        'is_mock_data': item.is_mock_data,
+        'search_source': item.search_source or ('google_search' if ctx.use_custom_search else 'mock'),
+        'amazon_source_domain': amazon_source_domain,
+        # Prices
+        'supplier_price_eur': supplier_price,
+        'amazon_price_eur': amazon_price,
+        'google_lowest_price_eur': google_lowest_price,
+        'google_suppliers_results': google_suppliers if google_suppliers else None,  # All Google suppliers
+        # Comparison
+        'cheapest_source': cheapest_source,
+        'cheapest_buy_price_eur': cheapest_buy_price,
+        'amazon_fees_eur': amazon_fees,
+        'amazon_fee_percentage': AMAZON_FEE_PERCENTAGE * 100,
+        # Margins
+        'supplier_margin_eur': supplier_margin['margin_eur'],
+        'supplier_margin_percentage': supplier_margin['margin_percentage'],
+        'google_margin_eur': google_margin['margin_eur'],
+        'google_margin_percentage': google_margin['margin_percentage'],
+        'best_margin_eur': best_margin['margin_eur'],
+        'best_margin_percentage': best_margin['margin_percentage'],
+        # Differences
+        'google_vs_amazon_diff_eur': google_vs_amazon_diff,
+        'supplier_vs_google_diff_eur': supplier_vs_google_diff,
+        # Price trend analysis
+        'price_trend': price_trend,
+        # Opportunity score
+        'opportunity_score': opportunity['score'],
+        'opportunity_level': opportunity['level'],
+        'opportunity_details': opportunity['details'],
+        # Profitability predictions
+        'profitability_predictions': profitability_predictions,
+        # Multi-market arbitrage
+        'multi_market_arbitrage': multi_market_arbitrage,
+        'compared_at': datetime.now(timezone.utc).isoformat()
+    }
+
+
+async def write_comparison_batch(user_id: str, items: List[ProductComparison]) -> Dict[str, Exception]:
+    """Write one batch of comparison data on the user's products with an unordered bulk_write; returns {product_id: error}"""
+    operations = [
+        UpdateOne({'id': item.product_id, 'user_id': user_id}, {'$set': item.update_data})
+        for item in items
+    ]
+    try:
+        await db.catalog_products.bulk_write(operations, ordered=False)
+    except BulkWriteError as e:
+        # Unordered: the other documents of the batch are written, only these failed
+        return {
+            items[error['index']].product_id: RuntimeError(f"Write failed: {error.get('errmsg', 'unknown error')}")
+            for error in e.details.get('writeErrors', [])
+        }
+    except Exception as e:
+        logger.error(f"Compare results bulk write failed for {len(items)} products: {e}")
+        return {item.product_id: e for item in items}
+    return {}
+
+
+async def persist_comparisons(ctx: CompareContext, items: List[ProductComparison]) -> Dict[str, Exception]:
+    """
+    Stage 6: write the comparison data on the catalog products, COMPARE_BULK_WRITE_SIZE per bulk_write.
+    
+    Returns:
+        dict: {product_id: exception} for the documents that could not be written
+    """
+    batches = [items[start:start + COMPARE_BULK_WRITE_SIZE] for start in range(0, len(items), COMPARE_BULK_WRITE_SIZE)]
+    failures = {}
+    for batch_failures in await asyncio.gather(*(write_comparison_batch(ctx.user['id'], batch) for batch in batches)):
+        failures.update(batch_failures)
+    return failures
+
+
+COMPARE_STAGES = [fetch_amazon_price, fetch_web_prices, analyze_price_trends, analyze_comparison]
+COMPARE_BATCH_STAGES = {analyze_price_trends}  # Called once with all the products of the batch
+COMPARE_BULK_WRITE_SIZE = int(os.environ.get('COMPARE_BULK_WRITE_SIZE', 250))
+# Incremental re-compare: comparisons younger than this are kept unless their inputs changed
+COMPARE_FRESHNESS_HOURS = float(os.environ.get('COMPARE_FRESHNESS_HOURS', 24))
+
+
+async def run_compare_pipeline(ctx: CompareContext, product_ids: List[str], prefetch: bool = True,
+                               dataforseo_batch: Optional[DataForSEOQueueBatch] = None) -> tuple:
+    """
+    Compare products through the staged pipeline.
+    
+    Each stage runs over all products (ctx.concurrency at a time) before the next
+    one starts, so that e.g. every Keepa lookup of the batch happens before any
+    web search. A product whose stage raised is dropped from the following stages.
+    The results are then written together with bulk writes. With ctx.dataforseo_queue,
+    the Google Shopping tasks of all products are queued before the Keepa stage,
+    unless the caller already started their dataforseo_batch.
+    
+    Returns:
+        tuple: (results in product_ids order, [{'product_id', 'error'}], {product_id: exception})
+    """
+    items, failures = await resolve_compare_products(ctx, product_ids, prefetch)
+    
+    if dataforseo_batch is not None:
+        ctx.dataforseo_batch = dataforseo_batch
+    elif ctx.dataforseo_queue and ctx.use_dataforseo and items:
+        # Queued now, so that the DataForSEO turnaround overlaps the Keepa stage
+        ctx.dataforseo_batch = DataForSEOQueueBatch(
+            ctx.dataforseo_login, ctx.dataforseo_password, ctx.user['id'], [item.product for item in items.values()]
+        )
+        ctx.dataforseo_batch.start()
+    try:
+        for stage in COMPARE_STAGES:
+            pending = [item for product_id, item in items.items() if product_id not in failures]
+            if stage in COMPARE_BATCH_STAGES:
+                try:
+                    outcomes = await stage(ctx, pending)
+                except Exception as e:
+                    outcomes = [e] * len(pending)
+            else:
+                outcomes = await map_bounded(lambda item: stage(ctx, item), pending, ctx.concurrency)
+            for item, outcome in zip(pending, outcomes):
+                if isinstance(outcome, Exception):
+                    logger.error(f"Compare stage {stage.__name__} failed for product {item.product_id}: {outcome}")
+                    failures[item.product_id] = outcome
+    finally:
+        if ctx.dataforseo_batch:
+            await ctx.dataforseo_batch.close()
+            ctx.dataforseo_batch = None
+    
+    compared = [item for product_id, item in items.items() if product_id not in failures]
+    write_failures = await persist_comparisons(ctx, compared)
+    for product_id, error in write_failures.items():
+        logger.error(f"Compare results not saved for product {product_id}: {error}")
+    failures.update(write_failures)
+    
+    results = []
+    errors = []
+    for product_id in dict.fromkeys(product_ids):
+        if product_id in failures:
+            errors.append({'product_id': product_id, 'error': str(failures[product_id])})
+        else:
+            results.append(items[product_id].result)
+    return results, errors, failures
+
+
+async def run_catalog_comparison(product_id: str, user: dict, race: bool = False) -> dict:
+    """Run the comparison of one catalog product and persist the results.
+    
+    race: query the Keepa domains concurrently (see race_keepa_domains)
+    """
+    ctx = CompareContext(user, race=race)
+    results, _, failures = await run_compare_pipeline(ctx, [product_id], prefetch=False)
+    if product_id in failures:
+        raise failures[product_id]
+    return results[0]
+
+
+def get_compare_stale_before(max_age_hours: Optional[float] = None) -> str:
+    """Comparisons made before the returned timestamp are stale (default age: COMPARE_FRESHNESS_HOURS)"""
+    if max_age_hours is None:
+        max_age_hours = COMPARE_FRESHNESS_HOURS
+    return (datetime.now(timezone.utc) - timedelta(hours=max_age_hours)).isoformat()
+
+
+def build_compare_products_query(user_id: str, stale_before: Optional[str] = None) -> dict:
+    """
+    Catalog products to compare: all of them, or with stale_before only those that
+    were never compared, were compared before stale_before, or whose supplier price
+    or GTIN changed since their last comparison.
+    """
+    query = {'user_id': user_id}
+    if stale_before:
+        query['$or'] = [
+            {'last_compared_at': None},
+            {'last_compared_at': {'$lt': stale_before}},
+            {'$expr': {'$ne': ['$compared_supplier_price_eur', '$supplier_price_eur']}},
+            {'$expr': {'$ne': ['$compared_gtin', '$gtin']}}
+        ]
+    return query
+
+
+@api_router.post("/catalog/compare-batch")
+async def compare_batch(
+    product_ids: List[str],
+    concurrency: Optional[int] = None,
+    user: dict = Depends(get_current_user)
+):
+    """Compare multiple products in batch, `concurrency` products at a time per stage"""
+    ctx = CompareContext(user, concurrency=concurrency)
+    results, errors, _ = await run_compare_pipeline(ctx, product_ids)
+    
+    return {
+        'success': len(results),
+        'failed': len(errors),
+        'results': results,
+        'errors': errors
+    }
+
+@api_router.post("/catalog/compare-all")
+async def compare_all_products(
+    concurrency: Optional[int] = None,
+    incremental: bool = False,
+    max_age_hours: Optional[float] = None,
+    user: dict = Depends(get_current_user)
+):
+    """Compare ALL products in the catalog for the current user.
+    
+    incremental=true only re-compares products whose comparison is older than
+    max_age_hours (default COMPARE_FRESHNESS_HOURS) or whose supplier price or GTIN
+    changed since; the others are counted as skipped.
+    
+    Products are compared COMPARE_BULK_WRITE_SIZE at a time, each chunk persisted
+    before the next one is read (see iter_compare_product_chunks).
+    """
+    total = await db.catalog_products.count_documents({'user_id': user['id']})
+    if total == 0:
+        raise HTTPException(status_code=404, detail="Aucun produit dans le catalogue")
+    
+    stale_before = get_compare_stale_before(max_age_hours) if incremental else None
+    query = build_compare_products_query(user['id'], stale_before)
+    ctx = CompareContext(user, concurrency=concurrency)
+    
+    selected = 0
+    results, errors = [], []
+    async for product_ids in iter_compare_product_chunks(query, COMPARE_BULK_WRITE_SIZE):
+        selected += len(product_ids)
+        chunk_results, chunk_errors, _ = await run_compare_pipeline(ctx, product_ids)
+        results.extend(chunk_results)
+        errors.extend(chunk_errors)
+    
+    return {
+        'total': total,
+        'skipped': total - selected,
+        'success': len(results),
+        'failed': len(errors),
+        'results': results,
+        'errors': errors
+    }
+
+# ==================== STREAMING COMPARE ====================
+
+# Streaming variants of compare-batch / compare-all: each result is sent as soon as
+# its chunk is compared, and only one chunk of results is held in memory.
+COMPARE_STREAM_CHUNK_SIZE = int(os.environ.get('COMPARE_STREAM_CHUNK_SIZE', 10))
+COMPARE_STREAM_MEDIA_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'sse': 'text/event-stream'
+}
+
+
+async def iter_compare_product_chunks(query: dict, chunk_size: int, after_id: Optional[str] = None):
+    """
+    Yield the ids of the catalog products matching query, chunk_size at a time (sorted by id, after after_id).
+    
+    Each chunk is its own query starting after the last id of the previous chunk: no
+    cursor stays open while a chunk is compared, which can take longer than the
+    server's idle cursor timeout (queued web searches, Keepa token waits).
+    """
+    last_id = after_id
+    while True:
+        chunk_query = {**query, 'id': {'$gt': last_id}} if last_id else query
+        products = await db.catalog_products.find(
+            chunk_query, {'_id': 0, 'id': 1}
+        ).sort('id', 1).limit(chunk_size).to_list(None)
+        if not products:
+            return
+        chunk = [product['id'] for product in products]
+        yield chunk
+        if len(chunk) < chunk_size:
+            return
+        last_id = chunk[-1]
+
+
+async def stream_compare_events(ctx: CompareContext, chunks, summary: Optional[dict] = None):
+    """Compare the chunks of product ids one after the other and yield a result/error event per product, then a summary event
+    
+    If a chunk (or reading the next one) fails as a whole, an error event without product_id
+    ends the stream, followed by the summary of what was compared until then.
+    """
+    succeeded = 0
+    failed = 0
+    product_ids = []
+    try:
+        async for product_ids in chunks:
+            results, errors, _ = await run_compare_pipeline(ctx, product_ids)
+            succeeded += len(results)
+            failed += len(errors)
+            for result in results:
+                yield {'type': 'result', 'result': result}
+            for error in errors:
+                yield {'type': 'error', **error}
+            product_ids = []
+    except Exception as e:
+        logger.error(f"Streaming compare aborted after {succeeded + failed} products: {e}")
+        failed += len(product_ids)
+        yield {'type': 'error', 'error': str(e), 'product_ids': product_ids}
+    yield {'type': 'summary', **(summary or {}), 'success': succeeded, 'failed': failed}
+
+
+def format_compare_event(event: dict, format: str) -> str:
+    data = json.dumps(jsonable_encoder(event))
+    if format == 'sse':
+        return f"event: {event['type']}\ndata: {data}\n\n"
+    return f"{data}\n"
+
+
+def compare_stream_response(events, format: str) -> StreamingResponse:
+    async def body():
+        async for event in events:
+            yield format_compare_event(event, format)
+    
+    return StreamingResponse(
+        body(),
+        media_type=COMPARE_STREAM_MEDIA_TYPES[format],
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+def check_compare_stream_format(format: str):
+    if format not in COMPARE_STREAM_MEDIA_TYPES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Format inconnu : {format} (formats : {', '.join(COMPARE_STREAM_MEDIA_TYPES)})"
+        )
+
+
+@api_router.post("/catalog/compare-batch/stream")
+async def compare_batch_stream(
+    product_ids: List[str],
+    concurrency: Optional[int] = None,
+    format: str = 'ndjson',
+    user: dict = Depends(get_current_user)
+):
+    """Compare multiple products, streaming one event per product (NDJSON lines or SSE) and a final summary"""
+    check_compare_stream_format(format)
+    ctx = CompareContext(user, concurrency=concurrency)
+    
+    async def chunks():
+        for start in range(0, len(product_ids), COMPARE_STREAM_CHUNK_SIZE):
+            yield product_ids[start:start + COMPARE_STREAM_CHUNK_SIZE]
+    
+    return compare_stream_response(
+        stream_compare_events(ctx, chunks(), {'total': len(product_ids)}),
+        format
+    )
+
+@api_router.post("/catalog/compare-all/stream")
+async def compare_all_products_stream(
+    concurrency: Optional[int] = None,
+    incremental: bool = False,
+    max_age_hours: Optional[float] = None,
+    format: str = 'ndjson',
+    user: dict = Depends(get_current_user)
+):
+    """Compare all (or, if incremental, the stale) catalog products, streaming one event per product and a final summary"""
+    check_compare_stream_format(format)
+    catalog_size = await db.catalog_products.count_documents({'user_id': user['id']})
+    if catalog_size == 0:
+        raise HTTPException(status_code=404, detail="Aucun produit dans le catalogue")
+    
+    stale_before = get_compare_stale_before(max_age_hours) if incremental else None
+    query = build_compare_products_query(user['id'], stale_before)
+    selected = await db.catalog_products.count_documents(query)
+    ctx = CompareContext(user, concurrency=concurrency)
+    
+    return compare_stream_response(
+        stream_compare_events(
+            ctx,
+            iter_compare_product_chunks(query, COMPARE_STREAM_CHUNK_SIZE),
+            {'total': catalog_size, 'skipped': catalog_size - selected}
+        ),
+        format
+    )
+
+# ==================== COMPARE PLANNER ====================
+
+# Dry-run estimate of the provider calls, Keepa tokens and duration of a compare run.
+# Hit rates observed in the GTIN index and the negative cache replace the defaults
+# once they have COMPARE_PLAN_MIN_SAMPLES entries.
+COMPARE_PLAN_MIN_SAMPLES = 20
+COMPARE_PLAN_DEFAULT_GTIN_HIT_RATE = 0.7  # Share of GTINs found by the domain cascade
+COMPARE_PLAN_DEFAULT_KEYWORD_HIT_RATE = 0.3  # Share of the cascade misses found by keyword search
+COMPARE_PLAN_DEFAULT_WEB_MISS_RATE = 0.5  # Share of Custom Search queries without any price
+
+
+async def get_keepa_resolution_rates() -> dict:
+    """GTIN cascade / keyword hit rates and the domain shares of cascade hits, from the GTIN index and negative cache"""
+    counts = await db.gtin_asin_index.aggregate([
+        {'$group': {'_id': {'domain': '$domain', 'method': '$method'}, 'count': {'$sum': 1}}}
+    ]).to_list(None)
+    misses = await db.keepa_negative_cache.count_documents({})
+    gtin_hits_by_domain = {}
+    keyword_hits = 0
+    for row in counts:
+        if row['_id'].get('method') == 'keyword':
+            keyword_hits += row['count']
+        else:
+            gtin_hits_by_domain[row['_id'].get('domain')] = gtin_hits_by_domain.get(row['_id'].get('domain'), 0) + row['count']
+    gtin_hits = sum(gtin_hits_by_domain.values())
+    samples = gtin_hits + keyword_hits + misses
+    observed = samples >= COMPARE_PLAN_MIN_SAMPLES
+    
+    return {
+        'gtin_hit_rate': round(gtin_hits / samples, 3) if observed else COMPARE_PLAN_DEFAULT_GTIN_HIT_RATE,
+        'keyword_hit_rate': round(keyword_hits / (keyword_hits + misses), 3) if observed and keyword_hits + misses else COMPARE_PLAN_DEFAULT_KEYWORD_HIT_RATE,
+        'domain_shares': (
+            {domain: count / gtin_hits for domain, count in gtin_hits_by_domain.items()}
+            if observed and gtin_hits else {KEEPA_EUROPEAN_DOMAINS[0]['domain']: 1.0}
+        ),
+        'samples': samples,
+        'observed': observed
+    }
+
+
+def count_arbitrage_fetches(found_domain_id: int) -> int:
+    """Markets the arbitrage analysis fetches for a product found on a domain (those after it in cascade order)"""
+    known = set()
+    for domain_info in KEEPA_EUROPEAN_DOMAINS:
+        known.add(domain_info['market_code'])
+        if domain_info['domain'] == found_domain_id:
+            break
+    return len([code for code in ARBITRAGE_MARKET_CODES if code not in known])
+
+
+def estimate_duration(calls: float, provider: str, concurrency: int) -> float:
+    """Seconds for `calls` independent requests, sent `concurrency` at a time within the provider limit"""
+    parallel = max(1, min(concurrency, HTTP_CLIENT_CONFIGS[provider]['max_in_flight']))
+    return calls * get_provider_latency(provider) / parallel
+
+
+async def plan_keepa_calls(keepa_key: str, products: List[dict], concurrency: int) -> dict:
+    """Keepa requests and tokens of a batch compare: GTIN index, cascade, keyword fallback and arbitrage"""
+    gtins = list(dict.fromkeys(p['gtin'] for p in products if p.get('gtin')))
+    rates = await get_keepa_resolution_rates()
+    tokens = 0.0
+    batch_requests = 0.0  # Sent one after another by the prefetch
+    product_requests = 0.0  # Sent per product, `concurrency` products at a time
+    arbitrage_fetches = 0.0  # Markets fetched by the arbitrage analysis, one token each
+    
+    # Indexed GTINs: one fetch by ASIN per domain (free when cached)
+    index_entries = await lookup_gtin_asin_index(gtins)
+    indexed_by_domain: Dict[int, List[str]] = {}
+    for entry in index_entries.values():
+        indexed_by_domain.setdefault(entry['domain'], []).append(entry['asin'])
+    indexed_cached = 0
+    for domain_id, asins in indexed_by_domain.items():
+        cached = await keepa_cache.get_many(domain_id, 'asin', asins, 'trend', peek=True)
+        indexed_cached += len(cached)
+        uncached = len(asins) - len(cached)
+        tokens += uncached * KEEPA_TOKEN_COST_PRODUCT
+        batch_requests += math.ceil(uncached / KEEPA_MAX_CODES_PER_REQUEST)
+        arbitrage_fetches += len(asins) * count_arbitrage_fetches(domain_id)
+    remaining = [g for g in gtins if g not in index_entries]
+    
+    known_absent = await lookup_keepa_negative_cache(remaining)
+    remaining = [g for g in remaining if g not in known_absent]
+    
+    # Cascade: GTINs cached for the first domain resolve for free, the others go down the domains
+    first_domain = KEEPA_EUROPEAN_DOMAINS[0]['domain']
+    cascade_cached = len(await keepa_cache.get_many(first_domain, 'code', remaining, 'trend', peek=True))
+    arbitrage_fetches += cascade_cached * count_arbitrage_fetches(first_domain)
+    to_resolve = len(remaining) - cascade_cached
+    still_missing = 1.0
+    for domain_info in KEEPA_EUROPEAN_DOMAINS:
+        codes = to_resolve * still_missing
+        tokens += codes * KEEPA_TOKEN_COST_PRODUCT
+        batch_requests += math.ceil(codes / KEEPA_MAX_CODES_PER_REQUEST)
+        found = to_resolve * rates['gtin_hit_rate'] * rates['domain_shares'].get(domain_info['domain'], 0)
+        arbitrage_fetches += found * count_arbitrage_fetches(domain_info['domain'])
+        still_missing = max(still_missing - rates['gtin_hit_rate'] * rates['domain_shares'].get(domain_info['domain'], 0), 0)
+    
+    # Keyword fallback of the cascade misses: a hit costs one search + one candidate + the refetch,
+    # a miss searches every domain and checks all candidates
+    keyword_searches = to_resolve * (1 - rates['gtin_hit_rate'])
+    keyword_hits = keyword_searches * rates['keyword_hit_rate']
+    keyword_misses = keyword_searches - keyword_hits
+    tokens += keyword_hits * (KEEPA_TOKEN_COST_SEARCH + 2 * KEEPA_TOKEN_COST_PRODUCT)
+    product_requests += keyword_hits * 3
+    domains = len(KEEPA_EUROPEAN_DOMAINS)
+    tokens += keyword_misses * domains * (KEEPA_TOKEN_COST_SEARCH + KEEPA_SEARCH_CANDIDATES * KEEPA_TOKEN_COST_PRODUCT)
+    product_requests += keyword_misses * domains * (1 + KEEPA_SEARCH_CANDIDATES)
+    
+    tokens += arbitrage_fetches * KEEPA_TOKEN_COST_PRODUCT
+    product_requests += arbitrage_fetches
+    
+    bucket = get_keepa_token_bucket(keepa_key)
+    if bucket.tokens_left is None:
+        # The /token endpoint reports the state without costing tokens
+        try:
+            await keepa_request(keepa_key, "token", {})
+        except Exception as e:
+            logger.warning(f"Keepa token status error: {e}")
+    tokens_left = bucket.estimate_tokens()
+    token_wait = None
+    if tokens_left is not None:
+        shortfall = max(tokens - tokens_left, 0)
+        token_wait = shortfall / bucket.refill_rate * 60 if bucket.refill_rate > 0 else (0 if shortfall == 0 else None)
+    
+    request_seconds = batch_requests * get_provider_latency('keepa') + estimate_duration(product_requests, 'keepa', concurrency)
+    return {
+        'gtins': len(gtins),
+        'indexed': len(index_entries),
+        'indexed_cached': indexed_cached,
+        'known_absent': len(known_absent),
+        'cascade_cached': cascade_cached,
+        'to_resolve': to_resolve,
+        'rates': rates,
+        'requests': round(batch_requests + product_requests),
+        'tokens': round(tokens),
+        'tokens_left': round(tokens_left, 1) if tokens_left is not None else None,
+        'refill_rate_per_minute': bucket.refill_rate,
+        'token_wait_seconds': round(token_wait) if token_wait is not None else None,
+        'estimated_seconds': round(max(request_seconds, token_wait or 0))
+    }
+
+
+async def get_web_search_miss_rate(user_id: str) -> float:
+    """Share of the user's compared products without any Google price (default until enough samples)"""
+    compared = await db.catalog_products.count_documents({'user_id': user_id, 'last_compared_at': {'$ne': None}})
+    if compared < COMPARE_PLAN_MIN_SAMPLES:
+        return COMPARE_PLAN_DEFAULT_WEB_MISS_RATE
+    missed = await db.catalog_products.count_documents(
+        {'user_id': user_id, 'last_compared_at': {'$ne': None}, 'google_lowest_price_eur': None}
+    )
+    return round(missed / compared, 3)
+
+
+async def count_uncached_web_queries(namespace: str, queries: List[str]) -> Tuple[int, int]:
+    """(distinct queries to send, distinct queries answered by the web search cache)"""
+    distinct = list({web_search_cache.make_key(namespace, query): query for query in queries}.values())
+    cached = len(await web_search_cache.get_many(namespace, distinct, peek=True))
+    return len(distinct) - cached, cached
+
+
+@api_router.post("/catalog/compare-plan")
+async def plan_catalog_comparison(
+    product_ids: Optional[List[str]] = None,
+    incremental: bool = False,
+    max_age_hours: Optional[float] = None,
+    concurrency: Optional[int] = None,
+    dataforseo_queue: bool = False,
+    user: dict = Depends(get_current_user)
+):
+    """Dry run: estimate the provider calls, Keepa tokens and duration of comparing a selection.
+    
+    The selection is `product_ids` (body), or the whole catalog (only the stale products
+    with incremental=true, as for compare-all). Nothing is fetched or written, except a
+    free Keepa /token call when the token level is not known yet. dataforseo_queue=true
+    estimates the Google Shopping searches of a compare job (DataForSEO standard queue).
+    """
+    ctx = CompareContext(user, concurrency=concurrency)
+    if product_ids is not None:
+        query = {'user_id': user['id'], 'id': {'$in': product_ids}}
+    else:
+        stale_before = get_compare_stale_before(max_age_hours) if incremental else None
+        query = build_compare_products_query(user['id'], stale_before)
+    products = await db.catalog_products.find(
+        query, {'_id': 0, 'id': 1, 'gtin': 1, 'brand': 1, 'name': 1, 'image_url': 1}
+    ).to_list(None)
+    
+    plan = {
+        'products': len(products),
+        'concurrency': ctx.concurrency,
+        'keepa': None,
+        'google_custom_search': None,
+        'dataforseo': None
+    }
+    if product_ids is None:
+        plan['skipped'] = await db.catalog_products.count_documents({'user_id': user['id']}) - len(products)
+    
+    if ctx.keepa_key and products:
+        plan['keepa'] = await plan_keepa_calls(ctx.keepa_key, products, ctx.concurrency)
+    
+    # Products sharing a query search it once, and cached queries are not sent again
+    if ctx.use_dataforseo:
+        tasks, cached = await count_uncached_web_queries(
+            'dataforseo', [build_dataforseo_keyword(p) for p in products]
+        )
+    if ctx.use_dataforseo and dataforseo_queue:
+        # Each job chunk queues its tasks (DATAFORSEO_TASKS_PER_POST per task_post) and waits for them,
+        # DATAFORSEO_QUEUE_LOOKAHEAD_CHUNKS chunks ahead of the one compared: their waits overlap
+        waits = math.ceil(tasks / COMPARE_JOB_CHUNK_SIZE / (DATAFORSEO_QUEUE_LOOKAHEAD_CHUNKS + 1))
+        plan['dataforseo'] = {
+            'mode': 'standard_queue',
+            'tasks': tasks,
+            'cached': cached,
+            'task_posts': sum(
+                math.ceil(min(COMPARE_JOB_CHUNK_SIZE, tasks - start) / DATAFORSEO_TASKS_PER_POST)
+                for start in range(0, tasks, COMPARE_JOB_CHUNK_SIZE)
+            ),
+            'estimated_seconds': round(waits * get_provider_latency('dataforseo_queue'))
+        }
+    elif ctx.use_dataforseo:
+        plan['dataforseo'] = {
+            'mode': 'live',
+            'tasks': tasks,
+            'cached': cached,
+            'estimated_seconds': round(estimate_duration(tasks, 'dataforseo', ctx.concurrency))
+        }
+    elif ctx.use_custom_search:
+        # One query per product, plus an image search for products with an image when it found no price
+        miss_rate = await get_web_search_miss_rate(user['id'])
+        web_queries, web_cached = await count_uncached_web_queries(
+            'cse', [f"{p['brand']} {p['name']} prix" for p in products]
+        )
+        image_queries, image_cached = await count_uncached_web_queries(
+            'cse_image', [f"{p['brand']} {p['name']}" for p in products if p.get('image_url')]
+        )
+        queries = web_queries + image_queries * miss_rate
+        plan['google_custom_search'] = {
+            'queries': round(queries),
+            'cached': web_cached + image_cached,
+            'miss_rate': miss_rate,
+            'estimated_seconds': round(estimate_duration(queries, 'google', ctx.concurrency))
+        }
+    
+    # The pipeline stages run one after another
+    estimated_seconds = sum(
+        plan[provider]['estimated_seconds']
+        for provider in ('keepa', 'google_custom_search', 'dataforseo') if plan[provider]
+    )
+    if plan['keepa'] and plan['dataforseo'] and plan['dataforseo']['mode'] == 'standard_queue':
+        # ... except the queued tasks, which complete while Keepa is queried
+        estimated_seconds = max(plan['keepa']['estimated_seconds'], plan['dataforseo']['estimated_seconds'])
+    plan['estimated_seconds'] = estimated_seconds
+    plan['estimated_minutes'] = round(estimated_seconds / 60, 1)
+    return plan
+
+
+# ==================== CATALOG RE-SCORING ====================
+
+# Re-derives the comparison figures of the compared products from their stored prices and
+# trend statistics, without any provider call: after a fee or exchange rate change, the
+# whole catalog is re-scored with array operations instead of product by product.
+RESCORE_PROJECTION = {
+    '_id': 0, 'id': 1, 'name': 1, 'gtin': 1, 'category': 1, 'supplier_price_gbp': 1, 'supplier_price_eur': 1,
+    'amazon_price_eur': 1, 'amazon_price_local': 1, 'amazon_currency': 1,
+    'google_lowest_price_eur': 1, 'google_suppliers_results': 1, 'price_trend': 1
+}
+
+
+def optional_floats(values) -> np.ndarray:
+    """float64 array of optional numbers (NaN for None)"""
+    return np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+
+
+def split_float(values):
+    """Dekker split of float64 values into a 26-bit high part and the exact remainder"""
+    scaled = values * 134217729.0  # 2^27 + 1
+    high = scaled - (scaled - values)
+    return high, values - high
+
+
+def round_decimals(values: np.ndarray, decimals: int) -> np.ndarray:
+    """
+    Vectorized round(value, decimals) with the results of Python's round().
+    
+    np.round rounds the product value * 10^decimals, which is already rounded and flips
+    about one price in twenty by a cent (39.765 -> 39.76 instead of 39.77); the exact
+    product is kept here as a float pair to round the value actually stored.
+    """
+    scale = 10.0 ** decimals
+    product = values * scale
+    values_high, values_low = split_float(values)
+    scale_high, scale_low = split_float(scale)
+    error = values_low * scale_low - (((product - values_high * scale_high) - values_low * scale_high) - values_high * scale_low)
+    rounded = np.rint(product)
+    remainder = product - rounded  # exact, in [-0.5, 0.5]
+    rounded = rounded + np.where((remainder == 0.5) & (error > 0), 1, 0) - np.where((remainder == -0.5) & (error < 0), 1, 0)
+    return rounded / scale
+
+
+def truthy(values: np.ndarray) -> np.ndarray:
+    """Vectorized `if value` of optional numbers: present and not zero"""
+    return ~np.isnan(values) & (values != 0)
+
+
+def build_rescore_frame(products: List[dict]) -> pd.DataFrame:
+    """One row per product with the stored inputs of its comparison figures"""
+    trends = [product.get('price_trend') or None for product in products]
+    return pd.DataFrame({
+        'id': [product['id'] for product in products],
+        'name': [product.get('name') for product in products],
+        'gtin': [product.get('gtin') for product in products],
+        'category': [product.get('category') for product in products],
+        'supplier_price_gbp': optional_floats(product.get('supplier_price_gbp') for product in products),
+        'supplier_price_eur': optional_floats(product.get('supplier_price_eur') for product in products),
+        'amazon_price_eur': optional_floats(product.get('amazon_price_eur') for product in products),
+        'amazon_price_local': optional_floats(product.get('amazon_price_local') for product in products),
+        'amazon_currency': [product.get('amazon_currency') for product in products],
+        'google_lowest_price': optional_floats(product.get('google_lowest_price_eur') for product in products),
+        'google_suppliers_count': [len(product.get('google_suppliers_results') or []) for product in products],
+        'has_trend': [trend is not None for trend in trends],
+        'trend': [trend.get('trend', 'stable') if trend else None for trend in trends],
+        'current_price': optional_floats(trend.get('current_price') if trend else None for trend in trends),
+        'avg_30d': optional_floats(trend.get('avg_30d') if trend else None for trend in trends),
+        'avg_60d': optional_floats(trend.get('avg_60d', trend.get('avg_30d')) if trend else None for trend in trends),
+        'avg_90d': optional_floats(trend.get('avg_90d', trend.get('avg_30d')) if trend else None for trend in trends),
+        'volatility': optional_floats(trend.get('volatility') if trend else None for trend in trends),
+        'data_points': [trend.get('data_points', 0) if trend else 0 for trend in trends],
+    })
+
+
+def convert_frame_prices(frame: pd.DataFrame, currency_rates: Dict[str, float], gbp_to_eur_rate: Optional[float]) -> tuple:
+    """
+    Supplier and Amazon prices in EUR.
+    
+    Amazon prices stored with their local price are converted again with currency_rates;
+    supplier prices are converted again when gbp_to_eur_rate is given.
+    
+    Returns:
+        tuple: (supplier prices, Amazon prices) arrays
+    """
+    supplier_price = frame['supplier_price_eur'].to_numpy()
+    if gbp_to_eur_rate is not None:
+        supplier_gbp = frame['supplier_price_gbp'].to_numpy()
+        supplier_price = np.where(np.isnan(supplier_gbp), supplier_price, round_decimals(supplier_gbp * gbp_to_eur_rate, 2))
+    
+    amazon_local = frame['amazon_price_local'].to_numpy()
+    amazon_rate = frame['amazon_currency'].map(currency_rates).to_numpy(dtype=np.float64, na_value=np.nan)
+    converted = ~np.isnan(amazon_local) & ~np.isnan(amazon_rate)
+    amazon_price = np.where(converted, round_decimals(amazon_local * amazon_rate, 2), frame['amazon_price_eur'].to_numpy())
+    return supplier_price, amazon_price
+
+
+def compute_margin_columns(supplier: np.ndarray, amazon: np.ndarray, google: np.ndarray, fee_rate) -> dict:
+    """Vectorized fees, cheapest source, margins and price differences of compute_comparison (fee_rate: scalar or per row)"""
+    has_amazon = truthy(amazon)
+    google_cheapest = ~np.isnan(google) & (google <= supplier)
+    cheapest_buy = np.where(google_cheapest, google, supplier)
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fees = round_decimals(amazon * fee_rate, 2)
+        
+        def margins(buying: np.ndarray) -> tuple:
+            margin_eur = round_decimals(amazon - buying - fees, 2)
+            margin_percentage = np.where(amazon > 0, round_decimals((margin_eur / amazon) * 100, 2), 0)
+            return margin_eur, margin_percentage
+        
+        supplier_margin_eur, supplier_margin_pct = margins(supplier)
+        google_margin_eur, google_margin_pct = margins(google)
+        best_margin_eur, best_margin_pct = margins(cheapest_buy)
+        
+        return {
+            'has_amazon': has_amazon,
+            'has_google_margin': has_amazon & truthy(google),
+            'google_cheapest': google_cheapest,
+            'cheapest_buy': cheapest_buy,
+            'fees': fees,
+            'supplier_margin_eur': supplier_margin_eur,
+            'supplier_margin_pct': supplier_margin_pct,
+            'google_margin_eur': google_margin_eur,
+            'google_margin_pct': google_margin_pct,
+            'best_margin_eur': best_margin_eur,
+            'best_margin_pct': best_margin_pct,
+            'google_vs_amazon_diff': round_decimals(google - amazon, 2),
+            'supplier_vs_google_diff': round_decimals(supplier - google, 2)
+        }
+
+
+def compute_opportunity_columns(frame: pd.DataFrame, best_margin_pct: np.ndarray, has_amazon: np.ndarray) -> dict:
+    """Vectorized calculate_opportunity_score: points per factor, score and level"""
+    google_count = frame['google_suppliers_count'].to_numpy()
+    has_trend = frame['has_trend'].to_numpy(dtype=bool)
+    trend = frame['trend'].to_numpy()
+    current = frame['current_price'].to_numpy()
+    avg_30d = frame['avg_30d'].to_numpy()
+    volatility = frame['volatility'].to_numpy()
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        margin_score = np.where(has_amazon, np.select(
+            [best_margin_pct >= 50, best_margin_pct >= 30, best_margin_pct >= 10], [30, 20, 10], 0
+        ), 0)
+        trend_score = np.where(has_trend, np.select(
+            [trend == 'baisse', trend == 'stable', trend == 'hausse'], [25, 15, 5], 0
+        ), 0)
+        competition_score = np.select([google_count <= 2, google_count <= 5, google_count <= 8], [20, 15, 10], 5)
+        score_volatility = np.where(np.isnan(volatility), 100, volatility)
+        volatility_score = np.where(has_trend, np.select(
+            [score_volatility < 10, score_volatility < 20, score_volatility < 30], [15, 10, 5], 0
+        ), 0)
+        position = ((current - avg_30d) / avg_30d) * 100
+        position_score = np.where(has_trend & truthy(avg_30d), np.select([position < -10, position < 0], [10, 5], 0), 0)
+    
+    score = margin_score + trend_score + competition_score + volatility_score + position_score
+    return {
+        'margin_score': margin_score,
+        'trend_score': trend_score,
+        'competition_score': competition_score,
+        'volatility_score': volatility_score,
+        'position_score': position_score,
+        'score': score,
+        'level': np.select([score >= 80, score >= 60, score >= 40], ['Excellent', 'Bon', 'Moyen'], 'Faible')
+    }
+
+
+def compute_prediction_columns(frame: pd.DataFrame, has_amazon: np.ndarray, cheapest_buy: np.ndarray, fee_rate) -> dict:
+    """Vectorized predict_price_profitability from the stored trend statistics"""
+    has_trend = frame['has_trend'].to_numpy(dtype=bool)
+    trend = frame['trend'].to_numpy()
+    current = frame['current_price'].to_numpy()
+    avg_30d = frame['avg_30d'].to_numpy()
+    avg_60d = frame['avg_60d'].to_numpy()
+    avg_90d = frame['avg_90d'].to_numpy()
+    volatility = np.where(np.isnan(frame['volatility'].to_numpy()), 50, frame['volatility'].to_numpy())
+    data_points = frame['data_points'].to_numpy()
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        daily_change = np.where(
+            truthy(avg_60d) & truthy(avg_90d), (current - avg_90d) / 90,
+            np.where(truthy(avg_60d), (current - avg_60d) / 60, (current - avg_30d) / 30)
+        )
+        
+        def profit(price: np.ndarray) -> np.ndarray:
+            return round_decimals(price - cheapest_buy - price * fee_rate, 2)
+        
+        current_profit = profit(current)
+        horizons = {}
+        for label, days, ceiling in (('30d', 30, 1.5), ('60d', 60, 1.8), ('90d', 90, 2.0)):
+            price = round_decimals(current + (daily_change * days), 2)
+            price = np.maximum(current * 0.5, np.minimum(price, current * ceiling))
+            horizon_profit = profit(price)
+            change = round_decimals(np.where(current_profit != 0, (horizon_profit - current_profit) / current_profit * 100, 0), 1)
+            horizons[label] = (price, horizon_profit, change)
+        
+        profit_30d = horizons['30d'][1]
+        recommendation = np.select(
+            [(profit_30d > current_profit * 1.1) & (trend != 'hausse'),
+             (profit_30d < current_profit * 0.9) | (volatility > 30)],
+            ['acheter_maintenant', 'risque'], 'attendre'
+        )
+    
+    return {
+        'predicted': has_trend & has_amazon & truthy(avg_30d),
+        'current_profit': current_profit,
+        'horizons': horizons,
+        'confidence': np.select(
+            [(volatility < 10) & (data_points > 50), (volatility < 25) & (data_points > 20)],
+            ['high', 'medium'], 'low'
+        ),
+        'recommendation': recommendation,
+        'volatility_risk': np.select([volatility < 10, volatility < 25], ['faible', 'moyen'], 'eleve')
+    }
+
+
+def reprice_trend_columns(frame: pd.DataFrame, amazon: np.ndarray) -> pd.DataFrame:
+    """
+    Trend columns re-based on the re-converted Amazon prices.
     
-    # Margin if buying from SUPPLIER and selling on Amazon
-    supplier_margin = calculate_margin(amazon_price, supplier_price, amazon_fees) if amazon_price else {'margin_eur': None, 'margin_percentage': None}
+    The compare path builds the trend with the Amazon EUR price as current price
+    (see build_price_trend); after an exchange rate change the stored current price,
+    trend direction and favorable flag are recomputed from the same 30-day average.
+    """
+    has_trend = frame['has_trend'].to_numpy(dtype=bool)
+    avg_30d = frame['avg_30d'].to_numpy()
+    current = np.where(has_trend & ~np.isnan(amazon), amazon, frame['current_price'].to_numpy())
     
-    # Margin if buying from GOOGLE and selling on Amazon
-    google_margin = calculate_margin(amazon_price, google_lowest_price, amazon_fees) if (amazon_price and google_lowest_price) else {'margin_eur': None, 'margin_percentage': None}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        diff_percentage = ((current - avg_30d) / avg_30d) * 100
+        trend = np.where(
+            truthy(avg_30d), np.select([diff_percentage > 5, diff_percentage < -5], ['hausse', 'baisse'], 'stable'), 'stable'
+        )
     
-    # Best margin (from cheapest source)
-    best_margin = calculate_margin(amazon_price, cheapest_buy_price, amazon_fees) if amazon_price else {'margin_eur': None, 'margin_percentage': None}
+    repriced = frame.copy()
+    repriced['current_price'] = current
+    repriced['trend'] = np.where(has_trend, trend, None)
+    repriced['is_favorable'] = truthy(avg_30d) & (current < avg_30d)
+    return repriced
+
+
+def optional_list(values: np.ndarray, present: np.ndarray) -> list:
+    """Python floats where present, None elsewhere"""
+    return [value if keep else None for value, keep in zip(values.tolist(), present.tolist())]
+
+
+def rescore_frame(frame: pd.DataFrame, currency_rates: Dict[str, float], gbp_to_eur_rate: Optional[float], fee_percentage: float) -> List[dict]:
+    """
+    Vectorized compute_comparison without the trend analysis: fees, margins, cheapest source,
+    differences, opportunity score (calculate_opportunity_score) and profitability
+    predictions (predict_price_profitability), from the stored trend statistics re-based
+    on the re-converted Amazon price (see reprice_trend_columns).
     
-    # Price differences
-    google_vs_amazon_diff = round(google_lowest_price - amazon_price, 2) if (google_lowest_price and amazon_price) else None
-    supplier_vs_google_diff = round(supplier_price - google_lowest_price, 2) if google_lowest_price else None
+    Pure function of its frame, run in the analysis process pool (see run_analysis).
     
-    # ==================== OPPORTUNITY SCORE ====================
-    google_suppliers_count = len(google_suppliers) if google_suppliers else 0
-    opportunity = calculate_opportunity_score(
-        margin_eur=best_margin['margin_eur'],
-        margin_percentage=best_margin['margin_percentage'],
-        price_trend=price_trend,
-        google_suppliers_count=google_suppliers_count,
-        amazon_price=amazon_price,
-        supplier_price=supplier_price
-    )
-    logger.info(f"Opportunity score for {product['name']}: {opportunity['score']}/100 ({opportunity['level']})")
+    Returns:
+        list: the fields to $set, in frame order
+    """
+    supplier, amazon = convert_frame_prices(frame, currency_rates, gbp_to_eur_rate)
+    google = frame['google_lowest_price'].to_numpy()
+    frame = reprice_trend_columns(frame, amazon)
+    margins = compute_margin_columns(supplier, amazon, google, fee_percentage)
+    opportunity = compute_opportunity_columns(frame, margins['best_margin_pct'], margins['has_amazon'])
+    predictions = compute_prediction_columns(frame, margins['has_amazon'], margins['cheapest_buy'], fee_percentage)
+    has_amazon = margins['has_amazon']
+    
+    columns = {
+        'supplier_price_eur': supplier.tolist(),
+        'amazon_price_eur': optional_list(amazon, ~np.isnan(amazon)),
+        'cheapest_source': np.where(margins['google_cheapest'], 'google', 'supplier').tolist(),
+        'cheapest_buy_price_eur': margins['cheapest_buy'].tolist(),
+        'amazon_fees_eur': optional_list(margins['fees'], has_amazon),
+        'amazon_margin_eur': optional_list(margins['best_margin_eur'], has_amazon),
+        'amazon_margin_percentage': optional_list(margins['best_margin_pct'], has_amazon),
+        'supplier_margin_eur': optional_list(margins['supplier_margin_eur'], has_amazon),
+        'supplier_margin_percentage': optional_list(margins['supplier_margin_pct'], has_amazon),
+        'google_margin_eur': optional_list(margins['google_margin_eur'], margins['has_google_margin']),
+        'google_margin_percentage': optional_list(margins['google_margin_pct'], margins['has_google_margin']),
+        'google_vs_amazon_diff_eur': optional_list(margins['google_vs_amazon_diff'], truthy(google) & has_amazon),
+        'supplier_vs_google_diff_eur': optional_list(margins['supplier_vs_google_diff'], truthy(google)),
+        'opportunity_score': opportunity['score'].tolist(),
+        'opportunity_level': opportunity['level'].tolist(),
+    }
+    details = zip(*(opportunity[factor].tolist() for factor in
+                    ('margin_score', 'trend_score', 'competition_score', 'volatility_score', 'position_score')))
+    horizons = {
+        label: tuple(values.tolist() for values in arrays)
+        for label, arrays in predictions['horizons'].items()
+    }
+    predicted_rows = predictions['predicted'].tolist()
+    current_rows = frame['current_price'].tolist()
+    current_profit_rows = predictions['current_profit'].tolist()
+    trend_rows = frame['trend'].tolist()
+    favorable_rows = frame['is_favorable'].tolist()
+    has_trend_rows = frame['has_trend'].tolist()
+    
+    updates = []
+    for i, (margin_points, trend_points, competition_points, volatility_points, position_points) in enumerate(details):
+        update = {field: values[i] for field, values in columns.items()}
+        update['opportunity_details'] = {
+            'margin_score': margin_points,
+            'trend_score': trend_points,
+            'competition_score': competition_points,
+            'volatility_score': volatility_points,
+            'position_score': position_points
+        }
+        update['profitability_predictions'] = {
+            'current': {'price': current_rows[i], 'profit_eur': current_profit_rows[i]},
+            'predictions': {
+                label: {'price': prices[i], 'profit_eur': profits[i], 'profit_change_pct': changes[i]}
+                for label, (prices, profits, changes) in horizons.items()
+            },
+            'confidence_level': str(predictions['confidence'][i]),
+            'recommendation': str(predictions['recommendation'][i]),
+            'volatility_risk': str(predictions['volatility_risk'][i]),
+            'trend_direction': trend_rows[i]
+        } if predicted_rows[i] else None
+        if has_trend_rows[i]:
+            update['price_trend.current_price'] = current_rows[i]
+            update['price_trend.trend'] = trend_rows[i]
+            update['price_trend.is_favorable'] = favorable_rows[i]
+        # Legacy fields
+        update['best_price_eur'] = update['cheapest_buy_price_eur']
+        update['margin_eur'] = update['amazon_margin_eur']
+        update['margin_percentage'] = update['amazon_margin_percentage']
+        updates.append(update)
+    return updates
+
+
+async def write_rescore_batch(operations: List[UpdateOne]) -> int:
+    """Write one batch of re-scored products with an unordered bulk_write; returns the number of failed writes"""
+    try:
+        await db.catalog_products.bulk_write(operations, ordered=False)
+    except BulkWriteError as e:
+        return len(e.details.get('writeErrors', []))
+    except Exception as e:
+        logger.error(f"Re-score bulk write failed for {len(operations)} products: {e}")
+        return len(operations)
+    return 0
+
+
+@api_router.post("/catalog/rescore")
+async def rescore_catalog(
+    refresh_exchange_rate: bool = False,
+    user: dict = Depends(get_current_user)
+):
+    """Recompute fees, margins, opportunity scores and predictions of all compared products.
     
-    # ==================== PROFITABILITY PREDICTIONS ====================
-    profitability_predictions = None
-    if price_trend and amazon_price:
-        profitability_predictions = predict_price_profitability(
-            price_trend=price_trend,
-            amazon_price=amazon_price,
-            supplier_price=cheapest_buy_price
-        )
-        if profitability_predictions:
-            logger.info(f"Profitability predictions for {product['name']}: 30d profit change = {profitability_predictions['predictions']['30d']['profit_change_pct']}%, recommendation = {profitability_predictions['recommendation']}")
+    Uses the stored Amazon/Google prices and trend statistics only (no Keepa or web search
+    call), with the current AMAZON_FEE_PERCENTAGE and marketplace exchange rates. With
+    refresh_exchange_rate=true, the GBP rate is fetched again and applied to the supplier
+    prices and to the Amazon.co.uk prices.
+    """
+    started = time.monotonic()
+    currency_rates = {domain['currency']: domain['exchange_rate'] for domain in KEEPA_EUROPEAN_DOMAINS}
+    gbp_to_eur_rate = None
+    if refresh_exchange_rate:
+        gbp_to_eur_rate = await get_exchange_rate()
+        currency_rates['GBP'] = gbp_to_eur_rate
     
-    # ==================== MULTI-MARKET ARBITRAGE ====================
-    multi_market_arbitrage = None
-    if amazon_price:  # Only analyze arbitrage if we have Amazon price data
-        multi_market_arbitrage = await analyze_multi_market_arbitrage(
-            gtin=product['gtin'],
-            supplier_price_eur=supplier_price,
-            keepa_api_key=keepa_key
-        )
-        if multi_market_arbitrage and multi_market_arbitrage.get('analysis_available'):
-            logger.info(f"Multi-market arbitrage for {product['name']}: Best sell market = {multi_market_arbitrage['best_sell_market']['country']}, arbitrage profit = €{multi_market_arbitrage['arbitrage_opportunity_eur']}")
+    products = await db.catalog_products.find(
+        {'user_id': user['id'], 'last_compared_at': {'$ne': None}}, RESCORE_PROJECTION
+    ).to_list(None)
+    if not products:
+        return {'success': True, 'rescored': 0, 'failed': 0, 'amazon_fee_percentage': AMAZON_FEE_PERCENTAGE * 100}
     
-    # Update product in database with all comparison data
-    amazon_source_domain = found_domain_info.get('name', 'Amazon.fr') if found_domain_info else ('Mock' if is_mock_data else 'Amazon.fr')
-    update_data = {
-        'amazon_price_eur': amazon_price,
-        'amazon_source_domain': amazon_source_domain,
-        'google_lowest_price_eur': google_lowest_price,
-        'google_suppliers_results': google_suppliers if google_suppliers else None,  # Store all Google suppliers
-        'cheapest_source': cheapest_source,
-        'cheapest_buy_price_eur': cheapest_buy_price,
-        'amazon_fees_eur': amazon_fees,
-        'amazon_margin_eur': best_margin['margin_eur'],
-        'amazon_margin_percentage': best_margin['margin_percentage'],
-        'supplier_margin_eur': supplier_margin['margin_eur'],
-        'supplier_margin_percentage': supplier_margin['margin_percentage'],
-        'google_margin_eur': google_margin['margin_eur'],
-        'google_margin_percentage': google_margin['margin_percentage'],
-        'google_vs_amazon_diff_eur': google_vs_amazon_diff,
-        'supplier_vs_google_diff_eur': supplier_vs_google_diff,
-        # Price trend analysis
-        'price_trend': price_trend,
-        # Opportunity score
-        'opportunity_score': opportunity['score'],
-        'opportunity_level': opportunity['level'],
-        'opportunity_details': opportunity['details'],
-        # Profitability predictions
-        'profitability_predictions': profitability_predictions,
-        # Multi-market arbitrage
-        'multi_market_arbitrage': multi_market_arbitrage,
-        # Legacy fields
-        'google_price_eur': google_lowest_price,
-        'best_price_eur': cheapest_buy_price,
-        'margin_eur': best_margin['margin_eur'],
-        'margin_percentage': best_margin['margin_percentage'],
-        'last_compared_at': datetime.now(timezone.utc).isoformat()
-    }
+    frame = build_rescore_frame(products)
+    updates = await run_analysis(rescore_frame, frame, currency_rates, gbp_to_eur_rate, AMAZON_FEE_PERCENTAGE, items=len(frame))
     
-    await db.catalog_products.update_one(
-        {'id': product_id},
-        {'$set': update_data}
-    )
+    rescored_at = datetime.now(timezone.utc).isoformat()
+    operations = [
+        UpdateOne({'id': product['id'], 'user_id': user['id']}, {'$set': {**update, 'rescored_at': rescored_at}})
+        for product, update in zip(products, updates)
+    ]
+    failed = sum(await asyncio.gather(*(
+        write_rescore_batch(operations[start:start + COMPARE_BULK_WRITE_SIZE])
+        for start in range(0, len(operations), COMPARE_BULK_WRITE_SIZE)
+    )))
     
+    logger.info(f"Re-scored {len(operations) - failed}/{len(operations)} products for user {user['id']} in {time.monotonic() - started:.2f}s")
     return {
-        'product_id': product_id,
-        'product_name': product['name'],
-        'gtin': product['gtin'],
-        'brand': product['brand'],
-        'is_mock_data': is_mock_data,
-        'search_source': search_source or ('google_search' if (google_key and google_cx) else 'mock'),
-        'amazon_source_domain': amazon_source_domain,
-        # Prices
-        'supplier_price_eur': supplier_price,
-        'amazon_price_eur': amazon_price,
-        'google_lowest_price_eur': google_lowest_price,
-        'google_suppliers_results': google_suppliers if google_suppliers else None,  # All Google suppliers
-        # Comparison
-        'cheapest_source': cheapest_source,
-        'cheapest_buy_price_eur': cheapest_buy_price,
-        'amazon_fees_eur': amazon_fees,
+        'success': True,
+        'rescored': len(operations) - failed,
+        'failed': failed,
         'amazon_fee_percentage': AMAZON_FEE_PERCENTAGE * 100,
-        # Margins
-        'supplier_margin_eur': supplier_margin['margin_eur'],
-        'supplier_margin_percentage': supplier_margin['margin_percentage'],
-        'google_margin_eur': google_margin['margin_eur'],
-        'google_margin_percentage': google_margin['margin_percentage'],
-        'best_margin_eur': best_margin['margin_eur'],
-        'best_margin_percentage': best_margin['margin_percentage'],
-        # Differences
-        'google_vs_amazon_diff_eur': google_vs_amazon_diff,
-        'supplier_vs_google_diff_eur': supplier_vs_google_diff,
-        # Price trend analysis
-        'price_trend': price_trend,
-        # Opportunity score
-        'opportunity_score': opportunity['score'],
-        'opportunity_level': opportunity['level'],
-        'opportunity_details': opportunity['details'],
-        # Profitability predictions
-        'profitability_predictions': profitability_predictions,
-        # Multi-market arbitrage
-        'multi_market_arbitrage': multi_market_arbitrage,
-        'compared_at': datetime.now(timezone.utc).isoformat()
+        'gbp_to_eur_rate': gbp_to_eur_rate
     }
 
-@api_router.post("/catalog/compare-batch")
-async def compare_batch(
-    product_ids: List[str],
-    user: dict = Depends(get_current_user)
-):
-    """Compare multiple products in batch"""
-    results = []
-    errors = []
-    
-    for product_id in product_ids:
-        try:
-            result = await compare_catalog_product(product_id, user)
-            results.append(result)
-        except Exception as e:
-            errors.append({'product_id': product_id, 'error': str(e)})
-    
+
+# ==================== WHAT-IF SIMULATION ====================
+
+# Re-score frames of the compared products, kept per user for the simulator and rebuilt
+# when the compared set changes (see get_simulation_frame); least recently used users are dropped.
+SIMULATION_CACHE_MAX_USERS = int(os.environ.get('SIMULATION_CACHE_MAX_USERS', 8))
+SIMULATION_MARGIN_BUCKETS = [
+    (-np.inf, 0, 'negative'), (0, 10, '0-10'), (10, 30, '10-30'), (30, 50, '30-50'), (50, np.inf, '50+')
+]
+simulation_frames: OrderedDict = OrderedDict()  # user_id -> (fingerprint, frame)
+
+
+async def get_simulation_frame(user_id: str) -> pd.DataFrame:
+    """Re-score frame of the user's compared products, reloaded only after a compare, re-score or delete"""
+    query = {'user_id': user_id, 'last_compared_at': {'$ne': None}}
+    stats = await db.catalog_products.aggregate([
+        {'$match': query},
+        {'$group': {'_id': None, 'count': {'$sum': 1}, 'compared': {'$max': '$last_compared_at'}, 'rescored': {'$max': '$rescored_at'}}}
+    ]).to_list(1)
+    fingerprint = (stats[0]['count'], stats[0]['compared'], stats[0]['rescored']) if stats else (0, None, None)
+    
+    cached = simulation_frames.get(user_id)
+    if cached and cached[0] == fingerprint:
+        simulation_frames.move_to_end(user_id)
+        return cached[1]
+    
+    products = await db.catalog_products.find(query, RESCORE_PROJECTION).to_list(None)
+    frame = build_rescore_frame(products)
+    frame['category_key'] = frame['category'].fillna('').astype(str).str.strip().str.lower()
+    simulation_frames[user_id] = (fingerprint, frame)
+    simulation_frames.move_to_end(user_id)
+    while len(simulation_frames) > SIMULATION_CACHE_MAX_USERS:
+        simulation_frames.popitem(last=False)
+    return frame
+
+
+def category_values(frame: pd.DataFrame, default: float, by_category: Dict[str, float]) -> np.ndarray:
+    """Per-product value of a {category: value} mapping (case-insensitive), default for the other categories"""
+    if not by_category:
+        return np.full(len(frame), default, dtype=np.float64)
+    values = {category.strip().lower(): value for category, value in by_category.items()}
+    return frame['category_key'].map(values).fillna(default).to_numpy(dtype=np.float64)
+
+
+def summarize_simulation(frame: pd.DataFrame, margins: dict, opportunity: dict) -> dict:
+    """Catalog totals (as /catalog/stats), margin distribution and opportunity levels"""
+    has_amazon = margins['has_amazon']
+    margin_eur = margins['best_margin_eur'][has_amazon]
+    margin_percentage = margins['best_margin_pct'][has_amazon]
+    priced = len(margin_eur)
     return {
-        'success': len(results),
-        'failed': len(errors),
-        'results': results,
-        'errors': errors
+        'priced_products': priced,
+        'profitable_products': int((margin_eur > 0).sum()),
+        'total_potential_margin': round(float(margin_eur.sum()), 2),
+        'avg_margin_percentage': round(float(margin_percentage.mean()), 2) if priced else 0,
+        'best_opportunity_margin': round(float(margin_eur.max()), 2) if priced else 0,
+        'avg_opportunity_score': round(float(opportunity['score'].mean()), 1) if len(frame) else 0,
+        'margin_distribution': {
+            label: int(((margin_percentage >= low) & (margin_percentage < high)).sum())
+            for low, high, label in SIMULATION_MARGIN_BUCKETS
+        },
+        'opportunity_levels': {
+            level: int((opportunity['level'] == level).sum())
+            for level in ('Excellent', 'Bon', 'Moyen', 'Faible')
+        }
     }
 
-@api_router.post("/catalog/compare-all")
-async def compare_all_products(
+
+def summarize_simulation_categories(frame: pd.DataFrame, margins: dict, fee_rates: np.ndarray) -> List[dict]:
+    """Simulated totals per category, by total margin"""
+    has_amazon = margins['has_amazon']
+    table = pd.DataFrame({
+        'category': frame['category'].fillna('').to_numpy()[has_amazon],
+        'margin_eur': margins['best_margin_eur'][has_amazon],
+        'margin_percentage': margins['best_margin_pct'][has_amazon],
+        'fee_percentage': fee_rates[has_amazon] * 100
+    })
+    table['profitable'] = table['margin_eur'] > 0
+    grouped = table.groupby('category').agg(
+        products=('margin_eur', 'size'),
+        profitable_products=('profitable', 'sum'),
+        total_potential_margin=('margin_eur', 'sum'),
+        avg_margin_percentage=('margin_percentage', 'mean'),
+        fee_percentage=('fee_percentage', 'first')
+    ).sort_values('total_potential_margin', ascending=False)
+    return [
+        {
+            'category': category,
+            'products': int(row.products),
+            'profitable_products': int(row.profitable_products),
+            'total_potential_margin': round(float(row.total_potential_margin), 2),
+            'avg_margin_percentage': round(float(row.avg_margin_percentage), 2),
+            'amazon_fee_percentage': round(float(row.fee_percentage), 2)
+        }
+        for category, row in zip(grouped.index, grouped.itertuples())
+    ]
+
+
+def top_simulated_products(frame: pd.DataFrame, supplier: np.ndarray, amazon: np.ndarray, margins: dict,
+                           opportunity: dict, fee_rates: np.ndarray, top_n: int) -> List[dict]:
+    """Best simulated opportunities, by opportunity score then margin (as /catalog/opportunities)"""
+    candidates = np.flatnonzero(margins['has_amazon'])
+    order = np.lexsort((-margins['best_margin_eur'][candidates], -opportunity['score'][candidates]))
+    return [
+        {
+            'product_id': frame['id'].iat[i],
+            'name': frame['name'].iat[i],
+            'gtin': frame['gtin'].iat[i],
+            'category': frame['category'].iat[i],
+            'supplier_price_eur': float(supplier[i]),
+            'amazon_price_eur': float(amazon[i]),
+            'cheapest_source': 'google' if margins['google_cheapest'][i] else 'supplier',
+            'cheapest_buy_price_eur': float(margins['cheapest_buy'][i]),
+            'amazon_fee_percentage': round(float(fee_rates[i]) * 100, 2),
+            'amazon_fees_eur': float(margins['fees'][i]),
+            'margin_eur': float(margins['best_margin_eur'][i]),
+            'margin_percentage': float(margins['best_margin_pct'][i]),
+            'opportunity_score': int(opportunity['score'][i]),
+            'opportunity_level': str(opportunity['level'][i])
+        }
+        for i in candidates[order[:max(top_n, 0)]]
+    ]
+
+
+@api_router.post("/catalog/simulate")
+async def simulate_catalog(
+    request: CatalogSimulationRequest,
     user: dict = Depends(get_current_user)
 ):
-    """Compare ALL products in the catalog for the current user"""
-    # Fetch all product IDs for this user
-    all_products = await db.catalog_products.find(
-        {'user_id': user['id']},
-        {'id': 1, '_id': 0}
-    ).to_list(10000)
-    
-    if not all_products:
-        raise HTTPException(status_code=404, detail="Aucun produit dans le catalogue")
-    
-    product_ids = [p['id'] for p in all_products]
-    total = len(product_ids)
+    """What-if on Amazon fees, exchange rates and supplier prices over the compared products.
     
-    results = []
-    errors = []
+    Margins and opportunity scores are recomputed from the stored prices and trend statistics
+    (as /catalog/rescore) on a cached frame of the catalog; nothing is fetched or written.
+    Fee and supplier price changes are in %, globally and per category; exchange_rates
+    override the marketplace rates, and GBP also converts the supplier prices again.
+    """
+    started = time.monotonic()
+    frame = await get_simulation_frame(user['id'])
+    marketplace_rates = {domain['currency']: domain['exchange_rate'] for domain in KEEPA_EUROPEAN_DOMAINS}
+    google = frame['google_lowest_price'].to_numpy()
+    
+    # Baseline: current fee percentage and marketplace exchange rates
+    supplier, amazon = convert_frame_prices(frame, marketplace_rates, None)
+    baseline_margins = compute_margin_columns(supplier, amazon, google, AMAZON_FEE_PERCENTAGE)
+    baseline_opportunity = compute_opportunity_columns(
+        reprice_trend_columns(frame, amazon), baseline_margins['best_margin_pct'], baseline_margins['has_amazon']
+    )
+    baseline = summarize_simulation(frame, baseline_margins, baseline_opportunity)
     
-    for product_id in product_ids:
-        try:
-            result = await compare_catalog_product(product_id, user)
-            results.append(result)
-        except Exception as e:
-            errors.append({'product_id': product_id, 'error': str(e)})
+    exchange_rates = {currency.upper(): rate for currency, rate in request.exchange_rates.items()}
+    fee_rates = category_values(
+        frame,
+        request.fee_percentage / 100 if request.fee_percentage is not None else AMAZON_FEE_PERCENTAGE,
+        {category: percentage / 100 for category, percentage in request.category_fee_percentages.items()}
+    )
+    supplier_changes = category_values(frame, request.supplier_price_change_percentage, request.category_supplier_price_changes)
+    supplier, amazon = convert_frame_prices(frame, {**marketplace_rates, **exchange_rates}, exchange_rates.get('GBP'))
+    supplier = round_decimals(supplier * (1 + supplier_changes / 100), 2)
+    margins = compute_margin_columns(supplier, amazon, google, fee_rates)
+    opportunity = compute_opportunity_columns(reprice_trend_columns(frame, amazon), margins['best_margin_pct'], margins['has_amazon'])
+    simulated = summarize_simulation(frame, margins, opportunity)
     
     return {
-        'total': total,
-        'success': len(results),
-        'failed': len(errors),
-        'results': results,
-        'errors': errors
+        'products': len(frame),
+        'parameters': {
+            'amazon_fee_percentage': request.fee_percentage if request.fee_percentage is not None else AMAZON_FEE_PERCENTAGE * 100,
+            'category_fee_percentages': request.category_fee_percentages,
+            'exchange_rates': {**marketplace_rates, **exchange_rates},
+            'supplier_price_change_percentage': request.supplier_price_change_percentage,
+            'category_supplier_price_changes': request.category_supplier_price_changes
+        },
+        'baseline': baseline,
+        'simulated': simulated,
+        'delta': {
+            field: round(simulated[field] - baseline[field], 2)
+            for field in ('profitable_products', 'total_potential_margin', 'avg_margin_percentage', 'avg_opportunity_score')
+        },
+        'categories': summarize_simulation_categories(frame, margins, fee_rates),
+        'top_products': top_simulated_products(frame, supplier, amazon, margins, opportunity, fee_rates, request.top_n),
+        'duration_ms': round((time.monotonic() - started) * 1000)
     }
 
+
 @api_router.get("/catalog/opportunities")
 async def get_opportunities(
     user: dict = Depends(get_current_user),
@@ -3150,6 +6357,353 @@ async def export_catalog(
         headers=headers
     )
 
+# ==================== COMPARE JOBS ====================
+
+# Catalog compares run as background jobs tracked in `compare_jobs`: the catalog is
+# loaded chunk by chunk (sorted by id) and each chunk goes through the staged compare
+# pipeline. After each chunk the job is checkpointed (last product id + counters), and
+# the process running it holds a lease it renews with a heartbeat. Jobs whose lease
+# expired (process killed or restarted) are resumed from their checkpoint by any process.
+COMPARE_JOB_WORKERS = int(os.environ.get('COMPARE_JOB_WORKERS', COMPARE_BATCH_CONCURRENCY))
+COMPARE_JOB_CHUNK_SIZE = COMPARE_BULK_WRITE_SIZE  # One bulk write (and checkpoint) per chunk
+COMPARE_JOB_MAX_ERRORS = 100  # Per-product errors kept on the job document
+COMPARE_JOB_LEASE_SECONDS = int(os.environ.get('COMPARE_JOB_LEASE_SECONDS', 120))
+COMPARE_JOB_HEARTBEAT_SECONDS = COMPARE_JOB_LEASE_SECONDS / 4
+COMPARE_WORKER_ID = str(uuid.uuid4())  # Lease owner id of this process
+
+compare_job_tasks: Dict[str, asyncio.Task] = {}
+compare_job_watchdog_task: Optional[asyncio.Task] = None
+
+
+def compare_job_lease_expiry() -> str:
+    return (datetime.now(timezone.utc) + timedelta(seconds=COMPARE_JOB_LEASE_SECONDS)).isoformat()
+
+
+class CompareJobRunner:
+    """Run one compare job (from its checkpoint, if any) and keep its progress document up to date"""
+
+    def __init__(self, job: dict, user: dict):
+        self.job_id = job['id']
+        self.user = user
+        self.ctx = CompareContext(user, concurrency=COMPARE_JOB_WORKERS, dataforseo_queue=job.get('dataforseo_queue', False))
+        self.stale_before = job.get('stale_before')
+        self.total = job['total']
+        self.checkpoint_id = job.get('checkpoint_id')
+        self.started_at = job.get('started_at')
+        # The counters go with the checkpoint: a job without one starts over
+        counters = job if self.checkpoint_id else {}
+        self.processed = counters.get('processed', 0)
+        self.succeeded = counters.get('succeeded', 0)
+        self.failed = counters.get('failed', 0)
+        self.resumed_from = self.processed  # Throughput only counts this run
+        self.pending_errors: List[dict] = []
+        self.started = time.monotonic()
+        self.cancel_requested = job.get('cancel_requested', False)
+        self.lease_lost = False
+        self.task: Optional[asyncio.Task] = None
+
+    def progress(self) -> dict:
+        elapsed = time.monotonic() - self.started
+        throughput = (self.processed - self.resumed_from) / elapsed * 60 if elapsed > 0 else 0
+        remaining = max(self.total - self.processed, 0)
+        return {
+            'processed': self.processed,
+            'succeeded': self.succeeded,
+            'failed': self.failed,
+            'checkpoint_id': self.checkpoint_id,
+            'throughput_per_min': round(throughput, 1),
+            'eta_seconds': round(remaining / throughput * 60) if throughput > 0 else None,
+            'updated_at': datetime.now(timezone.utc).isoformat()
+        }
+
+    async def flush(self, **fields):
+        """Write the progress and checkpoint, and pick up cancel requests"""
+        update = {'$set': {**self.progress(), **fields}}
+        if self.pending_errors:
+            update['$push'] = {'errors': {'$each': self.pending_errors, '$slice': COMPARE_JOB_MAX_ERRORS}}
+            self.pending_errors = []
+        job = await db.compare_jobs.find_one_and_update(
+            {'id': self.job_id}, update, projection={'_id': 0, 'cancel_requested': 1}
+        )
+        self.cancel_requested = bool(job and job.get('cancel_requested'))
+
+    async def finish(self, status: str, **fields):
+        await self.flush(
+            status=status,
+            finished_at=datetime.now(timezone.utc).isoformat(),
+            lease_owner=None,
+            lease_expires_at=None,
+            **fields
+        )
+
+    async def compare_chunk(self, product_ids: List[str], dataforseo_batch: Optional[DataForSEOQueueBatch] = None):
+        results, errors, _ = await run_compare_pipeline(self.ctx, product_ids, dataforseo_batch=dataforseo_batch)
+        self.succeeded += len(results)
+        self.failed += len(errors)
+        self.pending_errors.extend(errors)
+        self.processed += len(product_ids)
+        self.checkpoint_id = product_ids[-1]
+        await self.flush()
+
+    async def start_queue_batch(self, product_ids: List[str]) -> Optional[DataForSEOQueueBatch]:
+        """Queue the Google Shopping tasks of a chunk (None without the DataForSEO queue)"""
+        if not (self.ctx.dataforseo_queue and self.ctx.use_dataforseo):
+            return None
+        products = await db.catalog_products.find(
+            {'user_id': self.user['id'], 'id': {'$in': product_ids}},
+            {'_id': 0, 'id': 1, 'brand': 1, 'name': 1, 'gtin': 1}
+        ).to_list(None)
+        batch = DataForSEOQueueBatch(
+            self.ctx.dataforseo_login, self.ctx.dataforseo_password, self.user['id'], products, job_id=self.job_id
+        )
+        batch.start()
+        return batch
+
+    async def produce(self):
+        """
+        Load the catalog chunk by chunk after the checkpoint and compare each chunk, until done or cancelled.
+        
+        With the DataForSEO queue, the tasks of the next DATAFORSEO_QUEUE_LOOKAHEAD_CHUNKS chunks
+        are queued while a chunk is compared, so that their turnarounds overlap.
+        """
+        query = build_compare_products_query(self.user['id'], self.stale_before)
+        lookahead = DATAFORSEO_QUEUE_LOOKAHEAD_CHUNKS if self.ctx.dataforseo_queue and self.ctx.use_dataforseo else 0
+        queued: deque = deque()  # (product ids, DataForSEO batch) of the chunks read ahead
+        try:
+            async for chunk in iter_compare_product_chunks(query, COMPARE_JOB_CHUNK_SIZE, after_id=self.checkpoint_id):
+                if self.cancel_requested:
+                    return
+                queued.append((chunk, await self.start_queue_batch(chunk)))
+                if len(queued) > lookahead:
+                    await self.compare_chunk(*queued.popleft())
+            while queued:
+                if self.cancel_requested:
+                    return
+                await self.compare_chunk(*queued.popleft())
+        finally:
+            # Their recorded tasks are picked up by the next run of the job (or drained)
+            for _, batch in queued:
+                if batch:
+                    await batch.close()
+
+    async def heartbeat(self):
+        """Renew the lease; stop the job if it was cancelled (possibly from another process) or the lease was taken over"""
+        while True:
+            await asyncio.sleep(COMPARE_JOB_HEARTBEAT_SECONDS)
+            job = await db.compare_jobs.find_one_and_update(
+                {'id': self.job_id, 'lease_owner': COMPARE_WORKER_ID},
+                {'$set': {'lease_expires_at': compare_job_lease_expiry()}},
+                projection={'_id': 0, 'cancel_requested': 1}
+            )
+            if job is None:
+                logger.warning(f"Compare job {self.job_id}: lease lost, stopping")
+                self.lease_lost = True
+                self.task.cancel()
+                return
+            if job.get('cancel_requested'):
+                self.task.cancel()
+                return
+
+    async def run(self):
+        self.task = asyncio.current_task()
+        await db.compare_jobs.update_one(
+            {'id': self.job_id},
+            {'$set': {'status': 'running', 'started_at': self.started_at or datetime.now(timezone.utc).isoformat()}}
+        )
+        heartbeat = asyncio.create_task(self.heartbeat())
+        try:
+            await self.produce()
+            status = 'cancelled' if self.cancel_requested else 'completed'
+            await self.finish(status)
+            logger.info(f"Compare job {self.job_id} {status}: {self.succeeded} compared, {self.failed} errors out of {self.total}")
+        except asyncio.CancelledError:
+            if self.lease_lost:
+                raise  # Another process resumed the job: leave its document alone
+            await self.flush()
+            if self.cancel_requested:
+                await self.finish('cancelled')
+                logger.info(f"Compare job {self.job_id} cancelled after {self.processed}/{self.total} products")
+            else:
+                # Server shutdown: release the lease so that another process resumes the job right away
+                await self.flush(lease_owner=None, lease_expires_at=None)
+                logger.info(f"Compare job {self.job_id} interrupted after {self.processed}/{self.total} products, checkpoint {self.checkpoint_id}")
+            raise
+        except Exception as e:
+            logger.error(f"Compare job {self.job_id} failed: {e}")
+            await self.finish('failed', error=str(e))
+        finally:
+            heartbeat.cancel()
+
+
+def launch_compare_job(job: dict, user: dict) -> asyncio.Task:
+    """Run a (claimed) compare job in the background of this process"""
+    task = asyncio.create_task(CompareJobRunner(job, user).run())
+    compare_job_tasks[job['id']] = task
+    task.add_done_callback(lambda _: compare_job_tasks.pop(job['id'], None))
+    return task
+
+
+async def claim_compare_job(query: dict, **fields) -> Optional[dict]:
+    """Take the lease of a job matching query whose lease is free or expired; returns the updated job"""
+    return await db.compare_jobs.find_one_and_update(
+        {
+            **query,
+            '$or': [
+                {'lease_expires_at': None},
+                {'lease_expires_at': {'$lt': datetime.now(timezone.utc).isoformat()}}
+            ]
+        },
+        {'$set': {'lease_owner': COMPARE_WORKER_ID, 'lease_expires_at': compare_job_lease_expiry(), **fields}},
+        projection={'_id': 0},
+        return_document=ReturnDocument.AFTER
+    )
+
+
+async def resume_orphaned_compare_jobs() -> int:
+    """Resume the queued/running jobs whose process died (expired lease) from their checkpoint"""
+    resumed = 0
+    while True:
+        job = await claim_compare_job({'status': {'$in': ['queued', 'running']}})
+        if not job:
+            return resumed
+        user = await db.users.find_one({'id': job['user_id']}, {'_id': 0})
+        if not user:
+            await db.compare_jobs.update_one(
+                {'id': job['id']},
+                {'$set': {'status': 'failed', 'error': 'User not found', 'finished_at': datetime.now(timezone.utc).isoformat(), 'lease_owner': None, 'lease_expires_at': None}}
+            )
+            continue
+        logger.info(f"Resuming compare job {job['id']} at {job.get('processed', 0)}/{job['total']} (checkpoint {job.get('checkpoint_id')})")
+        launch_compare_job(job, user)
+        resumed += 1
+
+
+async def compare_job_watchdog():
+    while True:
+        try:
+            await resume_orphaned_compare_jobs()
+        except Exception as e:
+            logger.warning(f"Compare jobs watchdog error: {e}")
+        try:
+            await drain_dataforseo_tasks()
+        except Exception as e:
+            logger.warning(f"DataForSEO tasks drain error: {e}")
+        await asyncio.sleep(COMPARE_JOB_LEASE_SECONDS)
+
+
+async def start_compare_job(user: dict, incremental: bool = False, max_age_hours: Optional[float] = None,
+                            dataforseo_queue: bool = True) -> dict:
+    """Create a compare job for the user's catalog (only stale products if incremental) and start it in the background"""
+    catalog_size = await db.catalog_products.count_documents({'user_id': user['id']})
+    if catalog_size == 0:
+        raise HTTPException(status_code=404, detail="Aucun produit dans le catalogue")
+    
+    # Fixed at creation so that the products compared by the job drop out of its query
+    stale_before = get_compare_stale_before(max_age_hours) if incremental else None
+    total = await db.catalog_products.count_documents(build_compare_products_query(user['id'], stale_before))
+    
+    job = {
+        'id': str(uuid.uuid4()),
+        'user_id': user['id'],
+        'status': 'queued',
+        'incremental': incremental,
+        'stale_before': stale_before,
+        'dataforseo_queue': dataforseo_queue,
+        'total': total,
+        'skipped': catalog_size - total,
+        'processed': 0,
+        'succeeded': 0,
+        'failed': 0,
+        'checkpoint_id': None,
+        'throughput_per_min': 0,
+        'eta_seconds': None,
+        'errors': [],
+        'cancel_requested': False,
+        'lease_owner': COMPARE_WORKER_ID,
+        'lease_expires_at': compare_job_lease_expiry(),
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'started_at': None,
+        'finished_at': None
+    }
+    await db.compare_jobs.insert_one(job)
+    job.pop('_id', None)
+    
+    launch_compare_job(job, user)
+    return job
+
+
+@api_router.post("/catalog/compare-jobs")
+async def create_compare_job(
+    incremental: bool = False,
+    max_age_hours: Optional[float] = None,
+    dataforseo_queue: bool = True,
+    user: dict = Depends(get_current_user)
+):
+    """Start comparing the catalog in the background; poll the returned job for progress.
+    
+    incremental=true skips the products compared within max_age_hours whose inputs did not change.
+    With Google Shopping enabled, the DataForSEO searches go through the standard queue
+    (cheaper, results within minutes) unless dataforseo_queue=false selects the live endpoint.
+    """
+    job = await start_compare_job(user, incremental=incremental, max_age_hours=max_age_hours, dataforseo_queue=dataforseo_queue)
+    return {'job_id': job['id'], 'status': job['status'], 'total': job['total'], 'skipped': job['skipped']}
+
+@api_router.get("/catalog/compare-jobs")
+async def list_compare_jobs(limit: int = 20, user: dict = Depends(get_current_user)):
+    """List the user's most recent compare jobs"""
+    jobs = await db.compare_jobs.find(
+        {'user_id': user['id']},
+        {'_id': 0, 'errors': 0}
+    ).sort('created_at', -1).to_list(limit)
+    return {'jobs': jobs}
+
+@api_router.get("/catalog/compare-jobs/{job_id}")
+async def get_compare_job(job_id: str, user: dict = Depends(get_current_user)):
+    """Get the progress of a compare job (processed, throughput, ETA, errors)"""
+    job = await db.compare_jobs.find_one({'id': job_id, 'user_id': user['id']}, {'_id': 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@api_router.post("/catalog/compare-jobs/{job_id}/cancel")
+async def cancel_compare_job(job_id: str, user: dict = Depends(get_current_user)):
+    """Cancel a queued or running compare job"""
+    result = await db.compare_jobs.update_one(
+        {'id': job_id, 'user_id': user['id'], 'status': {'$in': ['queued', 'running']}},
+        {'$set': {'cancel_requested': True}}
+    )
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="No running job with this id")
+    
+    task = compare_job_tasks.get(job_id)
+    if task:
+        task.cancel()
+    return {'success': True, 'job_id': job_id, 'status': 'cancelling'}
+
+@api_router.post("/catalog/compare-jobs/{job_id}/resume")
+async def resume_compare_job(job_id: str, user: dict = Depends(get_current_user)):
+    """Resume an interrupted, failed or cancelled compare job from its last checkpoint"""
+    job = await claim_compare_job(
+        {'id': job_id, 'user_id': user['id'], 'status': {'$in': ['queued', 'running', 'failed', 'cancelled']}},
+        status='queued', cancel_requested=False, error=None, finished_at=None
+    )
+    if not job:
+        existing = await db.compare_jobs.find_one({'id': job_id, 'user_id': user['id']}, {'_id': 0, 'status': 1})
+        if not existing:
+            raise HTTPException(status_code=404, detail="Job not found")
+        if existing['status'] == 'completed':
+            raise HTTPException(status_code=409, detail="Job already completed")
+        raise HTTPException(status_code=409, detail="Job is already running")
+    
+    launch_compare_job(job, user)
+    return {
+        'success': True,
+        'job_id': job_id,
+        'status': job['status'],
+        'processed': job['processed'] if job.get('checkpoint_id') else 0,
+        'total': job['total']
+    }
+
 # ==================== DASHBOARD STATS ====================
 
 @api_router.get("/dashboard/stats")
@@ -3195,6 +6749,57 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+async def create_indexes():
+    try:
+        await db.keepa_cache.create_index('key', unique=True)
+        await db.keepa_cache.create_index('expires_at', expireAfterSeconds=0)
+        await db.keepa_price_histories.create_index([('asin', 1), ('domain', 1), ('csv_type', 1)], unique=True)
+        await db.gtin_asin_index.create_index('gtin', unique=True)
+        await db.keepa_negative_cache.create_index('key', unique=True)
+        await db.keepa_negative_cache.create_index('gtin')
+        await db.keepa_negative_cache.create_index('expires_at', expireAfterSeconds=0)
+        await db.compare_jobs.create_index([('user_id', 1), ('created_at', -1)])
+        await db.compare_jobs.create_index('id', unique=True)
+        await db.compare_jobs.create_index([('status', 1), ('lease_expires_at', 1)])
+        await db.catalog_products.create_index([('user_id', 1), ('last_compared_at', 1)])
+        await db.catalog_products.create_index([('user_id', 1), ('gtin', 1)])
+        await db.web_search_cache.create_index('key', unique=True)
+        await db.web_search_cache.create_index('expires_at', expireAfterSeconds=0)
+        await db.dataforseo_tasks.create_index('task_id', unique=True)
+        await db.dataforseo_tasks.create_index([('user_id', 1), ('key', 1)])
+        await db.dataforseo_tasks.create_index('posted_at')
+        await db.dataforseo_tasks.create_index('expires_at', expireAfterSeconds=0)
+    except Exception as e:
+        logger.warning(f"Index creation error: {e}")
+
+@app.on_event("startup")
+async def start_compare_job_watchdog():
+    # Resumes the jobs left behind by a previous (or another) process, now and whenever a lease expires
+    global compare_job_watchdog_task
+    compare_job_watchdog_task = asyncio.create_task(compare_job_watchdog())
+
+@app.on_event("startup")
+async def start_analysis_executor():
+    get_analysis_executor()
+
+@app.on_event("startup")
+async def startup_http_clients():
+    for provider in HTTP_CLIENT_CONFIGS:
+        get_http_client(provider)
+
+@app.on_event("shutdown")
+async def release_compare_jobs():
+    # Interrupted jobs checkpoint and release their lease, to be resumed by the next process
+    tasks = list(compare_job_tasks.values())
+    if compare_job_watchdog_task:
+        tasks.append(compare_job_watchdog_task)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    shutdown_analysis_executor()
+    await close_http_clients()
     client.close()
@@ -253,7 +253,7 @@ const Catalog = () => {
     setComparing(true);
     setExpandedProduct(productId);
     try {
-      const response = await api.post(`/catalog/compare/${productId}`);
+      const response = await api.post(`/catalog/compare/${productId}`, null, { params: { race: true } });
       setCompareResult(response.data);
       toast.success(`Prix comparés pour ${response.data.product_name}`);
       fetchProducts();
@@ -288,6 +288,36 @@ const Catalog = () => {
   };
 
   const [comparingAll, setComparingAll] = useState(false);
+  const [compareJob, setCompareJob] = useState(null);
+
+  const pollCompareJob = async (jobId) => {
+    try {
+      const response = await api.get(`/catalog/compare-jobs/${jobId}`);
+      const job = response.data;
+      setCompareJob(job);
+      if (job.status === "queued" || job.status === "running") {
+        setTimeout(() => pollCompareJob(jobId), 2000);
+        return;
+      }
+      if (job.status === "completed") {
+        toast.success(
+          `Recherche terminée ! ${job.succeeded} produits comparés sur ${job.total}, ${job.failed} erreurs`
+        );
+      } else if (job.status === "cancelled") {
+        toast.info(`Recherche annulée après ${job.processed} produits sur ${job.total}`);
+      } else {
+        toast.error(job.error || "Erreur lors de la recherche globale");
+      }
+      setComparingAll(false);
+      setCompareJob(null);
+      fetchProducts();
+      fetchStats();
+    } catch (error) {
+      toast.error("Erreur lors du suivi de la recherche globale");
+      setComparingAll(false);
+      setCompareJob(null);
+    }
+  };
 
   const handleCompareAll = async () => {
     if (!window.confirm(`Rechercher les prix pour TOUS les produits du catalogue (${totalProducts} produits) ? Cette opération peut prendre quelques minutes.`)) {
@@ -296,19 +326,24 @@ const Catalog = () => {
 
     setComparingAll(true);
     try {
-      const response = await api.post("/catalog/compare-all", {}, { timeout: 300000 });
-      toast.success(
-        `Recherche terminée ! ${response.data.success} produits comparés sur ${response.data.total}, ${response.data.failed} erreurs`
-      );
-      fetchProducts();
-      fetchStats();
+      const response = await api.post("/catalog/compare-jobs");
+      setCompareJob({ id: response.data.job_id, status: response.data.status, processed: 0, total: response.data.total });
+      pollCompareJob(response.data.job_id);
     } catch (error) {
       toast.error(error.response?.data?.detail || "Erreur lors de la recherche globale");
-    } finally {
       setComparingAll(false);
     }
   };
 
+  const handleCancelCompareAll = async () => {
+    if (!compareJob) return;
+    try {
+      await api.post(`/catalog/compare-jobs/${compareJob.id}/cancel`);
+    } catch (error) {
+      toast.error("Erreur lors de l'annulation");
+    }
+  };
+
   const handleExport = async () => {
     try {
       const response = await api.get("/catalog/export", {
@@ -965,7 +1000,8 @@ const Catalog = () => {
                       {comparingAll ? (
                         <>
                           <Loader2 className="w-4 h-4 mr-2 animate-spin" />
-                          Recherche en cours...
+                          Recherche en cours... {compareJob ? `${compareJob.processed}/${compareJob.total}` : ""}
+                          {compareJob?.eta_seconds != null && ` (~${Math.ceil(compareJob.eta_seconds / 60)} min)`}
                         </>
                       ) : (
                         <>
@@ -974,6 +1010,16 @@ const Catalog = () => {
                         </>
                       )}
                     </Button>
+                    {comparingAll && compareJob && (
+                      <Button
+                        onClick={handleCancelCompareAll}
+                        variant="outline"
+                        className="border-zinc-700 text-zinc-300"
+                      >
+                        <X className="w-4 h-4 mr-2" />
+                        Annuler
+                      </Button>
+                    )}
                     {selectedProducts.length > 0 && (
                       <Button
                         onClick={handleCompareBatch}
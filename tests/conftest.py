@@ -0,0 +1,151 @@
+"""
+Shared fixtures: the backend module with an in-memory Mongo (mongomock-motor) and
+a fake Keepa API behind the provider HTTP clients (httpx.MockTransport).
+"""
+import os
+import sys
+from pathlib import Path
+
+import httpx
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+from pymongo import ReturnDocument
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'backend'))
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'test_database')
+
+import server  # noqa: E402
+
+
+USER = {'id': 'user-1', 'email': 'user@example.com', 'api_keys': {'keepa_api_key': 'keepa-key'}}
+
+
+def keepa_product(asin: str, ean: str, price_cents: int = 1999, history: list = None) -> dict:
+    """Minimal Keepa /product entry with a current Amazon price"""
+    return {
+        'asin': asin,
+        'title': f'Product {asin}',
+        'eanList': [ean],
+        'stats': {'current': [price_cents]},
+        'csv': [history or []]
+    }
+
+
+def recent_history(prices_cents: list, days_between: int = 1) -> list:
+    """Interleaved Keepa csv series ending now, one point every days_between days"""
+    now = int(server.keepa_minutes_now())
+    series = []
+    for age, price in zip(range(len(prices_cents) - 1, -1, -1), prices_cents):
+        series += [now - age * days_between * 1440, price]
+    return series
+
+
+class FakeKeepa:
+    """Keepa API double: products per (domain, code or ASIN), every request recorded.
+
+    rate_limited(domain, times) makes the next `times` product requests on a domain answer 429.
+    """
+
+    def __init__(self):
+        self.products = {}
+        self.requests = []
+        self.rate_limits = {}
+
+    def add(self, domain: int, product: dict):
+        self.products[(domain, product['asin'])] = product
+        for ean in product.get('eanList') or []:
+            self.products[(domain, ean)] = product
+
+    def rate_limited(self, domain: int, times: int):
+        self.rate_limits[domain] = times
+
+    def product_requests(self, domain: int = None) -> list:
+        """(domain, code type, [codes]) of the /product requests sent so far"""
+        calls = []
+        for request in self.requests:
+            params = request.url.params
+            if request.url.path != '/product':
+                continue
+            code_type = 'code' if 'code' in params else 'asin'
+            call = (int(params['domain']), code_type, params[code_type].split(','))
+            if domain is None or call[0] == domain:
+                calls.append(call)
+        return calls
+
+    def handler(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        tokens = {'tokensLeft': 1000, 'refillIn': 10, 'refillRate': 20}
+        if request.url.host != 'api.keepa.com':
+            return httpx.Response(404, json={})
+        params = request.url.params
+        if request.url.path == '/token':
+            return httpx.Response(200, json=tokens)
+        if request.url.path == '/search':
+            return httpx.Response(200, json={'asinList': [], **tokens})
+        domain = int(params['domain'])
+        if self.rate_limits.get(domain):
+            self.rate_limits[domain] -= 1
+            return httpx.Response(429, json={**tokens, 'tokensLeft': -1})
+        codes = (params.get('code') or params.get('asin')).split(',')
+        products = [self.products[(domain, code)] for code in codes if (domain, code) in self.products]
+        return httpx.Response(200, json={'products': products, **tokens})
+
+
+@pytest.fixture(autouse=True)
+def backend(monkeypatch):
+    """Fresh in-memory database and process caches for each test"""
+    monkeypatch.setattr(server, 'db', AsyncMongoMockClient()['test'])
+    monkeypatch.setattr(server, 'keepa_cache', server.KeepaResponseCache(server.KEEPA_CACHE_LRU_BYTES))
+    monkeypatch.setattr(server, 'keepa_token_buckets', {})
+    monkeypatch.setattr(server, 'web_search_cache', server.WebSearchCache(server.WEB_SEARCH_CACHE_LRU_SIZE))
+    monkeypatch.setattr(server, 'provider_semaphores', {})
+    monkeypatch.setattr(server, 'provider_latencies', {})
+    monkeypatch.setattr(server, 'simulation_frames', server.OrderedDict())
+    monkeypatch.setattr(server, 'compare_job_tasks', {})
+    # Analysis stays inline: no process pool in tests
+    monkeypatch.setattr(server, 'ANALYSIS_POOL_MIN_ITEMS', float('inf'))
+
+    # mongomock checks the filter again after the update for ReturnDocument.AFTER,
+    # MongoDB returns the updated document (needed to claim job leases)
+    collection_class = type(server.db.compare_jobs)
+    find_one_and_update = collection_class.find_one_and_update
+
+    async def find_one_and_update_after(self, filter, update, projection=None, return_document=ReturnDocument.BEFORE, **kwargs):
+        if return_document != ReturnDocument.AFTER:
+            return await find_one_and_update(self, filter, update, projection=projection, return_document=return_document, **kwargs)
+        before = await find_one_and_update(self, filter, update, projection={'_id': 1}, **kwargs)
+        if before is None:
+            return None
+        return await self.find_one({'_id': before['_id']}, projection)
+
+    monkeypatch.setattr(collection_class, 'find_one_and_update', find_one_and_update_after)
+    return server
+
+
+@pytest.fixture
+def keepa(monkeypatch):
+    fake = FakeKeepa()
+    for provider in server.HTTP_CLIENT_CONFIGS:
+        monkeypatch.setitem(server.http_clients, provider, httpx.AsyncClient(transport=httpx.MockTransport(fake.handler)))
+    return fake
+
+
+async def insert_catalog(count: int, user: dict = USER, **fields) -> list:
+    """Catalog products p000, p001, ... with GTINs 1000, 1001, ..."""
+    await server.db.users.update_one({'id': user['id']}, {'$set': user}, upsert=True)
+    products = [
+        {
+            'id': f'p{i:03d}',
+            'user_id': user['id'],
+            'gtin': str(1000 + i),
+            'name': f'Product {i}',
+            'brand': 'Brand',
+            'category': 'Beauté',
+            'supplier_price_eur': 5.0,
+            **fields
+        }
+        for i in range(count)
+    ]
+    await server.db.catalog_products.insert_many([dict(product) for product in products])
+    return products
@@ -0,0 +1,259 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from fastapi import HTTPException
+
+import server
+from .conftest import USER, insert_catalog, keepa_product
+
+
+class ComparedChunks(list):
+    """Product ids of every run_compare_pipeline call; `delay` (seconds) slows each call down"""
+    delay = 0
+
+
+@pytest.fixture
+def compared_chunks(monkeypatch, keepa):
+    chunks = ComparedChunks()
+    run_compare_pipeline = server.run_compare_pipeline
+
+    async def recording_pipeline(ctx, product_ids, *args, **kwargs):
+        chunks.append(list(product_ids))
+        await asyncio.sleep(chunks.delay)
+        return await run_compare_pipeline(ctx, product_ids, *args, **kwargs)
+
+    monkeypatch.setattr(server, 'run_compare_pipeline', recording_pipeline)
+    monkeypatch.setattr(server, 'COMPARE_JOB_CHUNK_SIZE', 3)
+    for i in range(7):
+        keepa.add(4, keepa_product(f'A{i}', str(1000 + i)))
+    return chunks
+
+
+async def wait_for_jobs():
+    await asyncio.gather(*server.compare_job_tasks.values(), return_exceptions=True)
+
+
+async def get_job(job_id: str) -> dict:
+    return await server.db.compare_jobs.find_one({'id': job_id}, {'_id': 0})
+
+
+# ==================== COMPARE JOBS ====================
+
+def test_job_compares_catalog_in_chunks(compared_chunks):
+    async def run_job():
+        await insert_catalog(7)
+        job = await server.start_compare_job(USER, dataforseo_queue=False)
+        await wait_for_jobs()
+        return await get_job(job['id'])
+
+    job = asyncio.run(run_job())
+
+    assert compared_chunks == [['p000', 'p001', 'p002'], ['p003', 'p004', 'p005'], ['p006']]
+    assert job['status'] == 'completed'
+    assert (job['total'], job['processed'], job['succeeded'], job['failed']) == (7, 7, 7, 0)
+    assert job['finished_at'] and job['eta_seconds'] == 0
+
+
+def test_cancelled_job_stops_between_chunks(compared_chunks):
+    compared_chunks.delay = 0.05
+
+    async def cancel():
+        await insert_catalog(7)
+        job = await server.start_compare_job(USER, dataforseo_queue=False)
+        while not compared_chunks:
+            await asyncio.sleep(0.01)
+        await server.cancel_compare_job(job['id'], user=USER)
+        await wait_for_jobs()
+        return await get_job(job['id'])
+
+    job = asyncio.run(cancel())
+
+    assert len(compared_chunks) == 1
+    assert job['status'] == 'cancelled'
+    assert job['processed'] < 7 and job['finished_at']
+
+
+# ==================== LEASE AND CHECKPOINTS ====================
+
+async def insert_job(**fields) -> dict:
+    """A compare job of USER over the whole catalog, as start_compare_job creates it"""
+    job = {
+        'id': 'job-1',
+        'user_id': USER['id'],
+        'status': 'running',
+        'incremental': False,
+        'stale_before': None,
+        'dataforseo_queue': False,
+        'total': 7,
+        'skipped': 0,
+        'processed': 0,
+        'succeeded': 0,
+        'failed': 0,
+        'checkpoint_id': None,
+        'errors': [],
+        'cancel_requested': False,
+        'lease_owner': 'dead-worker',
+        'lease_expires_at': (datetime.now(timezone.utc) - timedelta(seconds=1)).isoformat(),
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'started_at': datetime.now(timezone.utc).isoformat(),
+        'finished_at': None,
+        **fields
+    }
+    await server.db.compare_jobs.insert_one(dict(job))
+    return job
+
+
+def test_expired_lease_is_resumed_from_checkpoint(compared_chunks):
+    async def resume():
+        await insert_catalog(7)
+        await insert_job(checkpoint_id='p003', processed=4, succeeded=3, failed=1)
+        resumed = await server.resume_orphaned_compare_jobs()
+        await wait_for_jobs()
+        return resumed, await get_job('job-1')
+
+    resumed, job = asyncio.run(resume())
+
+    assert resumed == 1
+    # Only the products after the checkpoint, with the counters carried over
+    assert compared_chunks == [['p004', 'p005', 'p006']]
+    assert job['status'] == 'completed'
+    assert (job['processed'], job['succeeded'], job['failed']) == (7, 6, 1)
+
+
+def test_live_lease_is_not_taken_over(compared_chunks):
+    async def resume():
+        await insert_catalog(7)
+        await insert_job(lease_expires_at=server.compare_job_lease_expiry())
+        return await server.resume_orphaned_compare_jobs(), await get_job('job-1')
+
+    resumed, job = asyncio.run(resume())
+
+    assert resumed == 0
+    assert compared_chunks == []
+    assert job['lease_owner'] == 'dead-worker'
+
+
+def test_runner_stops_when_its_lease_is_taken_over(compared_chunks, monkeypatch):
+    monkeypatch.setattr(server, 'COMPARE_JOB_HEARTBEAT_SECONDS', 0.01)
+    compared_chunks.delay = 0.05
+
+    async def take_over():
+        await insert_catalog(7)
+        job = await server.start_compare_job(USER, dataforseo_queue=False)
+        await asyncio.sleep(0.02)
+        await server.db.compare_jobs.update_one({'id': job['id']}, {'$set': {'lease_owner': 'other-worker'}})
+        await wait_for_jobs()
+        return await get_job(job['id'])
+
+    job = asyncio.run(take_over())
+
+    # The new owner's document is left alone
+    assert len(compared_chunks) == 1
+    assert job['status'] == 'running'
+    assert job['lease_owner'] == 'other-worker'
+    assert job['finished_at'] is None
+
+
+def test_shutdown_releases_lease_and_next_process_resumes(compared_chunks, monkeypatch):
+    compared_chunks.delay = 0.05
+
+    async def restart():
+        await insert_catalog(7)
+        job = await server.start_compare_job(USER, dataforseo_queue=False)
+        while len(compared_chunks) < 2:
+            await asyncio.sleep(0.01)
+        await server.release_compare_jobs()
+        interrupted = await get_job(job['id'])
+        monkeypatch.setattr(server, 'COMPARE_WORKER_ID', 'next-process')
+        compared_chunks.clear()
+        compared_chunks.delay = 0
+        resumed = await server.resume_orphaned_compare_jobs()
+        await wait_for_jobs()
+        return interrupted, resumed, await get_job(job['id'])
+
+    interrupted, resumed, job = asyncio.run(restart())
+
+    assert interrupted['status'] == 'running'
+    assert interrupted['lease_owner'] is None
+    assert (interrupted['checkpoint_id'], interrupted['processed']) == ('p002', 3)
+    assert resumed == 1
+    assert compared_chunks == [['p003', 'p004', 'p005'], ['p006']]
+    assert job['status'] == 'completed'
+    assert (job['processed'], job['checkpoint_id'], job['lease_owner']) == (7, 'p006', None)
+
+
+def test_resume_endpoint_refuses_completed_job(compared_chunks):
+    async def resume():
+        await insert_catalog(7)
+        await insert_job(status='completed', lease_owner=None, lease_expires_at=None)
+        with pytest.raises(HTTPException) as error:
+            await server.resume_compare_job('job-1', user=USER)
+        return error.value
+
+    assert asyncio.run(resume()).status_code == 409
+
+
+# ==================== INCREMENTAL QUERY ====================
+
+def test_incremental_query_selects_stale_and_changed_products():
+    recent = datetime.now(timezone.utc).isoformat()
+    old = (datetime.now(timezone.utc) - timedelta(days=30)).isoformat()
+    compared = {'compared_supplier_price_eur': 5.0}
+
+    async def select():
+        products = await insert_catalog(5)
+        changes = {
+            'p000': {'last_compared_at': None},
+            'p001': {'last_compared_at': old},
+            'p002': {'last_compared_at': recent},
+            'p003': {'last_compared_at': recent, 'supplier_price_eur': 6.0},
+            'p004': {'last_compared_at': recent, 'gtin': '999'},
+        }
+        for product in products:
+            fields = {**compared, 'compared_gtin': product['gtin'], **changes[product['id']]}
+            await server.db.catalog_products.update_one({'id': product['id']}, {'$set': fields})
+        query = server.build_compare_products_query(USER['id'], server.get_compare_stale_before(24))
+        docs = await server.db.catalog_products.find(query, {'_id': 0, 'id': 1}).sort('id', 1).to_list(None)
+        return [doc['id'] for doc in docs]
+
+    assert asyncio.run(select()) == ['p000', 'p001', 'p003', 'p004']
+
+
+def test_incremental_compare_all_skips_fresh_products(compared_chunks):
+    async def compare_twice():
+        await insert_catalog(7)
+        first = await server.compare_all_products(concurrency=None, incremental=True, max_age_hours=None, user=USER)
+        await server.db.catalog_products.update_one({'id': 'p005'}, {'$set': {'supplier_price_eur': 7.5}})
+        second = await server.compare_all_products(concurrency=None, incremental=True, max_age_hours=None, user=USER)
+        return first, second
+
+    first, second = asyncio.run(compare_twice())
+
+    assert (first['success'], first['skipped']) == (7, 0)
+    assert (second['success'], second['skipped']) == (1, 6)
+    assert compared_chunks[-1] == ['p005']
+
+
+# ==================== STREAMING ====================
+
+def test_stream_ends_with_error_and_partial_summary(monkeypatch):
+    async def failing_pipeline(ctx, product_ids, *args, **kwargs):
+        if product_ids[0] == 'c':
+            raise RuntimeError('Mongo unavailable')
+        return [{'product_id': product_id} for product_id in product_ids], [], {}
+
+    monkeypatch.setattr(server, 'run_compare_pipeline', failing_pipeline)
+
+    async def chunks():
+        for chunk in (['a', 'b'], ['c', 'd'], ['e']):
+            yield chunk
+
+    async def collect():
+        return [event async for event in server.stream_compare_events(None, chunks(), {'total': 5})]
+
+    events = asyncio.run(collect())
+
+    assert [event['type'] for event in events] == ['result', 'result', 'error', 'summary']
+    assert events[2]['product_ids'] == ['c', 'd']
+    assert events[3] == {'type': 'summary', 'total': 5, 'success': 2, 'failed': 2}
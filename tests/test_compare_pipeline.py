@@ -0,0 +1,168 @@
+import asyncio
+from concurrent.futures.process import BrokenProcessPool
+
+import server
+from .conftest import USER, insert_catalog, keepa_product
+
+FR = 4
+
+
+# ==================== BOUNDED CONCURRENCY ====================
+
+def test_map_bounded_keeps_order_limit_and_errors():
+    in_flight = 0
+    max_in_flight = 0
+
+    async def work(item):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await asyncio.sleep(0.01 * (5 - item))
+        in_flight -= 1
+        if item == 3:
+            raise ValueError(item)
+        return item * 10
+
+    results = asyncio.run(server.map_bounded(work, [0, 1, 2, 3, 4], 2))
+
+    assert results[:3] == [0, 10, 20] and results[4] == 40
+    assert isinstance(results[3], ValueError)
+    assert max_in_flight == 2
+
+
+def test_compare_concurrency_is_clamped():
+    assert server.resolve_compare_concurrency(None) == server.COMPARE_BATCH_CONCURRENCY
+    assert server.resolve_compare_concurrency(-3) == 1
+    assert server.resolve_compare_concurrency(1000) == server.COMPARE_BATCH_MAX_CONCURRENCY
+
+
+# ==================== STAGED PIPELINE ====================
+
+def test_batch_resolves_gtins_once_and_reports_unknown_products(keepa):
+    for i in range(3):
+        keepa.add(FR, keepa_product(f'A{i}', str(1000 + i), 2000 + 100 * i))
+
+    async def compare():
+        await insert_catalog(3)
+        return await server.compare_batch(['p000', 'missing', 'p001', 'p002'], user=USER)
+
+    response = asyncio.run(compare())
+
+    assert (response['success'], response['failed']) == (3, 1)
+    assert response['errors'] == [{'product_id': 'missing', 'error': '404: Product not found'}]
+    assert [result['amazon_price_eur'] for result in response['results']] == [20.0, 21.0, 22.0]
+    # One cascade request for the batch, no per-product GTIN lookup
+    assert [call for call in keepa.product_requests(FR) if call[1] == 'code'] == [(FR, 'code', ['1000', '1001', '1002'])]
+
+
+# ==================== BULK PERSISTENCE ====================
+
+def test_results_are_written_in_bulk(keepa, monkeypatch):
+    bulk_writes = []
+    collection_class = type(server.db.catalog_products)
+    bulk_write = collection_class.bulk_write
+
+    async def recording_bulk_write(self, operations, **kwargs):
+        if self.name == 'catalog_products':
+            bulk_writes.append((len(operations), kwargs.get('ordered')))
+        return await bulk_write(self, operations, **kwargs)
+
+    monkeypatch.setattr(collection_class, 'bulk_write', recording_bulk_write)
+    monkeypatch.setattr(server, 'COMPARE_BULK_WRITE_SIZE', 2)
+    for i in range(5):
+        keepa.add(FR, keepa_product(f'A{i}', str(1000 + i)))
+
+    async def compare():
+        await insert_catalog(5)
+        await server.run_compare_pipeline(server.CompareContext(USER), [f'p{i:03d}' for i in range(5)])
+        return await server.db.catalog_products.find({}, {'_id': 0}).to_list(None)
+
+    products = asyncio.run(compare())
+
+    assert sorted(bulk_writes) == [(1, False), (2, False), (2, False)]
+    assert all(product['amazon_price_eur'] == 19.99 and product['last_compared_at'] for product in products)
+
+
+def test_failed_bulk_write_fails_only_its_products(keepa, monkeypatch):
+    async def failing_bulk_write(self, operations, **kwargs):
+        raise RuntimeError('primary stepped down')
+
+    monkeypatch.setattr(type(server.db.catalog_products), 'bulk_write', failing_bulk_write)
+    keepa.add(FR, keepa_product('A0', '1000'))
+
+    async def compare():
+        await insert_catalog(1)
+        return await server.run_compare_pipeline(server.CompareContext(USER), ['p000'])
+
+    results, errors, _ = asyncio.run(compare())
+
+    assert results == []
+    assert errors == [{'product_id': 'p000', 'error': 'primary stepped down'}]
+
+
+def test_bulk_write_leaves_other_users_products_alone(keepa):
+    keepa.add(FR, keepa_product('A0', '1000'))
+    other_user = {**USER, 'id': 'user-2'}
+
+    async def compare():
+        # Inserted first: a write filtered on the product id alone would land on it
+        await insert_catalog(1, user=other_user)
+        await insert_catalog(1)
+        await server.run_compare_pipeline(server.CompareContext(USER), ['p000'])
+        return await server.db.catalog_products.find_one({'user_id': other_user['id']}, {'_id': 0})
+
+    other = asyncio.run(compare())
+
+    assert 'last_compared_at' not in other and 'amazon_price_eur' not in other
+
+
+# ==================== COMPARE PLANNER ====================
+
+def test_plan_counts_known_and_cached_gtins_without_fetching(keepa):
+    keepa.add(FR, keepa_product('A0', '1000'))
+
+    async def plan_twice():
+        await insert_catalog(3)
+        await server.record_keepa_miss('1002', 'Brand Product 2')
+        first = await server.plan_catalog_comparison(product_ids=None, user=USER)
+        requests = [request.url.path for request in keepa.requests]
+        await server.fetch_keepa_products('keepa-key', FR, codes=['1000'], profile='trend')
+        second = await server.plan_catalog_comparison(product_ids=None, user=USER)
+        return first, requests, second
+
+    first, requests, second = asyncio.run(plan_twice())
+
+    # Dry run: only the free token status call
+    assert requests == ['/token']
+    assert first['products'] == 3 and first['skipped'] == 0
+    assert (first['keepa']['known_absent'], first['keepa']['to_resolve']) == (1, 2)
+    assert first['keepa']['tokens_left'] == 1000
+    # A GTIN cached for the first domain resolves for free
+    assert (second['keepa']['cascade_cached'], second['keepa']['to_resolve']) == (1, 1)
+    assert second['keepa']['tokens'] < first['keepa']['tokens']
+
+
+# ==================== ANALYSIS PROCESS POOL ====================
+
+class BrokenExecutor:
+    def submit(self, *args, **kwargs):
+        raise BrokenProcessPool('worker killed')
+
+
+def test_small_analysis_runs_inline(monkeypatch):
+    monkeypatch.setattr(server, 'ANALYSIS_POOL_MIN_ITEMS', 50)
+    monkeypatch.setattr(server, 'analysis_executor', BrokenExecutor())
+
+    assert asyncio.run(server.run_analysis(sum, [1, 2, 3], items=3)) == 6
+
+
+def test_broken_analysis_pool_falls_back_inline(monkeypatch):
+    monkeypatch.setattr(server, 'ANALYSIS_POOL_MIN_ITEMS', 1)
+    monkeypatch.setattr(server, 'ANALYSIS_PROCESS_WORKERS', 1)
+    monkeypatch.setattr(server, 'analysis_executor', BrokenExecutor())
+
+    result = asyncio.run(server.run_analysis(sum, [1, 2, 3], items=3))
+
+    assert result == 6
+    # A new pool is started on the next call
+    assert server.analysis_executor is None
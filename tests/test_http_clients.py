@@ -0,0 +1,45 @@
+import asyncio
+
+import httpx
+
+import server
+
+
+def test_provider_client_is_shared_until_closed(monkeypatch):
+    monkeypatch.setattr(server, 'http_clients', {})
+
+    client = server.get_http_client('google')
+    shared = server.get_http_client('google') is client
+    asyncio.run(server.close_http_clients())
+
+    assert shared
+    assert client.is_closed and server.http_clients == {}
+    # Created again when used after the shutdown hook
+    assert server.get_http_client('google') is not client
+
+
+def test_provider_requests_are_bounded_in_flight(monkeypatch):
+    in_flight = 0
+    max_in_flight = 0
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        return httpx.Response(200, json={})
+
+    monkeypatch.setitem(server.HTTP_CLIENT_CONFIGS['google'], 'max_in_flight', 2)
+    monkeypatch.setitem(server.http_clients, 'google', httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+
+    async def send():
+        return await asyncio.gather(*(
+            server.provider_request('google', 'GET', f'https://www.googleapis.com/customsearch/v1?q={i}') for i in range(6)
+        ))
+
+    responses = asyncio.run(send())
+
+    assert [response.status_code for response in responses] == [200] * 6
+    assert max_in_flight == 2
+    assert server.get_provider_latency('google') < server.PROVIDER_DEFAULT_LATENCY_SECONDS['google']
@@ -0,0 +1,397 @@
+import asyncio
+import json
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+import server
+from .conftest import USER, insert_catalog, keepa_product, recent_history
+
+UK, DE, FR, IT, ES = 2, 3, 4, 8, 9
+
+
+# ==================== TOKEN BUCKET ====================
+
+def test_token_bucket_predicts_refills():
+    bucket = server.KeepaTokenBucket()
+    bucket.tokens_left = 0
+    bucket.refill_rate = 60
+    bucket.refill_in_ms = 30000
+    bucket.updated_at = 100.0
+
+    assert bucket.seconds_until_available(10, now=100.0) == 30.0
+    # Two refills needed: the next one, then a whole interval
+    assert bucket.seconds_until_available(70, now=100.0) == 90.0
+    assert bucket.estimate_tokens(now=100.0 + 30 + 60) == 120
+    # Never more than one hour of refills
+    assert bucket.estimate_tokens(now=100.0 + 24 * 3600) == bucket.capacity == 3600
+
+
+def test_token_bucket_syncs_from_response_and_consumes():
+    bucket = server.KeepaTokenBucket()
+    assert bucket.seconds_until_available(1000) == 0  # Unknown state: never blocks
+
+    bucket.update_from_response({'tokensLeft': 50, 'refillIn': 20000, 'refillRate': 20})
+    asyncio.run(bucket.acquire(30))
+
+    assert round(bucket.estimate_tokens()) == 20
+    assert bucket.status()['refill_rate_per_minute'] == 20
+
+
+def test_keepa_request_retries_rate_limit_after_refill(keepa):
+    keepa.add(FR, keepa_product('A1', '111'))
+    keepa.rate_limited(FR, 2)
+
+    status_code, data = asyncio.run(server.keepa_request('keepa-key', 'product', {'domain': FR, 'code': '111'}))
+
+    assert status_code == 200
+    assert [p['asin'] for p in data['products']] == ['A1']
+    assert len(keepa.product_requests()) == 3
+
+
+# ==================== RESPONSE CACHE ====================
+
+def test_fetch_is_served_from_cache(keepa):
+    keepa.add(FR, keepa_product('A1', '111'))
+
+    async def fetch_twice():
+        first, _ = await server.fetch_keepa_products('keepa-key', FR, codes=['111'])
+        server.keepa_cache.entries.clear()
+        # From the Mongo cache once the process cache is gone
+        second, _ = await server.fetch_keepa_products('keepa-key', FR, codes=['111'])
+        return first, second
+
+    first, second = asyncio.run(fetch_twice())
+
+    assert first['111']['asin'] == second['111']['asin'] == 'A1'
+    assert len(keepa.product_requests()) == 1
+
+
+def test_cache_keeps_only_what_callers_read(keepa):
+    old_and_recent = [1000, 4000] + recent_history([1500, 1600, 1700])
+    raw = {
+        **keepa_product('A1', '111'),
+        'offers': [{'sellerId': 'S'}] * 50,
+        'stats': {'current': list(range(1, 40)), 'avg30': list(range(1, 40)), 'avg180': list(range(40)), 'buyBoxPrice': 1550},
+        'csv': [old_and_recent, old_and_recent, None, old_and_recent] + [old_and_recent] * 10
+    }
+    keepa.add(FR, raw)
+
+    async def fetch():
+        found, _ = await server.fetch_keepa_products('keepa-key', FR, codes=['111'], profile='trend')
+        doc = await server.db.keepa_cache.find_one({'key': server.KeepaResponseCache.make_key(FR, 'code', '111', 'trend')})
+        history = await server.load_keepa_price_history('A1', FR)
+        return found['111'], doc['product'], history
+
+    cached, stored, history = asyncio.run(fetch())
+
+    assert cached == stored
+    assert set(cached) == {'asin', 'title', 'eanList', 'upcList', 'stats', 'csv'}
+    assert set(cached['stats']) == {'current', 'avg30', 'buyBoxPrice'}
+    assert len(cached['stats']['current']) == max(server.KEEPA_STATS_PRICE_INDICES) + 1
+    # Trend series only, over the trend window; the whole series goes to the history store
+    assert len(cached['csv']) == max(server.KEEPA_TREND_CSV_INDICES) + 1
+    assert cached['csv'][0] == cached['csv'][4] == old_and_recent[2:]
+    assert cached['csv'][2:4] == [None, None]
+    assert history['points'] == 4
+    assert server.extract_keepa_price(cached) == server.extract_keepa_price(raw)
+
+
+def test_full_profile_is_returned_whole_and_not_cached(keepa):
+    raw = {**keepa_product('A1', '111', history=[1000, 4000] + recent_history([1500])), 'offers': [{'sellerId': 'S'}] * 5}
+    keepa.add(FR, raw)
+
+    async def fetch_twice():
+        first, _ = await server.fetch_keepa_products('keepa-key', FR, asins=['A1'], profile='full')
+        second, _ = await server.fetch_keepa_products('keepa-key', FR, asins=['A1'], profile='full')
+        return first['A1'], second['A1'], await server.db.keepa_cache.count_documents({})
+
+    first, second, cached = asyncio.run(fetch_twice())
+
+    assert first == second == raw
+    assert cached == 0
+    assert len(keepa.product_requests(FR)) == 2
+
+
+def test_product_endpoint_returns_the_whole_keepa_response(keepa):
+    old_and_recent = [1000, 4000] + recent_history([1500, 1600])
+    keepa.add(1, {**keepa_product('A1', '111', history=old_and_recent), 'offers': [{'sellerId': 'S'}]})
+
+    async def drill_down():
+        response = await server.get_keepa_product('A1', user=USER)
+        return response, await server.load_keepa_price_history('A1', 1)
+
+    response, history = asyncio.run(drill_down())
+
+    assert response['tokensLeft'] == 1000
+    assert response['products'][0]['csv'][0] == old_and_recent
+    assert response['products'][0]['offers'] == [{'sellerId': 'S'}]
+    assert history['points'] == 3
+
+
+def test_cache_lru_is_capped_by_bytes():
+    product = keepa_product('A1', '111', history=list(range(200)))
+    size = len(json.dumps(product, separators=(',', ':')))
+    cache = server.KeepaResponseCache(size * 3)
+
+    for i in range(10):
+        cache._remember(f'key{i}', 1e12, 1e12, product)
+
+    assert list(cache.entries) == ['key7', 'key8', 'key9']
+    assert cache.size_bytes == size * 3
+    cache._remember('key9', 1e12, 1e12, product)
+    assert cache.size_bytes == size * 3
+
+
+# ==================== FETCH PROFILES ====================
+
+def test_smaller_profile_is_served_by_a_larger_cached_one(keepa):
+    keepa.add(FR, keepa_product('A1', '111'))
+
+    async def fetch():
+        trend, _ = await server.fetch_keepa_products('keepa-key', FR, codes=['111'], profile='trend')
+        price_only, _ = await server.fetch_keepa_products('keepa-key', FR, codes=['111'], profile='price-only')
+        return trend, price_only
+
+    trend, price_only = asyncio.run(fetch())
+
+    assert trend['111']['asin'] == price_only['111']['asin'] == 'A1'
+    assert len(keepa.product_requests()) == 1
+    assert 'history=1' in str(keepa.requests[0].url)
+
+
+def test_refresh_is_not_served_by_a_narrower_window(keepa):
+    keepa.add(FR, keepa_product('A1', '111'))
+
+    async def refresh(days):
+        found, _ = await server.fetch_keepa_products('keepa-key', FR, asins=['A1'], profile='refresh', days=days)
+        return found
+
+    async def fetch():
+        return [await refresh(days) for days in (30, 60, 30, 20)]
+
+    results = asyncio.run(fetch())
+
+    assert all(found['A1']['asin'] == 'A1' for found in results)
+    # The wider window is fetched again; repeated windows are cached, smaller ones are not served by larger ones
+    assert [request.url.params['days'] for request in keepa.requests] == ['30', '60', '20']
+
+
+# ==================== RACE MODE ====================
+
+def test_race_keeps_the_highest_priority_hit(keepa):
+    keepa.add(DE, keepa_product('A-DE', '111'))
+    keepa.add(IT, keepa_product('A-IT', '111'))
+    context = {}
+
+    keepa_product_found, domain_info = asyncio.run(
+        server.search_keepa_product_multi_domain('keepa-key', gtin='111', race=True, context=context)
+    )
+
+    assert keepa_product_found['asin'] == 'A-DE'
+    assert domain_info['domain'] == DE
+    assert context[FR] is None and context[DE]['asin'] == 'A-DE'
+
+
+# ==================== BATCH CASCADE ====================
+
+def test_cascade_sends_only_misses_to_next_domain(keepa):
+    keepa.add(FR, keepa_product('A1', '111'))
+    keepa.add(DE, keepa_product('A2', '222'))
+
+    resolved, not_looked_up, contexts = asyncio.run(
+        server.resolve_keepa_products_batch('keepa-key', ['111', '222', '333'])
+    )
+
+    assert {gtin: (product['asin'], domain['domain']) for gtin, (product, domain) in resolved.items()} == {
+        '111': ('A1', FR), '222': ('A2', DE)
+    }
+    assert not_looked_up == set()
+    requests = keepa.product_requests()
+    assert requests[0] == (FR, 'code', ['111', '222', '333'])
+    assert requests[1] == (DE, 'code', ['222', '333'])
+    assert all(codes == ['333'] for _, _, codes in requests[2:])
+    # Known results: the queried domains only
+    assert set(contexts['111']) == {FR}
+    assert contexts['222'][FR] is None and contexts['222'][DE]['asin'] == 'A2'
+    assert set(contexts['333']) == {domain['domain'] for domain in server.KEEPA_EUROPEAN_DOMAINS}
+
+
+def test_rate_limited_cascade_falls_back_to_per_product_gtin_lookup(keepa):
+    keepa.add(FR, keepa_product('A0', '1000', 2500))
+    keepa.add(FR, keepa_product('A1', '1001', 3500))
+    # The batch request and its retries are rate limited, the per-product lookups are not
+    keepa.rate_limited(FR, server.KEEPA_MAX_RETRIES + 1)
+
+    async def compare():
+        await insert_catalog(2)
+        resolved, not_looked_up, _ = await server.resolve_keepa_products_batch('keepa-key', ['1000', '1001'])
+        assert resolved == {} and not_looked_up == {'1000', '1001'}
+        keepa.rate_limited(FR, server.KEEPA_MAX_RETRIES + 1)
+        ctx = server.CompareContext(USER)
+        results, errors, _ = await server.run_compare_pipeline(ctx, ['p000', 'p001'])
+        misses = await server.db.keepa_negative_cache.count_documents({})
+        return results, errors, misses
+
+    results, errors, misses = asyncio.run(compare())
+
+    assert errors == []
+    assert [result['amazon_price_eur'] for result in results] == [25.0, 35.0]
+    # Not looked up is not a miss: the cascade stopped there, nothing in the negative cache
+    assert misses == 0
+    assert (DE, 'code', ['1000', '1001']) not in keepa.product_requests()
+    assert (FR, 'code', ['1000']) in keepa.product_requests()
+
+
+# ==================== MULTI-MARKET ARBITRAGE ====================
+
+def test_arbitrage_fetches_only_markets_missing_from_the_context(keepa):
+    keepa.add(UK, keepa_product('A1', '111', 1500))
+    context = {FR: keepa_product('A1', '111', 2000), DE: None}
+
+    arbitrage = asyncio.run(server.analyze_multi_market_arbitrage('111', 5.0, 'keepa-key', context))
+
+    assert sorted(domain for domain, _, _ in keepa.product_requests()) == [UK, ES]
+    assert arbitrage['markets']['FR']['price_eur'] == 20.0
+    assert arbitrage['markets']['UK']['price_eur'] == round(15.0 * 1.17, 2)
+    # Known misses are not fetched again
+    assert set(arbitrage['markets']) == {'FR', 'UK'}
+
+
+# ==================== CSV DECODER ====================
+
+def test_csv_decoder_drops_missing_prices_and_sorts():
+    minutes, prices = server.decode_keepa_csv([20, 1500, 10, -1, 5, 1200, 30, None, 40])
+
+    np.testing.assert_array_equal(minutes, [5, 20])
+    np.testing.assert_array_equal(prices, [12.0, 15.0])
+
+
+def test_batch_trend_analysis_matches_single_series():
+    histories = [[1500] * 12, [1500 + 100 * i for i in range(12)], [2500 - 60 * i for i in range(12)], [999]]
+    now = server.keepa_minutes_now()
+    decoded = [server.decode_keepa_csv(recent_history(history, days_between=7)) for history in histories]
+    series = [(minutes, prices, float(prices[-1])) for minutes, prices in decoded]
+
+    trends = server.analyze_price_series_batch(series, now_minutes=now)
+
+    assert trends == [server.analyze_price_series(*item, now_minutes=now) for item in series]
+    assert [trend and trend['trend'] for trend in trends] == ['stable', 'hausse', 'baisse', None]
+
+
+# ==================== HISTORY STORE ====================
+
+def test_history_store_round_trip():
+    history = recent_history([1000, 1100, 1200, 1300], days_between=10)
+
+    async def store():
+        await server.store_keepa_price_histories(FR, [{'asin': 'A1', 'csv': [history]}])
+        return await server.load_keepa_price_history('A1', FR)
+
+    stored = asyncio.run(store())
+
+    assert stored['version'] == 1
+    assert stored['points'] == 4
+    np.testing.assert_array_equal(stored['prices'], [10.0, 11.0, 12.0, 13.0])
+    np.testing.assert_array_equal(stored['minutes'], history[::2])
+
+
+def test_history_store_prefers_amazon_series():
+    async def store():
+        await server.store_keepa_price_histories(FR, [{'asin': 'A1', 'csv': [None, [100, 999, 200, 999], None, None, [100, 500, 200, 600]]}])
+        return await server.load_keepa_price_history('A1', FR), await server.load_keepa_price_history('A1', FR, csv_type=1)
+
+    by_priority, third_party = asyncio.run(store())
+
+    assert by_priority['csv_type'] == 4
+    assert third_party['csv_type'] == 1
+    assert by_priority['updated_at'] <= datetime.now(timezone.utc).replace(tzinfo=None) + timedelta(seconds=1)
+
+
+def test_windowed_refresh_merges_into_stored_history():
+    old = recent_history([1000, 1100, 1200, 1300], days_between=10)
+    recent = recent_history([1300, 1400], days_between=5)
+
+    async def store():
+        await server.store_keepa_price_histories(FR, [{'asin': 'A1', 'csv': [old]}])
+        await server.store_keepa_price_histories(FR, [{'asin': 'A1', 'csv': [recent]}], windowed=True)
+        return await server.load_keepa_price_history('A1', FR)
+
+    merged = asyncio.run(store())
+
+    assert merged['version'] == 2
+    # Stored points older than the fetched window are kept in front of it
+    np.testing.assert_array_equal(merged['prices'], [10.0, 11.0, 12.0, 13.0, 14.0])
+    np.testing.assert_array_equal(merged['minutes'], sorted(merged['minutes']))
+
+
+# ==================== GTIN INDEX ====================
+
+def test_resolved_gtin_is_fetched_by_asin_from_the_index(keepa):
+    keepa.add(IT, keepa_product('A1', '111'))
+
+    async def resolve_twice():
+        await server.resolve_keepa_products_batch('keepa-key', ['111'])
+        index = await server.lookup_gtin_asin_index(['111'])
+        keepa.requests.clear()
+        server.keepa_cache.entries.clear()
+        await server.db.keepa_cache.delete_many({})
+        resolved, _, contexts = await server.resolve_keepa_products_batch('keepa-key', ['111'])
+        return index, resolved, contexts
+
+    index, resolved, contexts = asyncio.run(resolve_twice())
+
+    assert index['111']['asin'] == 'A1'
+    assert index['111']['domain'] == IT
+    assert index['111']['method'] == 'gtin'
+    assert resolved['111'][0]['asin'] == 'A1'
+    assert keepa.product_requests() == [(IT, 'asin', ['A1'])]
+    # Index hit: no domain was queried by GTIN, the others stay unknown
+    assert set(contexts['111']) == {IT}
+
+
+# ==================== NEGATIVE CACHE ====================
+
+def test_negative_cache_backs_off_exponentially():
+    async def miss_twice():
+        await server.record_keepa_miss('111', 'Brand Product')
+        first = await server.db.keepa_negative_cache.find_one({'gtin': '111'})
+        await server.record_keepa_miss('111', 'Brand Product')
+        second = await server.db.keepa_negative_cache.find_one({'gtin': '111'})
+        absent = await server.is_keepa_known_absent('111', 'brand product ')
+        other_term = await server.is_keepa_known_absent('111', 'Other')
+        return first, second, absent, other_term
+
+    first, second, absent, other_term = asyncio.run(miss_twice())
+
+    assert (first['misses'], second['misses']) == (1, 2)
+    first_delay = first['retry_after'] - first['last_miss_at']
+    second_delay = second['retry_after'] - second['last_miss_at']
+    assert first_delay == timedelta(seconds=server.KEEPA_NEGATIVE_CACHE_BASE_SECONDS)
+    assert second_delay == 2 * first_delay
+    assert absent and not other_term
+
+
+def test_missed_gtin_is_not_searched_again(keepa):
+    async def compare_twice():
+        await insert_catalog(1)
+        await server.run_compare_pipeline(server.CompareContext(USER), ['p000'])
+        requests_after_first = len(keepa.product_requests())
+        await server.run_compare_pipeline(server.CompareContext(USER), ['p000'])
+        entries = await server.lookup_keepa_negative_cache(['1000'])
+        return requests_after_first, entries
+
+    requests_after_first, entries = asyncio.run(compare_twice())
+
+    assert requests_after_first == len(server.KEEPA_EUROPEAN_DOMAINS)
+    assert len(keepa.product_requests()) == requests_after_first
+    assert entries['1000']['misses'] == 1
+
+
+def test_resolution_clears_negative_cache_entry():
+    async def resolve():
+        await server.record_keepa_miss('111', None)
+        await server.record_gtin_asin_resolutions({'111': (keepa_product('A1', '111'), server.get_keepa_domain_info(FR))})
+        return await server.lookup_keepa_negative_cache(['111'])
+
+    assert asyncio.run(resolve()) == {}
@@ -0,0 +1,123 @@
+import asyncio
+
+import pytest
+
+import server
+from .conftest import USER, insert_catalog, keepa_product, recent_history
+
+FR, UK = 4, 2
+OLD_GBP_RATE, NEW_GBP_RATE = 1.17, 1.25
+
+# Fields written by both the compare path and the re-score
+RESCORED_FIELDS = [
+    'supplier_price_eur', 'amazon_price_eur', 'cheapest_source', 'cheapest_buy_price_eur', 'amazon_fees_eur',
+    'amazon_margin_eur', 'amazon_margin_percentage', 'supplier_margin_eur', 'supplier_margin_percentage',
+    'opportunity_score', 'opportunity_level', 'opportunity_details', 'profitability_predictions',
+    'best_price_eur', 'margin_eur', 'margin_percentage'
+]
+
+
+@pytest.fixture
+def compared_catalog(keepa, monkeypatch):
+    """Six products sold on Amazon.fr (even) or Amazon.co.uk (odd), with rising, falling or flat prices"""
+    monkeypatch.setattr(server, 'get_exchange_rate', lambda: asyncio.sleep(0, NEW_GBP_RATE))
+    trends = [[1500] * 12, [1500 + 40 * i for i in range(12)], [2500 - 60 * i for i in range(12)]]
+    for i in range(6):
+        history = trends[i % 3]
+        product = keepa_product(f'A{i}', str(1000 + i), history[-1] + 100 * i, history=recent_history(history, days_between=7))
+        keepa.add(UK if i % 2 else FR, product)
+
+    async def compare():
+        products = await insert_catalog(6)
+        for i, product in enumerate(products):
+            supplier_price_gbp = 4.0 + 2 * i
+            await server.db.catalog_products.update_one(
+                {'id': product['id']},
+                {'$set': {'supplier_price_gbp': supplier_price_gbp, 'supplier_price_eur': round(supplier_price_gbp * OLD_GBP_RATE, 2)}}
+            )
+        await server.compare_all_products(concurrency=None, incremental=False, max_age_hours=None, user=USER)
+
+    asyncio.run(compare())
+    return keepa
+
+
+async def catalog_docs() -> dict:
+    docs = await server.db.catalog_products.find({'user_id': USER['id']}, {'_id': 0}).to_list(None)
+    return {doc['id']: doc for doc in docs}
+
+
+def test_rescore_at_unchanged_rates_keeps_compare_results(compared_catalog):
+    async def rescore():
+        before = await catalog_docs()
+        await server.rescore_catalog(refresh_exchange_rate=False, user=USER)
+        return before, await catalog_docs()
+
+    before, after = asyncio.run(rescore())
+
+    for product_id, doc in before.items():
+        assert {field: after[product_id][field] for field in RESCORED_FIELDS} == {field: doc[field] for field in RESCORED_FIELDS}
+        assert after[product_id]['price_trend'] == doc['price_trend']
+
+
+def test_rescore_after_fx_change_matches_a_new_compare(compared_catalog, monkeypatch):
+    async def rescore_then_compare():
+        await server.rescore_catalog(refresh_exchange_rate=True, user=USER)
+        rescored = await catalog_docs()
+        # The same compare, run with the new GBP rate
+        for doc in rescored.values():
+            await server.db.catalog_products.update_one(
+                {'id': doc['id']}, {'$set': {'supplier_price_eur': round(doc['supplier_price_gbp'] * NEW_GBP_RATE, 2)}}
+            )
+        monkeypatch.setitem(server.get_keepa_domain_info(UK), 'exchange_rate', NEW_GBP_RATE)
+        await server.compare_all_products(concurrency=None, incremental=False, max_age_hours=None, user=USER)
+        return rescored, await catalog_docs()
+
+    rescored, compared = asyncio.run(rescore_then_compare())
+
+    for product_id, doc in compared.items():
+        assert {field: rescored[product_id][field] for field in RESCORED_FIELDS} == {field: doc[field] for field in RESCORED_FIELDS}
+        for field in ('current_price', 'trend', 'is_favorable'):
+            assert rescored[product_id]['price_trend'][field] == doc['price_trend'][field]
+    assert any(doc['amazon_currency'] == 'GBP' for doc in compared.values())
+
+
+def test_rescore_leaves_compared_supplier_price_to_compare(compared_catalog):
+    async def rescore():
+        await server.rescore_catalog(refresh_exchange_rate=True, user=USER)
+        stale = server.build_compare_products_query(USER['id'], server.get_compare_stale_before())
+        return await catalog_docs(), await server.db.catalog_products.count_documents(stale)
+
+    docs, stale = asyncio.run(rescore())
+
+    for doc in docs.values():
+        assert doc['compared_supplier_price_eur'] == round(doc['supplier_price_gbp'] * OLD_GBP_RATE, 2)
+        assert doc['supplier_price_eur'] == round(doc['supplier_price_gbp'] * NEW_GBP_RATE, 2)
+    # The new supplier prices still need a real compare (Google margins, arbitrage)
+    assert stale == 6
+
+
+def test_simulation_matches_rescore(compared_catalog):
+    async def simulate_then_rescore():
+        unchanged = await server.simulate_catalog(server.CatalogSimulationRequest(), user=USER)
+        simulated = await server.simulate_catalog(
+            server.CatalogSimulationRequest(exchange_rates={'GBP': NEW_GBP_RATE}), user=USER
+        )
+        await server.rescore_catalog(refresh_exchange_rate=True, user=USER)
+        return unchanged, simulated, await catalog_docs()
+
+    unchanged, simulated, rescored = asyncio.run(simulate_then_rescore())
+
+    assert unchanged['baseline'] == unchanged['simulated']
+    margins = [doc['amazon_margin_eur'] for doc in rescored.values() if doc['amazon_margin_eur'] is not None]
+    scores = [doc['opportunity_score'] for doc in rescored.values()]
+    assert simulated['simulated']['priced_products'] == len(margins)
+    assert simulated['simulated']['total_potential_margin'] == round(sum(margins), 2)
+    assert simulated['simulated']['profitable_products'] == sum(margin > 0 for margin in margins)
+    assert simulated['simulated']['avg_opportunity_score'] == round(sum(scores) / len(scores), 1)
+    levels = simulated['simulated']['opportunity_levels']
+    for level, count in levels.items():
+        assert count == sum(doc['opportunity_level'] == level for doc in rescored.values())
+    top = {product['product_id']: product for product in simulated['top_products']}
+    for product_id, product in top.items():
+        assert product['amazon_price_eur'] == rescored[product_id]['amazon_price_eur']
+        assert product['supplier_price_eur'] == rescored[product_id]['supplier_price_eur']
@@ -0,0 +1,129 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+import server
+from .conftest import USER
+
+PRODUCTS_URL = '/v3/merchant/google/products'
+
+
+class FakeDataForSEO:
+    """DataForSEO Google Shopping double: one shop offer per keyword, standard queue tasks ready at once"""
+
+    def __init__(self):
+        self.prices = {}
+        self.requests = []
+        self.tasks = {}  # task id -> keyword
+        self.failing = False
+
+    def paths(self) -> list:
+        return [request.url.path.removeprefix(PRODUCTS_URL) for request in self.requests]
+
+    def task_result(self, keyword: str) -> dict:
+        items = [{'type': 'google_shopping_serp', 'price': self.prices[keyword], 'seller': 'Shop', 'url': 'https://shop.example/p'}]
+        return {'status_code': server.DATAFORSEO_TASK_OK, 'result': [{'items': items}]}
+
+    async def handler(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        await asyncio.sleep(0)
+        if self.failing:
+            return httpx.Response(500, text='Internal error')
+        path = request.url.path.removeprefix(PRODUCTS_URL)
+        if path == '/live':
+            return httpx.Response(200, json={'tasks': [self.task_result(json.loads(request.content)[0]['keyword'])]})
+        if path == '/task_post':
+            created = []
+            for task in json.loads(request.content):
+                task_id = f'task-{len(self.tasks)}'
+                self.tasks[task_id] = task['keyword']
+                created.append({'id': task_id, 'status_code': server.DATAFORSEO_TASK_CREATED, 'data': task})
+            return httpx.Response(200, json={'tasks': created})
+        if path == '/tasks_ready':
+            return httpx.Response(200, json={'tasks': [{'result': [{'id': task_id} for task_id in self.tasks]}]})
+        task_id = path.rsplit('/', 1)[-1]
+        return httpx.Response(200, json={'tasks': [self.task_result(self.tasks[task_id])]})
+
+
+@pytest.fixture
+def dataforseo(monkeypatch):
+    fake = FakeDataForSEO()
+    monkeypatch.setitem(server.http_clients, 'dataforseo', httpx.AsyncClient(transport=httpx.MockTransport(fake.handler)))
+    return fake
+
+
+# ==================== WEB SEARCH CACHE ====================
+
+def test_search_is_shared_across_products_and_users(dataforseo):
+    dataforseo.prices['Brand Cream'] = 12.5
+    products = [{'brand': 'Brand', 'name': 'Cream'}, {'brand': 'brand', 'name': 'cream '}]
+
+    async def search():
+        concurrent = await asyncio.gather(*(
+            server.search_google_shopping_dataforseo(product, f'login-{i}', 'password') for i, product in enumerate(products)
+        ))
+        concurrent[0][1][0]['price'] = 0
+        later = await server.search_google_shopping_dataforseo(products[0], 'login-2', 'password')
+        return concurrent, later
+
+    concurrent, later = asyncio.run(search())
+
+    # The concurrent searches wait for the first one; the later one is served from the cache
+    assert dataforseo.paths() == ['/live']
+    assert concurrent[1][0] == later[0] == 12.5
+    assert later[1][0]['price'] == 12.5
+
+
+def test_failed_search_is_not_cached(dataforseo):
+    dataforseo.prices['Brand Cream'] = 12.5
+    dataforseo.failing = True
+    product = {'brand': 'Brand', 'name': 'Cream'}
+
+    async def search_twice():
+        failed = await server.search_google_shopping_dataforseo(product, 'login', 'password')
+        dataforseo.failing = False
+        return failed, await server.search_google_shopping_dataforseo(product, 'login', 'password')
+
+    failed, found = asyncio.run(search_twice())
+
+    assert failed == (None, [])
+    assert found[0] == 12.5
+    assert dataforseo.paths() == ['/live', '/live']
+
+
+# ==================== DATAFORSEO STANDARD QUEUE ====================
+
+def test_queue_batch_posts_each_uncached_query_once(dataforseo, monkeypatch):
+    monkeypatch.setattr(server, 'DATAFORSEO_POLL_SECONDS', 0)
+    dataforseo.prices.update({'Brand Cream': 12.5, 'Brand Soap': 3.0, 'Brand Gel': 7.0})
+    dataforseo.tasks['earlier-task'] = 'Brand Gel'
+    products = [
+        {'id': 'p0', 'brand': 'Brand', 'name': 'Cream'},
+        {'id': 'p1', 'brand': 'Brand', 'name': 'cream'},
+        {'id': 'p2', 'brand': 'Brand', 'name': 'Soap'},
+        {'id': 'p3', 'brand': 'Brand', 'name': 'Gel'},
+    ]
+
+    async def run_batch():
+        await server.web_search_cache.set('dataforseo', 'Brand Soap', [
+            {'supplier_name': 'Cached shop', 'url': 'https://cached.example/p', 'price': 2.5, 'is_lowest': False, 'is_amazon': False, 'source': 'google_shopping'}
+        ])
+        # Posted by an interrupted run of the job
+        await server.record_dataforseo_tasks(USER['id'], 'job-1', {'earlier-task': 'Brand Gel'})
+        batch = server.DataForSEOQueueBatch('login', 'password', USER['id'], products, job_id='job-1')
+        batch.start()
+        results = {product['id']: await batch.result(product['id']) for product in products}
+        await batch.close()
+        return results, await server.db.dataforseo_tasks.count_documents({})
+
+    results, recorded = asyncio.run(run_batch())
+
+    posts = [json.loads(request.content) for request in dataforseo.requests if request.url.path.endswith('/task_post')]
+    assert [[task['keyword'] for task in post] for post in posts] == [['Brand Cream']]
+    assert {product_id: result[0] for product_id, result in results.items()} == {'p0': 12.5, 'p1': 12.5, 'p2': 2.5, 'p3': 7.0}
+    # Each product gets its own copy of the shared results
+    assert results['p0'][1] is not results['p1'][1]
+    assert '/live' not in dataforseo.paths()
+    assert recorded == 0